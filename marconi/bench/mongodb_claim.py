@@ -0,0 +1,99 @@
+# Copyright (c) 2014 Rackspace, Inc.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures MongoDB claim throughput under consumer contention.
+
+Many consumers repeatedly claim, and then release, messages from a
+single queue, directly against the storage driver. Along with the
+throughput and latency, the number of messages each claim lost to
+parallel claims is reported, e.g.:
+
+    $ python -m marconi.bench.mongodb_claim -c 1,10,50,100
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import uuid
+
+from marconi.bench import storage
+
+
+QUEUE_NAME = 'bench-contended-queue'
+MESSAGE = {'ttl': 3600, 'body': {'event': 'BackupStarted', 'size': 42}}
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-u', '--uri', default='mongodb://localhost:27017')
+    parser.add_argument('-c', '--concurrency', default='1,10,50,100',
+                        type=storage.parse_int_list,
+                        help='Comma-separated list of consumer counts')
+    parser.add_argument('-m', '--messages', default=1000, type=int,
+                        help='Number of messages in the queue')
+    parser.add_argument('-l', '--limit', default=10, type=int,
+                        help='Max number of messages per claim')
+    parser.add_argument('-t', '--time', default=5, type=int,
+                        help='Duration of each run, in seconds')
+    args = parser.parse_args()
+
+    client_uuid = str(uuid.uuid4())
+    metadata = {'ttl': 60, 'grace': 60}
+
+    print('{0:>6} {1:>12} {2:>12} {3:>12}'.format('thrds', 'msgs/sec',
+                                                  'ms/claim', 'lost/claim'))
+
+    for concurrency in args.concurrency:
+        driver = storage.mongodb_driver(args.uri)
+        driver.queue_controller.create(QUEUE_NAME)
+
+        for offset in range(0, args.messages, 100):
+            batch = min(100, args.messages - offset)
+            driver.message_controller.post(QUEUE_NAME, [MESSAGE] * batch,
+                                           client_uuid)
+
+        claim_ctrl = driver.claim_controller
+
+        def claim():
+            claim_id, messages = claim_ctrl.create(QUEUE_NAME, metadata,
+                                                   limit=args.limit)
+            count = len(list(messages))
+
+            # Release the messages right away so that the queue
+            # never runs dry, keeping contention constant.
+            if claim_id is not None:
+                claim_ctrl.delete(QUEUE_NAME, claim_id)
+
+            return count
+
+        try:
+            results = storage.run_concurrently(claim, concurrency, args.time)
+
+            claims = driver.metrics.get('claims.created') or 1
+            lost = driver.metrics.get('claims.lost') / claims
+            storage.print_row(concurrency, *results,
+                              extra='{0:>12.2f}'.format(lost))
+        finally:
+            storage.drop_mongodb_databases(driver)
+
+    print('')  # Blank line
+
+
+def main():
+    run()
+
+
+if __name__ == '__main__':
+    main()
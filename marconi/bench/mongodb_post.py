@@ -0,0 +1,84 @@
+# Copyright (c) 2014 Rackspace, Inc.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures MongoDB post throughput on a single, hot queue.
+
+Posts are issued directly against the storage driver from an
+increasing number of threads, once with marker leasing disabled
+and once for each of the given lease sizes, e.g.:
+
+    $ python -m marconi.bench.mongodb_post -c 1,4,16,64 -l 0,100
+"""
+
+from __future__ import print_function
+
+import argparse
+import uuid
+
+from marconi.bench import storage
+
+
+QUEUE_NAME = 'bench-hot-queue'
+MESSAGE = {'ttl': 300, 'body': {'event': 'BackupStarted', 'size': 42}}
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-u', '--uri', default='mongodb://localhost:27017')
+    parser.add_argument('-c', '--concurrency', default='1,2,4,8,16,32,64',
+                        type=storage.parse_int_list,
+                        help='Comma-separated list of producer counts')
+    parser.add_argument('-l', '--lease-sizes', default='0,100',
+                        type=storage.parse_int_list,
+                        help='Comma-separated list of marker lease sizes')
+    parser.add_argument('-b', '--batch', default=1, type=int,
+                        help='Number of messages per post')
+    parser.add_argument('-t', '--time', default=5, type=int,
+                        help='Duration of each run, in seconds')
+    args = parser.parse_args()
+
+    messages = [MESSAGE] * args.batch
+    client_uuid = str(uuid.uuid4())
+
+    for lease_size in args.lease_sizes:
+        print('\nmarker_lease_size = {0}'.format(lease_size))
+        print('{0:>6} {1:>12} {2:>12}'.format('thrds', 'msgs/sec',
+                                              'ms/post'))
+
+        for concurrency in args.concurrency:
+            driver = storage.mongodb_driver(args.uri,
+                                            marker_lease_size=lease_size)
+            driver.queue_controller.create(QUEUE_NAME)
+            message_ctrl = driver.message_controller
+
+            def post():
+                message_ctrl.post(QUEUE_NAME, messages, client_uuid)
+                return len(messages)
+
+            try:
+                results = storage.run_concurrently(post, concurrency,
+                                                   args.time)
+                storage.print_row(concurrency, *results)
+            finally:
+                storage.drop_mongodb_databases(driver)
+
+    print('')  # Blank line
+
+
+def main():
+    run()
+
+
+if __name__ == '__main__':
+    main()
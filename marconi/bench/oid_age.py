@@ -0,0 +1,88 @@
+# Copyright (c) 2014 Rackspace, Inc.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares ways of denormalizing a page of MongoDB messages.
+
+Reports the time, per 1,000 messages, taken to compute message ages
+via ObjectId.generation_time (the original path) versus reading the
+timestamp straight from the ObjectId's binary form, both one message
+at a time and a whole page at once. Does not require a database, e.g.:
+
+    $ python -m marconi.bench.oid_age -n 1000 -r 200
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from bson import objectid
+
+from marconi.openstack.common import timeutils
+from marconi.queues.storage.mongodb import messages as mongo_messages
+from marconi.queues.storage.mongodb import utils
+
+
+def _generation_time_message(msg, now):
+    # The original implementation of _basic_message()
+    oid = msg['_id']
+    age = now - timeutils.delta_seconds(utils.EPOCH, oid.generation_time)
+
+    return {
+        'id': str(oid),
+        'age': int(age),
+        'ttl': msg['t'],
+        'body': msg['b'],
+    }
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--messages', default=1000, type=int,
+                        help='Number of messages per page')
+    parser.add_argument('-r', '--repeat', default=100, type=int,
+                        help='Number of pages to denormalize per path')
+    args = parser.parse_args()
+
+    page = [{'_id': objectid.ObjectId(), 't': 60, 'b': {'event': i}}
+            for i in range(args.messages)]
+    now = timeutils.utcnow_ts()
+
+    paths = [
+        ('generation_time', lambda: [_generation_time_message(msg, now)
+                                     for msg in page]),
+        ('binary', lambda: [mongo_messages._basic_message(msg, now)
+                            for msg in page]),
+        ('binary, batched', lambda: mongo_messages._basic_messages(page,
+                                                                   now)),
+    ]
+
+    print('{0:>16} {1:>16}'.format('path', 'ms/1k msgs'))
+
+    for name, func in paths:
+        seconds = min(timeit.repeat(func, number=args.repeat, repeat=3))
+        # Milliseconds per 1,000 messages
+        msecs = seconds / args.repeat / args.messages * 1000 * 1000
+        print('{0:>16} {1:>16.3f}'.format(name, msecs))
+
+    print('')  # Blank line
+
+
+def main():
+    run()
+
+
+if __name__ == '__main__':
+    main()
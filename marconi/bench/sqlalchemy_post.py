@@ -0,0 +1,140 @@
+# Copyright (c) 2014 Rackspace, Inc.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures SQLAlchemy post throughput for each way of inserting.
+
+Batches of messages are inserted from an increasing number of threads
+using each of the given strategies for learning the ids of the new
+rows, including the original one, which selected the highest ids in
+the table after inserting. "returning" requires a database that
+supports RETURNING, e.g., PostgreSQL:
+
+    $ python -m marconi.bench.sqlalchemy_post -c 1,4,16 -b 1,10 \\
+          -s select-last,each,contiguous
+
+By default, a temporary SQLite database is used.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import tempfile
+import uuid
+
+import sqlalchemy as sa
+
+from marconi.bench import storage
+from marconi.openstack.common import timeutils
+from marconi.queues.storage.sqlalchemy import messages
+from marconi.queues.storage.sqlalchemy import tables
+from marconi.queues.storage.sqlalchemy import utils
+
+
+QUEUE_NAME = 'bench-hot-queue'
+BODY = utils.json_encode({'event': 'BackupStarted', 'size': 42})
+
+
+def _select_last(trans, rows):
+    # The original implementation, which may return ids that belong
+    # to messages posted concurrently by other clients.
+    result = trans.execute(tables.Messages.insert(), rows)
+
+    statement = sa.sql.select([tables.Messages.c.id])
+    statement = statement.limit(result.rowcount)
+    statement = statement.order_by(tables.Messages.c.id.desc())
+    return [row[0] for row in reversed(trans.execute(statement).fetchall())]
+
+
+STRATEGIES = {
+    'select-last': _select_last,
+    'returning': messages.insert_returning,
+    'contiguous': messages.insert_contiguous,
+    'each': messages.insert_each,
+}
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-u', '--uri', default=None,
+                        help='Database URI; defaults to a temporary '
+                             'SQLite database')
+    parser.add_argument('-c', '--concurrency', default='1,2,4,8',
+                        type=storage.parse_int_list,
+                        help='Comma-separated list of producer counts')
+    parser.add_argument('-b', '--batches', default='1,10',
+                        type=storage.parse_int_list,
+                        help='Comma-separated list of messages per post')
+    parser.add_argument('-s', '--strategies',
+                        default='select-last,each,contiguous',
+                        type=lambda value: value.split(','),
+                        help='Comma-separated list of insert strategies: '
+                             '{0}'.format(', '.join(sorted(STRATEGIES))))
+    parser.add_argument('-t', '--time', default=5, type=int,
+                        help='Duration of each run, in seconds')
+    args = parser.parse_args()
+
+    uri = args.uri
+    if uri is None:
+        fd, path = tempfile.mkstemp(suffix='.db', prefix='marconi-bench-')
+        os.close(fd)
+        uri = 'sqlite:///' + path
+
+    client = str(uuid.uuid4())
+
+    for name in args.strategies:
+        insert_rows = STRATEGIES[name]
+
+        for batch in args.batches:
+            print('\nstrategy = {0}, batch = {1}'.format(name, batch))
+            print('{0:>6} {1:>12} {2:>12}'.format('thrds', 'msgs/sec',
+                                                  'ms/post'))
+
+            for concurrency in args.concurrency:
+                driver = storage.sqlalchemy_driver(uri)
+                driver.queue_controller.create(QUEUE_NAME)
+                qid = utils.get_qid(driver, QUEUE_NAME, '')
+
+                def post():
+                    created = timeutils.utcnow()
+                    now = timeutils.utcnow_ts()
+                    rows = [dict(qid=qid, ttl=300, expires=now + 300,
+                                 body=BODY, client=client,
+                                 created=created, cid=None)
+                            for _ in range(batch)]
+
+                    with driver.trans() as trans:
+                        insert_rows(trans, rows)
+
+                    return batch
+
+                try:
+                    results = storage.run_concurrently(post, concurrency,
+                                                       args.time)
+                    storage.print_row(concurrency, *results)
+                finally:
+                    storage.drop_sqlalchemy_tables(driver)
+
+    if args.uri is None:
+        os.remove(path)
+
+    print('')  # Blank line
+
+
+def main():
+    run()
+
+
+if __name__ == '__main__':
+    main()
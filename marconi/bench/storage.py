@@ -0,0 +1,144 @@
+# Copyright (c) 2014 Rackspace, Inc.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for benchmarking storage drivers directly.
+
+Unlike the producer and consumer benchmarks, these helpers talk to
+the storage layer without going through the HTTP transport, so that
+driver changes can be measured in isolation.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+from oslo.config import cfg
+
+from marconi.openstack.common.cache import cache as oslo_cache
+from marconi.queues.storage import mongodb
+from marconi.queues.storage.mongodb import options
+from marconi.queues.storage import sqlalchemy
+from marconi.queues.storage.sqlalchemy import options as sqla_options
+from marconi.queues.storage.sqlalchemy import tables as sqla_tables
+
+
+def mongodb_driver(uri, database='marconi_bench', **overrides):
+    """Creates a MongoDB data driver for benchmarking.
+
+    :param uri: MongoDB connection URI
+    :param database: Name of the database to use as a prefix for
+        the queues and message partition databases
+    :param overrides: Additional options to set in the
+        [drivers:storage:mongodb] group
+    """
+    conf = cfg.ConfigOpts()
+    conf.register_opts(options.MONGODB_OPTIONS, group=options.MONGODB_GROUP)
+
+    overrides['uri'] = uri
+    overrides['database'] = database
+    for name, value in overrides.items():
+        conf.set_override(name, value, group=options.MONGODB_GROUP)
+
+    return mongodb.DataDriver(conf, oslo_cache.get_cache())
+
+
+def drop_mongodb_databases(driver):
+    """Removes all databases created by a benchmark run."""
+    for db in driver.message_databases + [driver.queues_database]:
+        driver.connection.drop_database(db)
+
+
+def sqlalchemy_driver(uri, **overrides):
+    """Creates a SQLAlchemy data driver for benchmarking.
+
+    :param uri: SQLAlchemy database URI
+    :param overrides: Additional options to set in the
+        [drivers:storage:sqlalchemy] group
+    """
+    conf = cfg.ConfigOpts()
+    conf.register_opts(sqla_options.SQLALCHEMY_OPTIONS,
+                       group=sqla_options.SQLALCHEMY_GROUP)
+
+    overrides['uri'] = uri
+    for name, value in overrides.items():
+        conf.set_override(name, value, group=sqla_options.SQLALCHEMY_GROUP)
+
+    return sqlalchemy.DataDriver(conf, oslo_cache.get_cache())
+
+
+def drop_sqlalchemy_tables(driver):
+    """Removes all tables created by a benchmark run."""
+    driver.close_connection()
+    sqla_tables.metadata.drop_all(driver.engine)
+
+
+def run_concurrently(func, concurrency, duration):
+    """Calls `func` in a loop from several threads.
+
+    :param func: Callable taking no arguments. It may return the number
+        of operations it performed; None is counted as one operation.
+    :param concurrency: Number of threads to run in parallel
+    :param duration: Number of seconds to keep calling `func`
+
+    :returns: (total operations, total calls, total seconds spent
+        inside `func`, wall-clock seconds)
+    """
+    lock = threading.Lock()
+    totals = {'ops': 0, 'calls': 0, 'elapsed': 0.0}
+
+    def worker(end):
+        ops = calls = 0
+        elapsed = 0.0
+
+        while time.time() < end:
+            start = time.time()
+            result = func()
+            elapsed += time.time() - start
+
+            ops += 1 if result is None else result
+            calls += 1
+
+        with lock:
+            totals['ops'] += ops
+            totals['calls'] += calls
+            totals['elapsed'] += elapsed
+
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(start + duration,))
+               for _ in range(concurrency)]
+
+    for each_thread in threads:
+        each_thread.start()
+
+    for each_thread in threads:
+        each_thread.join()
+
+    wall_clock = time.time() - start
+    return totals['ops'], totals['calls'], totals['elapsed'], wall_clock
+
+
+def print_row(concurrency, ops, calls, elapsed, wall_clock, extra=''):
+    """Prints a single line of throughput and latency results."""
+    throughput = ops / wall_clock
+    latency = 1000 * elapsed / calls if calls else 0
+
+    print('{0:>6} {1:>12.0f} {2:>12.1f} {3}'.format(
+        concurrency, throughput, latency, extra))
+
+
+def parse_int_list(value):
+    """Parses a comma-separated list of integers, e.g., "1,4,16"."""
+    return [int(level) for level in value.split(',')]
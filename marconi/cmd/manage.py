@@ -0,0 +1,165 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Administrative commands that act on a storage backend directly."""
+
+from __future__ import print_function
+
+import sys
+
+from oslo.config import cfg
+
+from marconi.common import cli
+from marconi.queues import bootstrap
+from marconi.queues.storage import utils as storage_utils
+
+
+def _require_storage(conf, *names):
+    if conf.drivers.storage not in names:
+        msg = 'The configured storage driver is not "{0}".'
+        print(msg.format(names[0]), file=sys.stderr)
+        sys.exit(2)
+
+
+def _pools(control):
+    marker = None
+    while True:
+        page = list(control.pools_controller.list(marker=marker, limit=100,
+                                                  detailed=True))
+        if not page:
+            return
+
+        for pool in page:
+            yield pool
+
+        marker = page[-1]['name']
+
+
+def mongodb_bootstrap(conf, boot):
+    """Creates collections and indexes, and records the schema version."""
+
+    # Imported here so that the command works without pymongo
+    # installed, as long as it is not used.
+    from marconi.queues.storage.mongodb import schema
+
+    _require_storage(conf, 'mongodb')
+
+    if not conf.pooling:
+        schema.bootstrap(storage_utils.load_storage_driver(conf, boot.cache))
+        print('Bootstrapped the storage driver.')
+        return
+
+    schema.bootstrap_control(boot.control)
+    print('Bootstrapped the control driver.')
+
+    for pool in _pools(boot.control):
+        pool_conf = storage_utils.dynamic_conf(pool['uri'], pool['options'])
+        if pool_conf.drivers.storage != 'mongodb':
+            print('Skipped pool "{0}", which is not a mongodb '
+                  'pool.'.format(pool['name']))
+            continue
+
+        driver = storage_utils.load_storage_driver(pool_conf, boot.cache)
+        schema.bootstrap(driver)
+        print('Bootstrapped pool "{0}".'.format(pool['name']))
+
+
+def mongodb_indexes(conf, boot):
+    """Reports the size and usage of each messages index, per partition."""
+
+    # Imported here so that the command works without pymongo
+    # installed, as long as it is not used.
+    from marconi.queues.storage.mongodb import indexes
+
+    _require_storage(conf, 'mongodb')
+
+    driver = storage_utils.load_storage_driver(conf, boot.cache)
+
+    print('{0:>9} {1:>20} {2:>12} {3:>12} {4:>8}'.format(
+        'partition', 'index', 'size (KiB)', 'ops', 'unused'))
+
+    for row in indexes.report(driver):
+        ops = '-' if row['ops'] is None else row['ops']
+        print('{0:>9} {1:>20} {2:>12.1f} {3:>12} {4:>8}'.format(
+            row['partition'], row['name'], row['size'] / 1024.0, ops,
+            '' if row['expected'] else 'yes'))
+
+    if conf.command.drop_unused:
+        for partition, name in indexes.drop_unused(driver):
+            print('Dropped index "{0}" from partition {1}'.format(
+                name, partition))
+
+
+def sqlalchemy_migrate(conf, boot):
+    """Adds the columns and indexes that existing databases lack."""
+
+    # Imported here so that the command works without sqlalchemy
+    # installed, as long as it is not used.
+    from marconi.queues.storage.sqlalchemy import migration
+
+    _require_storage(conf, 'sqlalchemy', 'sqlite')
+
+    def _upgrade(driver, label):
+        for change in migration.upgrade(driver.engine):
+            print('{0}: {1}'.format(label, change))
+
+        print('Migrated {0}.'.format(label))
+
+    if not conf.pooling:
+        driver = storage_utils.load_storage_driver(conf, boot.cache)
+        _upgrade(driver, 'the storage driver')
+        return
+
+    for pool in _pools(boot.control):
+        pool_conf = storage_utils.dynamic_conf(pool['uri'], pool['options'])
+        if pool_conf.drivers.storage not in ('sqlalchemy', 'sqlite'):
+            print('Skipped pool "{0}", which is not a sqlalchemy '
+                  'pool.'.format(pool['name']))
+            continue
+
+        driver = storage_utils.load_storage_driver(pool_conf, boot.cache)
+        _upgrade(driver, 'pool "{0}"'.format(pool['name']))
+
+
+def _add_command_parsers(subparsers):
+    parser = subparsers.add_parser(
+        'mongodb-bootstrap',
+        help=mongodb_bootstrap.__doc__)
+    parser.set_defaults(func=mongodb_bootstrap)
+
+    parser = subparsers.add_parser(
+        'mongodb-indexes',
+        help=mongodb_indexes.__doc__)
+    parser.add_argument('--drop-unused', action='store_true',
+                        help='Drop indexes the driver is no longer '
+                             'configured to use, e.g., after enabling '
+                             'compact_indexes.')
+    parser.set_defaults(func=mongodb_indexes)
+
+    parser = subparsers.add_parser(
+        'sqlalchemy-migrate',
+        help=sqlalchemy_migrate.__doc__)
+    parser.set_defaults(func=sqlalchemy_migrate)
+
+
+@cli.runnable
+def run():
+    conf = cfg.CONF
+    conf.register_cli_opt(cfg.SubCommandOpt('command',
+                                            title='Commands',
+                                            handler=_add_command_parsers))
+    conf(project='marconi', prog='marconi-manage')
+
+    boot = bootstrap.Bootstrap(conf)
+    conf.command.func(conf, boot)
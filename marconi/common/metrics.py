@@ -0,0 +1,96 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""metrics: lightweight, in-process counters for instrumenting drivers."""
+
+import collections
+import contextlib
+import threading
+import time
+
+import six
+
+from marconi.common import workers
+import marconi.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Registry(object):
+    """A thread-safe collection of named counters.
+
+    Counters are created on first use and, unless documented as
+    gauges, only ever accumulate, so that consumers can compute rates
+    by diffing two snapshots. Gauges are adjusted by passing a
+    negative amount to `incr()`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(int)
+
+    def incr(self, name, amount=1):
+        """Adds `amount` (an int or a float) to the named counter."""
+        with self._lock:
+            self._counters[name] += amount
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Records the number and total duration of calls to a block.
+
+        Increments `name + '.count'`, and adds the number of seconds
+        spent inside the block to `name + '.seconds'`.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                self._counters[name + '.count'] += 1
+                self._counters[name + '.seconds'] += elapsed
+
+    def get(self, name):
+        """Returns the current value of the named counter."""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self):
+        """Returns a copy of all counters as a dict."""
+        with self._lock:
+            return dict(self._counters)
+
+
+class Reporter(workers.PeriodicWorker):
+    """Periodically logs a snapshot of some counters at INFO level.
+
+    :param snapshot: Callable that returns the counters to log as a
+        dict, such as `Registry.snapshot`
+    :param interval: Number of seconds between log messages
+    """
+
+    def __init__(self, snapshot, interval):
+        super(Reporter, self).__init__('metrics-reporter', Registry(),
+                                       interval)
+        self._snapshot = snapshot
+
+    def run_once(self):
+        counters = self._snapshot()
+        if not counters:
+            return
+
+        LOG.info(u'Metrics: %s', u', '.join(
+            u'%s=%s' % (name, round(value, 3)
+                        if isinstance(value, float) else value)
+            for name, value in sorted(six.iteritems(counters))))
@@ -0,0 +1,127 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""workers: background threads for periodic maintenance tasks."""
+
+import abc
+import threading
+
+import six
+
+import marconi.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+@six.add_metaclass(abc.ABCMeta)
+class PeriodicWorker(threading.Thread):
+    """Daemon thread that makes a pass over some work at an interval.
+
+    `run_once()` is called as soon as the thread starts, and then
+    every `interval` seconds, until `stop()` is called or
+    `is_done()` returns True for the result of a pass. Any exception
+    raised by a pass is logged, and the next pass goes ahead as usual.
+
+    Passes that work through batches of items can use `drain()`,
+    which pauses between batches and returns early once the worker
+    has been asked to stop.
+
+    :param name: Name of the thread
+    :param metrics: Registry in which to record the work done
+    :param interval: Number of seconds to wait between passes
+    :param batch_size: (Default 1) Number of items per batch
+    :param batch_delay: (Default 0) Seconds to wait between batches
+    :param timer: (Default None) Name under which to record the time
+        spent per pass, if any
+    """
+
+    def __init__(self, name, metrics, interval, batch_size=1,
+                 batch_delay=0, timer=None):
+        super(PeriodicWorker, self).__init__(name=name)
+        self.daemon = True
+
+        self._metrics = metrics
+        self._interval = interval
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._timer = timer
+        self._stop_event = threading.Event()
+
+    @property
+    def stopping(self):
+        """True once the thread has been asked to exit."""
+        return self._stop_event.is_set()
+
+    def stop(self):
+        """Asks the thread to exit at the next opportunity."""
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self._timer is None:
+                    result = self.run_once()
+                else:
+                    with self._metrics.timed(self._timer):
+                        result = self.run_once()
+
+            except Exception as ex:
+                LOG.exception(ex)
+
+            else:
+                if self.is_done(result):
+                    return
+
+            self._stop_event.wait(self._interval)
+
+    @abc.abstractmethod
+    def run_once(self):
+        """Makes a single pass over the work.
+
+        :returns: A summary of the work done, passed to `is_done()`
+        """
+        raise NotImplementedError
+
+    def is_done(self, result):
+        """Returns True if no more passes are needed.
+
+        :param result: The value returned by the last `run_once()`
+        """
+        return False
+
+    def drain(self, process, metric=None):
+        """Processes batches of items until a batch comes up short.
+
+        :param process: Callable that takes the maximum number of
+            items to process, and returns the number processed
+        :param metric: (Default None) Name of the counter to which
+            to add the number of items processed, if any
+        :returns: The number of items processed
+        """
+        total = 0
+
+        while not self._stop_event.is_set():
+            count = process(self._batch_size)
+
+            if count:
+                total += count
+                if metric is not None:
+                    self._metrics.incr(metric, count)
+
+            if count < self._batch_size:
+                break
+
+            self._stop_event.wait(self._batch_delay)
+
+        return total
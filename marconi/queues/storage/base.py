@@ -19,12 +19,19 @@ import abc
 
 import six
 
+from marconi.common import metrics
+from marconi.queues.storage import errors
+
 DEFAULT_QUEUES_PER_PAGE = 10
 DEFAULT_MESSAGES_PER_PAGE = 10
 DEFAULT_POOLS_PER_PAGE = 10
 
 DEFAULT_MESSAGES_PER_CLAIM = 10
 
+# Seconds to wait for each background thread to exit when a
+# driver's connection is closed.
+WORKER_STOP_TIMEOUT = 10
+
 
 @six.add_metaclass(abc.ABCMeta)
 class DriverBase(object):
@@ -35,10 +42,14 @@ class DriverBase(object):
     :param cache: Cache instance to use for reducing latency
         for certain lookups.
     :type cache: `marconi.openstack.common.cache.backends.BaseCache`
+
+    Drivers may record instrumentation data, such as retry counts
+    and timings, in `self.metrics`.
     """
     def __init__(self, conf, cache):
         self.conf = conf
         self.cache = cache
+        self.metrics = metrics.Registry()
 
 
 @six.add_metaclass(abc.ABCMeta)
@@ -61,6 +72,39 @@ class DataDriverBase(DriverBase):
     def __init__(self, conf, cache):
         super(DataDriverBase, self).__init__(conf, cache)
 
+        # Background threads started by the driver; see _start_worker()
+        self._workers = []
+
+    def _start_worker(self, worker):
+        """Starts a background thread to be stopped with the driver.
+
+        :param worker: A `marconi.common.workers.PeriodicWorker`
+        """
+        self._workers.append(worker)
+        worker.start()
+
+    def close_connection(self):
+        """Releases the resources held by the driver.
+
+        Stops every background thread started by the driver, waiting
+        up to WORKER_STOP_TIMEOUT seconds for each to exit. Drivers
+        that hold connections close them as well.
+        """
+        workers, self._workers = self._workers, []
+
+        for worker in workers:
+            worker.stop()
+
+        for worker in workers:
+            worker.join(WORKER_STOP_TIMEOUT)
+
+    def metrics_snapshot(self):
+        """Returns the driver's counters, as a dict, for reporting.
+
+        Meta-drivers include the counters of the drivers they wrap.
+        """
+        return self.metrics.snapshot()
+
     @abc.abstractmethod
     def is_alive(self):
         """Check whether the storage is ready."""
@@ -222,7 +266,7 @@ class Message(ControllerBase):
     def list(self, queue, project=None, marker=None,
              limit=DEFAULT_MESSAGES_PER_PAGE,
              echo=False, client_uuid=None,
-             include_claimed=False):
+             include_claimed=False, include_body=True):
         """Base method for listing messages.
 
         :param queue: Name of the queue to get the
@@ -236,6 +280,10 @@ class Message(ControllerBase):
         :param client_uuid: A UUID object. Required when echo=False.
         :param include_claimed: omit claimed messages from listing?
         :type include_claimed: bool
+        :param include_body: (Default True) Set to False to omit the
+            message bodies, e.g., for observers that only need to
+            track progress through the queue.
+        :type include_body: bool
 
         :returns: An iterator giving a sequence of messages and
             the marker of the next page.
@@ -303,6 +351,44 @@ class Message(ControllerBase):
         """
         raise NotImplementedError
 
+    def post_many(self, batches, client_uuid, project=None):
+        """Posts messages to several queues at once.
+
+        Drivers that can post to several queues in fewer round trips
+        than it takes to post to each of them in turn override this
+        method. The default implementation simply calls `post()` for
+        each queue.
+
+        :param batches: A dict mapping the name of each queue to post
+            to, to the messages to post to it, as given to `post()`.
+        :param client_uuid: A UUID object.
+        :param project: Project id
+
+        :returns: A dict mapping each queue name to the list of
+            message ids posted to that queue
+        :raises: QueueDoesNotExist if any of the queues does not
+            exist, in which case nothing is posted. FanoutIncomplete
+            if posting to one of the queues fails after messages were
+            already posted to others, which are not backed out.
+        """
+        queue_controller = self.driver.queue_controller
+        for queue in batches:
+            if not queue_controller.exists(queue, project=project):
+                raise errors.QueueDoesNotExist(queue, project)
+
+        results = {}
+        for queue, messages in six.iteritems(batches):
+            try:
+                results[queue] = self.post(queue, messages, client_uuid,
+                                           project=project)
+            except Exception:
+                if not results:
+                    raise
+
+                raise errors.FanoutIncomplete(project, results)
+
+        return results
+
     @abc.abstractmethod
     def delete(self, queue, message_id, project=None, claim=None):
         """Base method for deleting a single message.
@@ -341,6 +427,26 @@ class Message(ControllerBase):
         """
         raise NotImplementedError
 
+    def wait(self, queue, project=None, since=None, timeout=0):
+        """Blocks until new messages may have been posted to a queue.
+
+        Drivers that are able to notify waiting readers of new
+        messages override this method, so that consumers on quiet
+        queues need not keep polling them. The default implementation
+        returns right away.
+
+        :param queue: Name of the queue to wait on
+        :param project: Project id
+        :param since: (Default now) UNIX timestamp of the caller's
+            last listing of the queue; messages posted at or after
+            this time cause the method to return right away.
+        :param timeout: (Default 0) Max number of seconds to wait
+        :returns: True if messages may have been posted since the
+            given time, False if the timeout expired first, or if
+            the driver does not support waiting.
+        """
+        return False
+
 
 @six.add_metaclass(abc.ABCMeta)
 class Claim(ControllerBase):
@@ -0,0 +1,195 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""codecs: optional compression of message bodies at rest.
+
+Compressed bodies are framed with a header naming the codec used, so
+that they can still be read after a pool's codec has been changed or
+compression has been turned off. Serialized JSON never begins with a
+NUL byte, which is how framed bodies are told apart from plain ones:
+
+    b'\\x00' + codec name + b'\\x00' + compressed data
+
+Besides the built-in codecs, any codec registered under the
+'marconi.queues.storage.codecs' entry point namespace may be used.
+"""
+
+import abc
+import time
+import zlib
+
+import six
+from stevedore import driver
+
+from marconi.i18n import _
+
+_NAMESPACE = 'marconi.queues.storage.codecs'
+_MARK = b'\x00'
+
+
+@six.add_metaclass(abc.ABCMeta)
+class Codec(object):
+    """Compresses and decompresses serialized message bodies."""
+
+    @abc.abstractmethod
+    def compress(self, data):
+        """Returns a compressed copy of `data` (a byte string)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def decompress(self, data):
+        """Reverses `compress()`."""
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+
+    def __init__(self, level=6):
+        self._level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self._level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+_BUILTIN_CODECS = {
+    'zlib': ZlibCodec,
+}
+
+_loaded = {}
+
+
+def load(name):
+    """Returns the codec registered under the given name.
+
+    :raises: ValueError if no such codec exists
+    """
+    try:
+        return _loaded[name]
+    except KeyError:
+        pass
+
+    if name in _BUILTIN_CODECS:
+        codec = _BUILTIN_CODECS[name]()
+    else:
+        try:
+            mgr = driver.DriverManager(_NAMESPACE, name, invoke_on_load=True)
+        except RuntimeError as ex:
+            msg = _(u'Unknown message body codec "{0}": {1}')
+            raise ValueError(msg.format(name, ex))
+
+        codec = mgr.driver
+
+    _loaded[name] = codec
+    return codec
+
+
+def is_compressed(data):
+    """Returns True if `data` was framed by `BodyCompressor`."""
+    return data[:1] == _MARK
+
+
+def decompress(data, metrics=None):
+    """Returns the plain serialized body for `data`.
+
+    Bodies that were stored uncompressed are returned as-is.
+
+    :param data: A body as stored
+    :param metrics: (Default None) The driver's
+        `marconi.common.metrics.Registry`. If given, the number of
+        bodies decompressed and the time spent doing so are added to
+        `compression.decompressed` and
+        `compression.decompress_seconds`.
+    """
+    if not is_compressed(data):
+        return data
+
+    start = time.time()
+
+    end = data.index(_MARK, 1)
+    name = data[1:end].decode('ascii')
+    plain = load(name).decompress(data[end + 1:])
+
+    if metrics is not None:
+        metrics.incr('compression.decompressed')
+        metrics.incr('compression.decompress_seconds', time.time() - start)
+
+    return plain
+
+
+class BodyCompressor(object):
+    """Compresses serialized bodies above a size threshold.
+
+    The number of bytes seen and stored, and the time spent
+    compressing, are recorded in the driver's metrics, from which
+    the achieved compression ratio can be derived:
+
+        compression.bytes_out / compression.bytes_in
+
+    :param name: Name of the codec to use; see `load()`
+    :param threshold: Bodies smaller than this many bytes, once
+        serialized, are stored uncompressed.
+    :param metrics: The driver's `marconi.common.metrics.Registry`
+    """
+
+    def __init__(self, name, threshold, metrics):
+        self._codec = load(name)
+        self._header = _MARK + six.b(name) + _MARK
+        self._threshold = threshold
+        self._metrics = metrics
+
+    def compress(self, data):
+        """Returns `data` framed and compressed, if worth it.
+
+        Bodies below the threshold, and those that do not get
+        any smaller, are returned unchanged.
+        """
+        if len(data) < self._threshold:
+            return data
+
+        start = time.time()
+        compressed = self._header + self._codec.compress(data)
+
+        metrics = self._metrics
+        metrics.incr('compression.compress_seconds', time.time() - start)
+
+        if len(compressed) >= len(data):
+            metrics.incr('compression.skipped')
+            return data
+
+        metrics.incr('compression.compressed')
+        metrics.incr('compression.bytes_in', len(data))
+        metrics.incr('compression.bytes_out', len(compressed))
+
+        return compressed
+
+
+def compressor_from_conf(driver_conf, metrics):
+    """Returns the `BodyCompressor` configured for a driver.
+
+    :param driver_conf: The driver's config group, which must
+        include the `body_codec` and `body_compression_threshold`
+        options. For pooled drivers, these may be set through the
+        pool's options.
+    :param metrics: The driver's `marconi.common.metrics.Registry`
+    :returns: A compressor, or None if compression is disabled
+    """
+    if not driver_conf.body_codec:
+        return None
+
+    return BodyCompressor(driver_conf.body_codec,
+                          driver_conf.body_compression_threshold,
+                          metrics)
@@ -64,6 +64,29 @@ class MessageConflict(Conflict):
             return self._succeeded_ids
 
 
+class FanoutIncomplete(ExceptionBase):
+
+    msg_format = (u'Messages could not be posted to every queue '
+                  u'in project {project}')
+
+    def __init__(self, project, succeeded_ids):
+        """Initializes the error with contextual information.
+
+        :param project: name of the project to which the queues belong
+        :param succeeded_ids: dict mapping the name of each queue to
+            which messages were posted, to the list of IDs of the
+            messages posted to it. Queues missing from the dict did
+            not receive any messages.
+        """
+
+        super(FanoutIncomplete, self).__init__(project=project)
+        self._succeeded_ids = succeeded_ids
+
+    @property
+    def succeeded_ids(self):
+        return self._succeeded_ids
+
+
 class QueueDoesNotExist(DoesNotExist):
 
     msg_format = u'Queue {name} does not exist for project {project}'
@@ -44,21 +44,31 @@ class CatalogueController(base.CatalogueBase):
         super(CatalogueController, self).__init__(*args, **kwargs)
 
         self._col = self.driver.database.catalogue
+
+        if not self.driver.schema_bootstrapped:
+            self._ensure_indexes()
+
+    def _ensure_indexes(self):
         self._col.ensure_index(CATALOGUE_INDEX, unique=True)
 
     @utils.raises_conn_error
     def _insert(self, project, queue, pool, upsert):
         key = utils.scope_queue_name(queue, project)
-        return self._col.update({PRIMARY_KEY: key},
-                                {'$set': {'s': pool}}, upsert=upsert)
+
+        # Updates, unlike upserts, check whether the entry existed
+        with self.driver.write_concerns.write(
+                'admin', needs_result=not upsert) as options:
+            return self._col.update({PRIMARY_KEY: key},
+                                    {'$set': {'s': pool}}, upsert=upsert,
+                                    **options)
 
     @utils.raises_conn_error
     def list(self, project):
         fields = {'_id': 0}
 
         query = utils.scoped_query(None, project)
-        return utils.HookedCursor(self._col.find(query, fields),
-                                  _normalize)
+        return utils.BatchedCursor(self._col.find(query, fields),
+                                   utils.denormalize_each(_normalize))
 
     @utils.raises_conn_error
     def get(self, project, queue):
@@ -83,8 +93,11 @@ class CatalogueController(base.CatalogueBase):
 
     @utils.raises_conn_error
     def delete(self, project, queue):
-        self._col.remove({PRIMARY_KEY: utils.scope_queue_name(queue, project)},
-                         w=0)
+        with self.driver.write_concerns.write(
+                'admin', default='unacknowledged') as options:
+            self._col.remove(
+                {PRIMARY_KEY: utils.scope_queue_name(queue, project)},
+                **options)
 
     def update(self, project, queue, pool=None):
         # NOTE(cpp-cabrera): _insert handles conn_error
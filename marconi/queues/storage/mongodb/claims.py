@@ -29,6 +29,7 @@ import marconi.openstack.common.log as logging
 from marconi.openstack.common import timeutils
 from marconi.queues import storage
 from marconi.queues.storage import errors
+from marconi.queues.storage.mongodb import messages
 from marconi.queues.storage.mongodb import utils
 
 
@@ -116,11 +117,21 @@ class ClaimController(storage.Claim):
         list we execute a query filtering by the ids returned
         by the previous query.
 
+        The candidate messages are fetched together with the fields
+        needed to return them, so that in the common, uncontended
+        case, the claim is created in exactly two operations: a
+        find and a multi-document update that both stamps the claim
+        and extends the lifetime of any messages that would expire
+        before the claim does. Only when some of the candidates need
+        extending and others don't does this take a second update.
+
         Since there's a lot of space for race conditions here,
         we'll check if the number of updated records is equal to
-        the max number of messages to claim. If the number of updated
-        messages is lower than limit we'll try to claim the remaining
-        number of messages.
+        the number of candidates. If some of the candidates were
+        claimed by a parallel request in the meantime, a third,
+        id-only query is needed to find out which messages we
+        actually won. The number of messages lost to such races
+        is recorded under the `claims.lost` metric.
 
         This 2 queries are required because there's no way, as for the
         time being, to execute an update on a limited number of records.
@@ -146,14 +157,15 @@ class ClaimController(storage.Claim):
 
         # Get a list of active, not claimed nor expired
         # messages that could be claimed.
-        msgs = msg_ctrl._active(queue, fields={'_id': 1}, project=project,
-                                limit=limit)
+        msgs = msg_ctrl._active(queue,
+                                fields=dict(messages.MESSAGE_FIELDS, e=1),
+                                project=project, limit=limit)
 
-        messages = iter([])
-        ids = [msg['_id'] for msg in msgs]
+        candidates = list(msgs)
+        if not candidates:
+            return (None, iter([]))
 
-        if len(ids) == 0:
-            return (None, messages)
+        ids = [msg['_id'] for msg in candidates]
 
         now = timeutils.utcnow_ts()
 
@@ -168,34 +180,85 @@ class ClaimController(storage.Claim):
         # to the current time when the message is
         # posted. There is no need to check whether
         # 'c' exists or 'c.id' is None.
-        collection = msg_ctrl._collection(queue, project)
-        updated = collection.update({'_id': {'$in': ids},
-                                     'c.e': {'$lte': now}},
-                                    {'$set': {'c': meta}},
-                                    upsert=False,
-                                    multi=True)['n']
-
-        # NOTE(flaper87): Dirty hack!
-        # This sets the expiration time to
-        # `expires` on messages that would
-        # expire before claim.
-        new_values = {'e': message_expiration, 't': message_ttl}
-        collection.update({'p_q': utils.scope_queue_name(queue, project),
-                           'e': {'$lt': message_expiration},
-                           'c.id': oid},
-                          {'$set': new_values},
-                          upsert=False, multi=True)
-
-        if updated != 0:
+        #
+        # Messages that would expire before the claim does have
+        # their expiration and TTL bumped in the same update, rather
+        # than in a second pass over the claimed messages. The TTL
+        # of the others is left alone. Their expiration is checked
+        # again by the update, in case a parallel claim bumped it.
+        collections = msg_ctrl._collections_for(queue, project)
+
+        extended = set(msg['_id'] for msg in candidates
+                       if msg['e'] < message_expiration)
+
+        batches = (
+            ([id_ for id_ in ids if id_ in extended],
+             {'e': {'$lt': message_expiration}},
+             {'$set': {'c': meta, 'e': message_expiration,
+                       't': message_ttl}}),
+            ([id_ for id_ in ids if id_ not in extended],
+             {},
+             {'$set': {'c': meta}}),
+        )
+
+        updated = 0
+        with self.driver.write_concerns.write(
+                'claim', needs_result=True) as options:
+            for batch_ids, query, update in batches:
+                if not batch_ids:
+                    continue
+
+                query = dict(query, **{'_id': {'$in': batch_ids},
+                                       'c.e': {'$lte': now}})
+
+                for collection in collections:
+                    updated += collection.update(
+                        query, update, upsert=False, multi=True,
+                        **options)['n']
+
+        # A message that is being moved to a new partition may have
+        # been updated in both, so don't count it twice.
+        updated = min(updated, len(ids))
+
+        msg_ctrl._queue_ctrl._inc_stats(queue, project, claimed=updated)
+
+        lost = len(ids) - updated
+        if lost or len(collections) > 1:
             # NOTE(kgriffs): This extra step is necessary because
             # in between having gotten a list of active messages
             # and updating them, some of them may have been
             # claimed by a parallel request. Therefore, we need
             # to find out which messages were actually tagged
             # with the claim ID successfully.
-            claim, messages = self.get(queue, oid, project=project)
-
-        return (str(oid), messages)
+            won = set()
+            if updated:
+                won = set(msg['_id'] for collection in collections
+                          for msg in collection.find(
+                              {'_id': {'$in': ids}, 'c.id': oid},
+                              fields={'_id': 1}).hint(
+                                  messages.ID_INDEX_FIELDS))
+
+            candidates = [msg for msg in candidates if msg['_id'] in won]
+            lost = len(ids) - len(candidates)
+
+        if lost:
+            LOG.debug(u'Lost %(lost)d of %(total)d messages to parallel '
+                      u'claims on queue %(queue)s under project '
+                      u'%(project)s',
+                      {'lost': lost, 'total': len(ids),
+                       'queue': queue, 'project': project})
+
+        self.driver.metrics.incr('claims.created')
+        self.driver.metrics.incr('claims.messages', updated)
+        self.driver.metrics.incr('claims.lost', lost)
+
+        for msg in candidates:
+            if msg['_id'] in extended:
+                msg['t'] = message_ttl
+
+        basic_messages = messages._basic_messages(candidates, now,
+                                                  self.driver.metrics)
+        return (str(oid), iter(basic_messages))
 
     @utils.raises_conn_error
     @utils.retries_on_autoreconnect
@@ -209,8 +272,10 @@ class ClaimController(storage.Claim):
         expires = now + ttl
 
         msg_ctrl = self.driver.message_controller
+        # Only check whether the claim exists; skip the message body.
         claimed = msg_ctrl._claimed(queue, cid, expires=now,
-                                    limit=1, project=project)
+                                    limit=1, project=project,
+                                    fields={'_id': 1, 't': 1, 'c': 1})
 
         try:
             next(claimed)
@@ -226,20 +291,21 @@ class ClaimController(storage.Claim):
         # TODO(kgriffs): Create methods for these so we don't interact
         # with the messages collection directly (loose coupling)
         scope = utils.scope_queue_name(queue, project)
-        collection = msg_ctrl._collection(queue, project)
-        collection.update({'p_q': scope, 'c.id': cid},
-                          {'$set': {'c': meta}},
-                          upsert=False, multi=True)
-
-        # NOTE(flaper87): Dirty hack!
-        # This sets the expiration time to
-        # `expires` on messages that would
-        # expire before claim.
-        collection.update({'p_q': scope,
-                           'e': {'$lt': expires},
-                           'c.id': cid},
-                          {'$set': {'e': expires, 't': ttl}},
-                          upsert=False, multi=True)
+        with self.driver.write_concerns.write('claim') as options:
+            for collection in msg_ctrl._collections_for(queue, project):
+                collection.update({'p_q': scope, 'c.id': cid},
+                                  {'$set': {'c': meta}},
+                                  upsert=False, multi=True, **options)
+
+                # NOTE(flaper87): Dirty hack!
+                # This sets the expiration time to
+                # `expires` on messages that would
+                # expire before claim.
+                collection.update({'p_q': scope,
+                                   'e': {'$lt': expires},
+                                   'c.id': cid},
+                                  {'$set': {'e': expires, 't': ttl}},
+                                  upsert=False, multi=True, **options)
 
     @utils.raises_conn_error
     @utils.retries_on_autoreconnect
@@ -21,24 +21,50 @@ import pymongo
 import pymongo.errors
 
 from marconi.common import decorators
+from marconi.common import errors
 from marconi.openstack.common import log as logging
 from marconi.queues import storage
 from marconi.queues.storage.mongodb import controllers
+from marconi.queues.storage.mongodb import migration
 from marconi.queues.storage.mongodb import options
+from marconi.queues.storage.mongodb import schema
+from marconi.queues.storage.mongodb import sweeper
+from marconi.queues.storage.mongodb import utils
 
 
 LOG = logging.getLogger(__name__)
 
 
-def _connection(conf):
+# Maps pool options to the client keyword arguments they set. Options
+# left at 0 keep the library defaults.
+_POOL_OPTIONS = (
+    ('max_pool_size', 'max_pool_size'),
+    ('wait_queue_timeout', 'waitQueueTimeoutMS'),
+    ('wait_queue_multiple', 'waitQueueMultiple'),
+    ('connect_timeout', 'connectTimeoutMS'),
+    ('socket_timeout', 'socketTimeoutMS'),
+)
+
+
+def _connection(conf, metrics=None):
     if conf.uri and 'replicaSet' in conf.uri:
         MongoClient = pymongo.MongoReplicaSetClient
     else:
         MongoClient = pymongo.MongoClient
 
-    if conf.uri and 'ssl=true' in conf.uri.lower():
-        kwargs = {}
+    kwargs = {}
+
+    for name, kwarg in _POOL_OPTIONS:
+        if conf[name]:
+            kwargs[kwarg] = conf[name]
 
+    if conf.socket_keepalive:
+        kwargs['socketKeepAlive'] = True
+
+    if metrics is not None:
+        kwargs['_pool_class'] = utils.instrumented_pool_class(metrics)
+
+    if conf.uri and 'ssl=true' in conf.uri.lower():
         # Default to CERT_REQUIRED
         ssl_cert_reqs = ssl.CERT_REQUIRED
 
@@ -57,9 +83,7 @@ def _connection(conf):
         if conf.ssl_ca_certs:
             kwargs['ssl_ca_certs'] = conf.ssl_ca_certs
 
-        return MongoClient(conf.uri, **kwargs)
-
-    return MongoClient(conf.uri)
+    return MongoClient(conf.uri, **kwargs)
 
 
 class DataDriver(storage.DataDriverBase):
@@ -81,6 +105,26 @@ class DataDriver(storage.DataDriverBase):
                                 group=options.MONGODB_GROUP)
         self.mongodb_conf = self.conf[options.MONGODB_GROUP]
 
+        # Leased markers are handed out ahead of the counter, so it
+        # could no longer serve as the watermark.
+        if (self.mongodb_conf.visibility_watermark and
+                self.mongodb_conf.marker_lease_size):
+            raise errors.InvalidDriver(
+                'visibility_watermark can not be combined with '
+                'marker_lease_size')
+
+        self.circuit_breaker = utils.CircuitBreaker(
+            self.mongodb_conf.circuit_breaker_threshold,
+            self.mongodb_conf.circuit_breaker_cooldown)
+
+        self.read_preferences = utils.ReadPreferences(
+            self.mongodb_conf.read_preferences,
+            self.mongodb_conf.max_staleness,
+            lambda: self.connection.admin.command('replSetGetStatus'))
+
+        self.write_concerns = utils.WriteConcerns(
+            self.mongodb_conf.write_concerns, self.metrics)
+
     def is_alive(self):
         try:
             # NOTE(zyuan): Requires admin access to mongodb
@@ -89,6 +133,28 @@ class DataDriver(storage.DataDriverBase):
         except pymongo.errors.PyMongoError:
             return False
 
+    def close_connection(self):
+        """Stops any background threads, and disconnects the client.
+
+        The client reconnects as needed if the driver is used again.
+        """
+        super(DataDriver, self).close_connection()
+        self.connection.close()
+
+    @decorators.lazy_property(write=False)
+    def schema_bootstrapped(self):
+        """True if controllers may skip creating their indexes.
+
+        That is the case when `fast_start` is enabled and the layout
+        recorded by bootstrapping is the one expected. See the
+        `schema` module.
+        """
+        if not self.mongodb_conf.fast_start:
+            return False
+
+        return schema.is_current(self.queues_database,
+                                 schema.data_layout(self.mongodb_conf))
+
     @decorators.lazy_property(write=False)
     def queues_database(self):
         """Database dedicated to the "queues" collection.
@@ -105,7 +171,11 @@ class DataDriver(storage.DataDriverBase):
         """List of message databases, ordered by partition number."""
 
         name = self.mongodb_conf.database
-        partitions = self.mongodb_conf.partitions
+
+        # While migrating to a different number of partitions,
+        # the databases from both layouts are needed.
+        partitions = max(self.mongodb_conf.partitions,
+                         self.mongodb_conf.previous_partitions)
 
         # NOTE(kgriffs): Partition names are zero-based, and
         # the list is ordered by partition, which means that a
@@ -120,7 +190,7 @@ class DataDriver(storage.DataDriverBase):
     @decorators.lazy_property(write=False)
     def connection(self):
         """MongoDB client connection instance."""
-        return _connection(self.mongodb_conf)
+        return _connection(self.mongodb_conf, self.metrics)
 
     @decorators.lazy_property(write=False)
     def queue_controller(self):
@@ -128,7 +198,15 @@ class DataDriver(storage.DataDriverBase):
 
     @decorators.lazy_property(write=False)
     def message_controller(self):
-        return controllers.MessageController(self)
+        controller = controllers.MessageController(self)
+
+        if controller._migrating and self.mongodb_conf.partition_mover:
+            self._start_worker(migration.PartitionMover(self, controller))
+
+        if self.mongodb_conf.claim_sweep_interval > 0:
+            self._start_worker(sweeper.ClaimSweeper(self, controller))
+
+        return controller
 
     @decorators.lazy_property(write=False)
     def claim_controller(self):
@@ -145,16 +223,32 @@ class ControlDriver(storage.ControlDriverBase):
 
         self.mongodb_conf = self.conf[options.MONGODB_GROUP]
 
+        self.circuit_breaker = utils.CircuitBreaker(
+            self.mongodb_conf.circuit_breaker_threshold,
+            self.mongodb_conf.circuit_breaker_cooldown)
+
+        self.write_concerns = utils.WriteConcerns(
+            self.mongodb_conf.write_concerns, self.metrics)
+
     @decorators.lazy_property(write=False)
     def connection(self):
         """MongoDB client connection instance."""
-        return _connection(self.mongodb_conf)
+        return _connection(self.mongodb_conf, self.metrics)
 
     @decorators.lazy_property(write=False)
     def database(self):
         name = self.mongodb_conf.database
         return self.connection[name]
 
+    @decorators.lazy_property(write=False)
+    def schema_bootstrapped(self):
+        """True if controllers may skip creating their indexes."""
+        if not self.mongodb_conf.fast_start:
+            return False
+
+        return schema.is_current(self.database,
+                                 schema.control_layout(self.mongodb_conf))
+
     @property
     def pools_controller(self):
         return controllers.PoolsController(self)
@@ -0,0 +1,103 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reports on, and prunes, the indexes of the messages collections."""
+
+import pymongo.errors
+
+from marconi.queues.storage.mongodb import messages
+
+# Created by MongoDB itself, and never reported as unused
+_ID_INDEX_NAME = '_id_'
+
+
+def expected_indexes(mongodb_conf):
+    """Returns the names of the indexes the driver is configured to use."""
+
+    specs = messages.index_specs(mongodb_conf.compact_indexes,
+                                 mongodb_conf.visibility_watermark)
+
+    return set([_ID_INDEX_NAME] + [name for name, _f, _o in specs])
+
+
+def report(driver):
+    """Returns the size and usage of every index, in every partition.
+
+    Usage is read with the $indexStats aggregation stage, which is
+    only available as of MongoDB 3.2; with earlier versions, only
+    sizes are reported.
+
+    :param driver: The MongoDB data driver
+    :returns: A list of dicts, each with the keys `partition`,
+        `name`, `size` (in bytes), `ops` (the number of times the
+        index was used, or None if unknown), `since` (when usage
+        started being tracked, or None) and `expected` (False for
+        indexes the driver is no longer configured to use).
+    """
+    expected = expected_indexes(driver.mongodb_conf)
+    rows = []
+
+    for partition, database in enumerate(driver.message_databases):
+        try:
+            stats = database.command('collstats', 'messages')
+        except pymongo.errors.OperationFailure:
+            # The collection has not been created yet
+            continue
+
+        usage = _usage(database.messages)
+
+        for name, size in sorted(stats.get('indexSizes', {}).items()):
+            accesses = usage.get(name, {})
+            rows.append({
+                'partition': partition,
+                'name': name,
+                'size': size,
+                'ops': accesses.get('ops'),
+                'since': accesses.get('since'),
+                'expected': name in expected,
+            })
+
+    return rows
+
+
+def drop_unused(driver):
+    """Drops indexes the driver is no longer configured to use.
+
+    Typically run after switching to the compact set of indexes,
+    once the new indexes have been built.
+
+    :param driver: The MongoDB data driver
+    :returns: A list of (partition, index name) tuples
+    """
+    dropped = []
+
+    for row in report(driver):
+        if not row['expected']:
+            database = driver.message_databases[row['partition']]
+            database.messages.drop_index(row['name'])
+            dropped.append((row['partition'], row['name']))
+
+    return dropped
+
+
+def _usage(collection):
+    try:
+        result = collection.aggregate([{'$indexStats': {}}])
+    except pymongo.errors.OperationFailure:
+        return {}
+
+    # Older versions of pymongo return the whole command response
+    docs = result['result'] if isinstance(result, dict) else result
+    return dict((doc['name'], doc['accesses']) for doc in docs)
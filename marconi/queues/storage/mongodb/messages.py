@@ -21,18 +21,27 @@ Field Mappings:
     letter of their long name.
 """
 
+import collections
 import datetime
 import itertools
+import operator
+import threading
 import time
 
+from bson import binary
 from bson import objectid
 import pymongo.errors
 import pymongo.read_preferences
+import six
 
 from marconi.i18n import _
+from marconi.openstack.common import excutils
+from marconi.openstack.common import jsonutils
 import marconi.openstack.common.log as logging
+from marconi.openstack.common import strutils
 from marconi.openstack.common import timeutils
 from marconi.queues import storage
+from marconi.queues.storage import codecs
 from marconi.queues.storage import errors
 from marconi.queues.storage.mongodb import utils
 
@@ -50,9 +59,29 @@ MAX_RETRY_POST_DURATION = 45
 # producers to succeed in turn.
 COUNTER_STALL_WINDOW = 5
 
+# Lifetime, in seconds, of the private claim used to tag messages
+# while they are being popped. If a pop fails halfway through, the
+# tagged messages become available again once the claim expires.
+POP_CLAIM_TTL = 30
+
+# Seconds to wait before reopening a tailable cursor on the
+# notifications collection, e.g., after it has wrapped around.
+NOTIFICATION_RETRY_INTERVAL = 0.5
+
+# Number of messages moved at a time when migrating a queue
+# to a different partition.
+MIGRATION_BATCH_SIZE = 100
+
 # For hinting
 ID_INDEX_FIELDS = [('_id', 1)]
 
+# Projections, so that only the fields used by the denormalizers
+# are read from the database and decoded.
+MESSAGE_FIELDS = {'_id': 1, 't': 1, 'b': 1}
+MESSAGE_PAGE_FIELDS = {'_id': 1, 't': 1, 'b': 1, 'k': 1}
+MESSAGE_PAGE_FIELDS_NO_BODY = {'_id': 1, 't': 1, 'k': 1}
+CLAIMED_MESSAGE_FIELDS = {'_id': 1, 't': 1, 'b': 1, 'c': 1}
+
 # For removing expired messages
 TTL_INDEX_FIELDS = [
     ('e', 1),
@@ -108,6 +137,69 @@ TRANSACTION_INDEX_FIELDS = [
     ('tx', 1),
 ]
 
+# Sorts before any ObjectId that is actually generated, but after
+# null. Used to restrict partial indexes to claimed messages and to
+# messages belonging to an unfinalized transaction, so that queries
+# on a given ID can be proven to fall within the index.
+MIN_OID = objectid.ObjectId('0' * 24)
+
+# Compact replacement for CLAIMED_INDEX_FIELDS. Claim IDs are unique
+# across queues, and only a few messages carry any given claim, so
+# there is no need to index the queue, nor the claim's expiration,
+# nor any of the (vast majority of) unclaimed messages.
+CLAIM_ID_INDEX_FIELDS = [
+    ('c.id', 1),
+    ('k', 1),
+]
+
+
+def index_specs(compact=False, use_watermark=False):
+    """Returns the indexes to create on each messages collection.
+
+    :param compact: Whether to use the compact set of indexes,
+        which relies on partial indexes (MongoDB 3.2+). It drops the
+        "counting" index, leaving counts to the "active" index, and
+        replaces the "claimed" and "transaction" indexes with partial
+        ones that only cover messages that are actually claimed, or
+        part of an unfinalized transaction.
+    :param use_watermark: Whether batches are made visible with a
+        watermark, in which case transactions are never used.
+    :returns: A list of (name, fields, options) tuples
+    """
+    specs = [
+        ('ttl', TTL_INDEX_FIELDS, {'expireAfterSeconds': 0}),
+        ('active', ACTIVE_INDEX_FIELDS, {}),
+
+        # NOTE(kgriffs): This index must be unique so that
+        # inserting a message with the same marker to the
+        # same queue will fail; this is used to detect a
+        # race condition which can cause an observer client
+        # to miss a message when there is more than one
+        # producer posting messages to the same queue, in
+        # parallel.
+        ('queue_marker', MARKER_INDEX_FIELDS, {'unique': True}),
+    ]
+
+    if compact:
+        specs.append(('claim_id', CLAIM_ID_INDEX_FIELDS, {
+            'partialFilterExpression': {'c.id': {'$gt': MIN_OID}},
+        }))
+    else:
+        specs.append(('claimed', CLAIMED_INDEX_FIELDS, {}))
+        specs.append(('counting', COUNTING_INDEX_FIELDS, {}))
+
+    # The transaction index is only needed to finalize batches
+    # posted with the two-phase algorithm.
+    if not use_watermark:
+        if compact:
+            specs.append(('transaction_pending', TRANSACTION_INDEX_FIELDS, {
+                'partialFilterExpression': {'tx': {'$gt': MIN_OID}},
+            }))
+        else:
+            specs.append(('transaction', TRANSACTION_INDEX_FIELDS, {}))
+
+    return specs
+
 
 class MessageController(storage.Message):
     """Implements message resource operations using MongoDB.
@@ -132,9 +224,43 @@ class MessageController(storage.Message):
 
         # Cache for convenience and performance
         self._num_partitions = self.driver.mongodb_conf.partitions
+
+        # When the number of partitions is being changed, messages
+        # may still live in their queue's previous partition until
+        # the partition mover gets to them. See _collections_for().
+        self._prev_partitions = self.driver.mongodb_conf.previous_partitions
+        self._migrating = self._prev_partitions not in (
+            0, self._num_partitions)
         self._queue_ctrl = self.driver.queue_controller
         self._retry_range = range(self.driver.mongodb_conf.max_attempts)
 
+        # Average number of conflicts hit by recent posts, per queue,
+        # used to widen the backoff jitter on contended queues.
+        self._contention = utils.ContentionTracker()
+
+        # Blocks of markers reserved by this worker, keyed by
+        # scoped queue name. Each lease is a list of
+        # [next_marker, end_marker, expires]. See _lease_markers().
+        self._marker_lease_size = self.driver.mongodb_conf.marker_lease_size
+        self._marker_lease_ttl = self.driver.mongodb_conf.marker_lease_ttl
+        self._marker_leases = {}
+        self._marker_lease_lock = threading.Lock()
+
+        # When enabled, batches are posted in a single insert and
+        # made visible by advancing the queue's watermark, rather
+        # than by a second update clearing their transaction ID.
+        self._use_watermark = self.driver.mongodb_conf.visibility_watermark
+
+        # The compact index set drops the "counting" index, so counts
+        # use the "active" index, of which its fields are a subset.
+        self._compact_indexes = self.driver.mongodb_conf.compact_indexes
+        if self._compact_indexes:
+            self._claimed_index = CLAIM_ID_INDEX_FIELDS
+            self._counting_index = ACTIVE_INDEX_FIELDS
+        else:
+            self._claimed_index = CLAIMED_INDEX_FIELDS
+            self._counting_index = COUNTING_INDEX_FIELDS
+
         # Create a list of 'messages' collections, one for each database
         # partition, ordered by partition number.
         #
@@ -145,9 +271,26 @@ class MessageController(storage.Message):
         self._collections = [db.messages
                              for db in self.driver.message_databases]
 
-        # Ensure indexes are initialized before any queries are performed
-        for collection in self._collections:
-            self._ensure_indexes(collection)
+        # Ensure indexes are initialized before any queries are
+        # performed, unless that was already done by bootstrapping.
+        if not self.driver.schema_bootstrapped:
+            for collection in self._collections:
+                self._ensure_indexes(collection)
+
+        # Compresses large bodies at rest, if enabled for this pool
+        self._compressor = codecs.compressor_from_conf(
+            self.driver.mongodb_conf, self.driver.metrics)
+
+        # Capped collections, one per partition, used to wake up
+        # readers waiting on a queue when messages are posted to it.
+        self._notifications = None
+        if self.driver.mongodb_conf.notifications:
+            if self.driver.schema_bootstrapped:
+                self._notifications = [db.notifications for db
+                                       in self.driver.message_databases]
+            else:
+                self._notifications = [self._ensure_notifications(db)
+                                       for db in self.driver.message_databases]
 
     # ----------------------------------------------------------------------
     # Helpers
@@ -156,59 +299,335 @@ class MessageController(storage.Message):
     def _ensure_indexes(self, collection):
         """Ensures that all indexes are created."""
 
-        collection.ensure_index(TTL_INDEX_FIELDS,
-                                name='ttl',
-                                expireAfterSeconds=0,
-                                background=True)
+        for name, fields, options in index_specs(self._compact_indexes,
+                                                 self._use_watermark):
+            collection.ensure_index(fields, name=name, background=True,
+                                    **options)
 
-        collection.ensure_index(ACTIVE_INDEX_FIELDS,
-                                name='active',
-                                background=True)
+    def _ensure_notifications(self, database):
+        """Ensures that the notifications collection is created."""
 
-        collection.ensure_index(CLAIMED_INDEX_FIELDS,
-                                name='claimed',
-                                background=True)
+        try:
+            collection = database.create_collection(
+                'notifications', capped=True,
+                size=self.driver.mongodb_conf.notification_log_size)
 
-        collection.ensure_index(COUNTING_INDEX_FIELDS,
-                                name='counting',
-                                background=True)
+        except pymongo.errors.CollectionInvalid:
+            # Already created by another worker
+            return database.notifications
 
-        # NOTE(kgriffs): This index must be unique so that
-        # inserting a message with the same marker to the
-        # same queue will fail; this is used to detect a
-        # race condition which can cause an observer client
-        # to miss a message when there is more than one
-        # producer posting messages to the same queue, in
-        # parallel.
-        collection.ensure_index(MARKER_INDEX_FIELDS,
-                                name='queue_marker',
-                                unique=True,
-                                background=True)
+        # A tailable cursor opened on an empty capped collection
+        # is dead on arrival, so seed it with a notification that no
+        # reader will ever match.
+        collection.insert({PROJ_QUEUE: None, 'n': 0})
+
+        return collection
 
-        collection.ensure_index(TRANSACTION_INDEX_FIELDS,
-                                name='transaction',
-                                background=True)
+    def _prepare_messages(self, queue_name, project, messages,
+                          client_uuid, now, transaction):
+        """Returns the documents to insert for a batch of messages.
+
+        Markers are left for the caller to assign.
+        """
+        now_dt = datetime.datetime.utcfromtimestamp(now)
+        scope = utils.scope_queue_name(queue_name, project)
+
+        prepared_messages = [
+            {
+                PROJ_QUEUE: scope,
+                't': message['ttl'],
+                'e': now_dt + datetime.timedelta(seconds=message['ttl']),
+                'u': client_uuid,
+                'c': {'id': None, 'e': now},
+                'b': message['body'] if 'body' in message else {},
+                'tx': transaction,
+            }
+
+            for message in messages
+        ]
+
+        if self._compressor is not None:
+            for message in prepared_messages:
+                message['b'] = self._compress_body(message['b'])
+
+        return prepared_messages
+
+    def _compress_body(self, body):
+        """Returns the body to store, compressing it if worth it.
+
+        Compressed bodies are stored as BSON binary values, which
+        JSON bodies can never be, so that `_basic_message()` can
+        tell the two apart.
+        """
+        data = strutils.safe_encode(jsonutils.dumps(body), 'utf-8')
+        compressed = self._compressor.compress(data)
+
+        if compressed is data:
+            return body
+
+        return binary.Binary(compressed)
+
+    def _notify(self, queue_name, project, now):
+        """Records that messages were just posted to a queue."""
+
+        if self._notifications is None:
+            return
+
+        partition = utils.get_partition(self._num_partitions,
+                                        queue_name, project)
+
+        # Waiting readers will simply time out if the notification
+        # gets lost, so don't wait for it to be acknowledged.
+        self._notifications[partition].insert(
+            {PROJ_QUEUE: utils.scope_queue_name(queue_name, project),
+             'n': now},
+            w=0)
 
     def _collection(self, queue_name, project=None):
-        """Get a partitioned collection instance."""
+        """Get a partitioned collection instance.
+
+        New messages are always written to this collection.
+        """
         return self._collections[utils.get_partition(self._num_partitions,
                                                      queue_name, project)]
 
-    def _backoff_sleep(self, attempt):
+    def _previous_collection(self, queue_name, project=None):
+        """Get the collection messages were written to before migrating.
+
+        :returns: The collection for the queue under the previous
+            number of partitions, or None if not migrating, or if the
+            queue maps to the same partition either way.
+        """
+        if not self._migrating:
+            return None
+
+        previous = utils.get_partition(self._prev_partitions,
+                                       queue_name, project)
+
+        if previous == utils.get_partition(self._num_partitions,
+                                           queue_name, project):
+            return None
+
+        return self._collections[previous]
+
+    def _collections_for(self, queue_name, project=None):
+        """Get every collection that may hold messages for a queue.
+
+        While migrating to a different number of partitions, this
+        includes the queue's previous collection, which comes first
+        since it holds the authoritative copy of any message that is
+        in the process of being moved.
+        """
+        previous = self._previous_collection(queue_name, project)
+        current = self._collection(queue_name, project)
+
+        return [current] if previous is None else [previous, current]
+
+    def _merge(self, cursors, sort=1, limit=None):
+        """Merges results from several collections, ordered by marker.
+
+        Messages found in more than one collection, i.e., those being
+        moved to a new partition, are only returned once.
+
+        :returns: A list of message documents
+        """
+        seen = set()
+        merged = []
+
+        for doc in itertools.chain.from_iterable(cursors):
+            if doc['_id'] not in seen:
+                seen.add(doc['_id'])
+                merged.append(doc)
+
+        if sort is not None and merged and 'k' in merged[0]:
+            merged.sort(key=operator.itemgetter('k'), reverse=(sort == -1))
+
+        return merged if limit is None else merged[:limit]
+
+    def _migrate_queue(self, queue_name, project=None,
+                       batch_size=MIGRATION_BATCH_SIZE):
+        """Moves a batch of messages to the queue's new partition.
+
+        Each message is copied over as a whole, replacing any copy
+        left over from an earlier attempt, and is then removed from the
+        previous partition, but only if it has not changed in the
+        meantime, e.g., due to being claimed. Otherwise, it is simply
+        moved again as part of the next batch. If a message was
+        deleted after having been copied, the copy is removed as well.
+
+        Messages whose batch has not been finalized yet are left alone,
+        since the worker posting them will finalize them where they
+        were inserted. They are moved once finalized, or expire where
+        they are if their worker crashed.
+
+        :returns: The number of messages moved, or 0 once the
+            previous partition holds no more messages for the queue
+        """
+        previous = self._previous_collection(queue_name, project)
+        if previous is None:
+            return 0
+
+        current = self._collection(queue_name, project)
+        scope = utils.scope_queue_name(queue_name, project)
+
+        moved = 0
+        query = {PROJ_QUEUE: scope, 'tx': None}
+        for doc in previous.find(query).limit(batch_size):
+            current.update({'_id': doc['_id']}, doc, upsert=True)
+
+            removed = previous.remove({'_id': doc['_id'],
+                                       'c.id': doc['c'].get('id'),
+                                       'c.e': doc['c'].get('e'),
+                                       'e': doc['e']})['n']
+
+            if removed:
+                moved += 1
+            elif previous.find_one({'_id': doc['_id']},
+                                   fields={'_id': 1}) is None:
+                # Deleted while we were copying it
+                current.remove({'_id': doc['_id']})
+
+        return moved
+
+    def _backoff_sleep(self, attempt, scope=None):
         """Sleep between retries using a jitter algorithm.
 
         Mitigates thrashing between multiple parallel requests, and
         creates backpressure on clients to slow down the rate
         at which they submit requests.
 
+        The jitter is scaled by the rate of conflicts recently observed
+        on the queue, up to `max_retry_sleep`, so that the more
+        producers are competing for a queue, the more their retries
+        are spread out. The sleep yields to other green threads, if any.
+
         :param attempt: current attempt number, zero-based
+        :param scope: scoped name of the queue being retried, if any
         """
         conf = self.driver.mongodb_conf
+
+        jitter = conf.max_retry_jitter
+        if scope is not None:
+            jitter *= 1 + self._contention.rate(scope)
+            jitter = min(jitter, conf.max_retry_sleep)
+
         seconds = utils.calculate_backoff(attempt, conf.max_attempts,
-                                          conf.max_retry_sleep,
-                                          conf.max_retry_jitter)
+                                          conf.max_retry_sleep, jitter)
+
+        self.driver.metrics.incr('retries.post_conflict')
+        self.driver.metrics.incr('retries.post_conflict.seconds', seconds)
+
+        utils.cooperative_sleep(seconds)
+
+    def _lease_markers(self, queue_name, project, count):
+        """Reserves a contiguous range of markers for a batch of messages.
+
+        Markers are handed out from a block leased by this worker. When
+        the current block can't satisfy the request, or has outlived
+        `marker_lease_ttl`, a new block is reserved by incrementing the
+        queue's counter by `marker_lease_size` (or `count`, if larger)
+        in a single atomic operation. Any markers left over in the
+        previous block are simply skipped; gaps are harmless since
+        markers only need to be unique and increasing.
 
-        time.sleep(seconds)
+        :param queue_name: Name of the queue to which the markers belong
+        :param project: Queue's project
+        :param count: Number of contiguous markers required
+
+        :returns: The first marker in the reserved range
+        :raises: storage.errors.QueueDoesNotExist
+        """
+        scope = utils.scope_queue_name(queue_name, project)
+        now = timeutils.utcnow_ts()
+
+        with self._marker_lease_lock:
+            lease = self._marker_leases.get(scope)
+            if (lease is not None and lease[2] > now and
+                    lease[1] - lease[0] >= count):
+                first = lease[0]
+                lease[0] += count
+                return first
+
+        # Reserve the block outside of the lock so that posts to other
+        # queues are not held up by the round trip. If two requests race
+        # to renew the same lease, both get a distinct block and the
+        # loser's remainder is skipped.
+        amount = max(count, self._marker_lease_size)
+        end = self._queue_ctrl._inc_counter(queue_name, project,
+                                            amount=amount)
+        first = end - amount
+
+        with self._marker_lease_lock:
+            self._marker_leases[scope] = [first + count, end,
+                                          now + self._marker_lease_ttl]
+
+        return first
+
+    def _release_markers(self, queue_name, project=None):
+        """Discards any block of markers leased for the given queue."""
+        scope = utils.scope_queue_name(queue_name, project)
+
+        with self._marker_lease_lock:
+            self._marker_leases.pop(scope, None)
+
+    def _remove_stalled_batch(self, queue_name, project, collection):
+        """Removes the messages left behind by a crashed post.
+
+        When the watermark is used, messages are inserted without a
+        transaction ID, at markers the counter is only moved past once
+        the whole batch has been inserted. A worker that crashed in
+        between leaves messages that conflict with every later post.
+        If the counter has not been updated for COUNTER_STALL_WINDOW
+        seconds, any such messages inserted before that window are
+        removed, so that the next attempt can reuse their markers.
+
+        :returns: The counter, if it had stalled, or None otherwise
+        """
+        counter = self._queue_ctrl._inc_counter(queue_name, project,
+                                                amount=0,
+                                                window=COUNTER_STALL_WINDOW)
+        if counter is None:
+            return None
+
+        cutoff = timeutils.utcnow() - datetime.timedelta(
+            seconds=COUNTER_STALL_WINDOW)
+
+        query = {
+            PROJ_QUEUE: utils.scope_queue_name(queue_name, project),
+            'k': {'$gte': counter},
+            '_id': {'$lt': objectid.ObjectId.from_datetime(cutoff)},
+        }
+
+        with self.driver.write_concerns.write(
+                'post', needs_result=True) as options:
+            result = collection.remove(query, **options)
+
+        if result and result.get('n'):
+            msgtmpl = (u'Detected a stalled message counter for queue '
+                       u'"%(queue)s" under project %(project)s. Removed '
+                       u'%(count)d message(s) left by a crashed post.')
+
+            LOG.warning(msgtmpl, dict(queue=queue_name, project=project,
+                                      count=result['n']))
+
+        return counter
+
+    def _remove_transaction(self, collection, transaction):
+        """Removes the messages of a batch that was not finalized."""
+        with self.driver.write_concerns.write(
+                'post', needs_result=True) as options:
+            collection.remove({'tx': transaction}, **options)
+
+    def _watermark(self, queue_name, project=None):
+        """Returns the queue's visibility watermark for use in a query.
+
+        If the queue does not exist, returns a watermark that is below
+        any valid marker, so that queries simply come up empty.
+        """
+        try:
+            return self._queue_ctrl._get_watermark(queue_name, project)
+        except errors.QueueDoesNotExist:
+            return 0
 
     def _purge_queue(self, queue_name, project=None):
         """Removes all messages from the queue.
@@ -222,13 +641,18 @@ class MessageController(storage.Message):
         :param queue_name: name of the queue to purge
         :param project: ID of the project to which the queue belongs
         """
+        self._release_markers(queue_name, project)
+
         scope = utils.scope_queue_name(queue_name, project)
-        collection = self._collection(queue_name, project)
-        collection.remove({PROJ_QUEUE: scope}, w=0)
+        with self.driver.write_concerns.write(
+                'delete', default='unacknowledged') as options:
+            for collection in self._collections_for(queue_name, project):
+                collection.remove({PROJ_QUEUE: scope}, **options)
 
     def _list(self, queue_name, project=None, marker=None,
               echo=False, client_uuid=None, fields=None,
-              include_claimed=False, sort=1, limit=None):
+              include_claimed=False, sort=1, limit=None,
+              read_preference=None):
         """Message document listing helper.
 
         :param queue_name: Name of the queue to list
@@ -252,6 +676,8 @@ class MessageController(storage.Message):
             to list. The results may include fewer messages than the
             requested `limit` if not enough are available. If limit is
             not specified
+        :param read_preference: (Default None) Read preference for
+            the query, if other than the connection's default
 
         :returns: Generator yielding up to `limit` messages.
         """
@@ -280,28 +706,50 @@ class MessageController(storage.Message):
         if marker is not None:
             query['k'] = {'$gt': marker}
 
-        collection = self._collection(queue_name, project)
+        if self._use_watermark:
+            watermark = self._watermark(queue_name, project)
+            query.setdefault('k', {})['$lt'] = watermark
+
+        collections = self._collections_for(queue_name, project)
 
         if not include_claimed:
             # Only include messages that are not part of
             # any claim, or are part of an expired claim.
             query['c.e'] = {'$lte': now}
 
-        # Construct the request
-        cursor = collection.find(query, fields=fields, sort=[('k', sort)])
+        # The marker is needed to merge results from both partitions
+        # of a queue that is being migrated.
+        if len(collections) > 1 and fields is not None and 'k' not in fields:
+            fields = dict(fields, k=1)
+
+        options = {}
+        if read_preference is not None:
+            options['read_preference'] = read_preference
+
+        cursors = []
+        for collection in collections:
+            # Construct the request
+            cursor = collection.find(query, fields=fields,
+                                     sort=[('k', sort)], **options)
+
+            if limit is not None:
+                cursor.limit(limit)
+
+            # NOTE(flaper87): Suggest the index to use for this query to
+            # ensure the most performant one is chosen.
+            cursors.append(cursor.hint(ACTIVE_INDEX_FIELDS))
 
-        if limit is not None:
-            cursor.limit(limit)
+        if len(cursors) == 1:
+            return cursors[0]
 
-        # NOTE(flaper87): Suggest the index to use for this query to
-        # ensure the most performant one is chosen.
-        return cursor.hint(ACTIVE_INDEX_FIELDS)
+        return iter(self._merge(cursors, sort, limit))
 
     # ----------------------------------------------------------------------
     # "Friends" interface
     # ----------------------------------------------------------------------
 
-    def _count(self, queue_name, project=None, include_claimed=False):
+    def _count(self, queue_name, project=None, include_claimed=False,
+               read_preference=None):
         """Return total number of messages in a queue.
 
         This method is designed to very quickly count the number
@@ -328,8 +776,32 @@ class MessageController(storage.Message):
             # Exclude messages that are claimed
             query['c.e'] = {'$lte': timeutils.utcnow_ts()}
 
-        collection = self._collection(queue_name, project)
-        return collection.find(query).hint(COUNTING_INDEX_FIELDS).count()
+        options = {}
+        if read_preference is not None:
+            options['read_preference'] = read_preference
+
+        # Messages that are in the middle of being moved to a
+        # new partition may be counted twice.
+        return sum(collection.find(query, **options)
+                   .hint(self._counting_index).count()
+                   for collection in self._collections_for(queue_name,
+                                                           project))
+
+    def _first(self, queue_name, project=None, sort=1,
+               read_preference=None):
+        """Like `first()`, with an optional read preference."""
+
+        cursor = self._list(queue_name, project=project,
+                            include_claimed=True, sort=sort,
+                            fields=MESSAGE_FIELDS, limit=1,
+                            read_preference=read_preference)
+        try:
+            message = next(cursor)
+        except StopIteration:
+            raise errors.QueueIsEmpty(queue_name, project)
+
+        now = timeutils.utcnow_ts()
+        return _basic_message(message, now, self.driver.metrics)
 
     def _active(self, queue_name, marker=None, echo=False,
                 client_uuid=None, fields=None, project=None,
@@ -341,10 +813,13 @@ class MessageController(storage.Message):
                           limit=limit)
 
     def _claimed(self, queue_name, claim_id,
-                 expires=None, limit=None, project=None):
+                 expires=None, limit=None, project=None,
+                 fields=CLAIMED_MESSAGE_FIELDS):
 
         if claim_id is None:
-            claim_id = {'$ne': None}
+            # Equivalent to {'$ne': None}, but able to use the
+            # partial claim_id index.
+            claim_id = {'$gt': MIN_OID}
 
         query = {
             PROJ_QUEUE: utils.scope_queue_name(queue_name, project),
@@ -356,23 +831,38 @@ class MessageController(storage.Message):
         # the primary to avoid a race condition caused by the
         # multi-phased "create claim" algorithm.
         preference = pymongo.read_preferences.ReadPreference.PRIMARY
-        collection = self._collection(queue_name, project)
-        msgs = collection.find(query, sort=[('k', 1)],
-                               read_preference=preference).hint(
-                                   CLAIMED_INDEX_FIELDS)
+        collections = self._collections_for(queue_name, project)
+
+        if len(collections) > 1 and 'k' not in fields:
+            fields = dict(fields, k=1)
 
-        if limit is not None:
-            msgs = msgs.limit(limit)
+        cursors = []
+        for collection in collections:
+            msgs = collection.find(query, fields=fields,
+                                   sort=[('k', 1)],
+                                   read_preference=preference).hint(
+                                       self._claimed_index)
+
+            if limit is not None:
+                msgs = msgs.limit(limit)
+
+            cursors.append(msgs)
+
+        if len(cursors) == 1:
+            msgs = cursors[0]
+        else:
+            msgs = iter(self._merge(cursors, limit=limit))
 
         now = timeutils.utcnow_ts()
 
-        def denormalizer(msg):
-            doc = _basic_message(msg, now)
-            doc['claim'] = msg['c']
+        def denormalizer(msgs):
+            docs = _basic_messages(msgs, now, self.driver.metrics)
+            for doc, msg in zip(docs, msgs):
+                doc['claim'] = msg['c']
 
-            return doc
+            return docs
 
-        return utils.HookedCursor(msgs, denormalizer)
+        return utils.BatchedCursor(msgs, denormalizer)
 
     def _unclaim(self, queue_name, claim_id, project=None):
         cid = utils.to_oid(claim_id)
@@ -386,11 +876,65 @@ class MessageController(storage.Message):
         # and the claim expiration time to now
         now = timeutils.utcnow_ts()
         scope = utils.scope_queue_name(queue_name, project)
-        collection = self._collection(queue_name, project)
 
-        collection.update({PROJ_QUEUE: scope, 'c.id': cid},
-                          {'$set': {'c': {'id': None, 'e': now}}},
-                          upsert=False, multi=True)
+        released = 0
+        with self.driver.write_concerns.write(
+                'claim', needs_result=True) as options:
+            for collection in self._collections_for(queue_name, project):
+                released += collection.update(
+                    {PROJ_QUEUE: scope, 'c.id': cid},
+                    {'$set': {'c': {'id': None, 'e': now}}},
+                    upsert=False, multi=True, **options)['n']
+
+        self._queue_ctrl._inc_stats(queue_name, project, claimed=-released)
+
+    @utils.raises_conn_error
+    @utils.retries_on_autoreconnect
+    def _sweep_expired_claims(self, partition, batch_size):
+        """Clears the IDs of expired claims from a batch of messages.
+
+        Messages keep the ID of their last claim after it expires,
+        which bloats the claim index, and the lookups that go
+        through it. Messages are only cleared if their claim is
+        still expired at the time of the update, so a message that
+        is claimed again in the meantime is left untouched.
+
+        The expired claims are also taken off the claimed counts kept
+        for queue stats. If some of the messages were claimed again
+        in the meantime, that is left to the next reconciliation,
+        since it is not known which ones.
+
+        :param partition: Number of the partition to sweep
+        :param batch_size: Max number of messages to clear
+        :returns: The number of messages cleared
+        """
+        collection = self._collections[partition]
+        now = timeutils.utcnow_ts()
+
+        query = {
+            'c.id': {'$gt': MIN_OID},
+            'c.e': {'$lte': now},
+        }
+
+        fields = {'_id': 1, PROJ_QUEUE: 1, 'c.e': 1}
+        docs = list(collection.find(query, fields=fields).limit(batch_size))
+
+        if not docs:
+            return 0
+
+        query['_id'] = {'$in': [doc['_id'] for doc in docs]}
+        swept = collection.update(query,
+                                  {'$set': {'c': {'id': None, 'e': now}}},
+                                  upsert=False, multi=True)['n']
+
+        if swept == len(docs):
+            expirations = collections.defaultdict(list)
+            for doc in docs:
+                expirations[doc[PROJ_QUEUE]].append(doc['c']['e'])
+
+            self._queue_ctrl._expire_claims(expirations)
+
+        return swept
 
     # ----------------------------------------------------------------------
     # Public interface
@@ -398,7 +942,8 @@ class MessageController(storage.Message):
 
     def list(self, queue_name, project=None, marker=None,
              limit=storage.DEFAULT_MESSAGES_PER_PAGE,
-             echo=False, client_uuid=None, include_claimed=False):
+             echo=False, client_uuid=None, include_claimed=False,
+             include_body=True):
 
         if marker is not None:
             try:
@@ -406,37 +951,42 @@ class MessageController(storage.Message):
             except ValueError:
                 yield iter([])
 
+        if include_body:
+            fields = MESSAGE_PAGE_FIELDS
+        else:
+            fields = MESSAGE_PAGE_FIELDS_NO_BODY
+
+        # Observers don't need to read their own writes, but the
+        # watermark is read from the primary, so listing from a
+        # lagging secondary could page past messages below it.
+        preference = None
+        if not self._use_watermark:
+            preference = self.driver.read_preferences.get('list')
+
         messages = self._list(queue_name, project=project, marker=marker,
                               client_uuid=client_uuid, echo=echo,
-                              include_claimed=include_claimed, limit=limit)
+                              fields=fields, include_claimed=include_claimed,
+                              limit=limit, read_preference=preference)
 
         marker_id = {}
 
         now = timeutils.utcnow_ts()
 
         # NOTE (kgriffs) @utils.raises_conn_error not needed on this
-        # function, since utils.HookedCursor already has it.
-        def denormalizer(msg):
-            marker_id['next'] = msg['k']
+        # function, since utils.BatchedCursor already has it.
+        def denormalizer(msgs):
+            marker_id['next'] = msgs[-1]['k']
 
-            return _basic_message(msg, now)
+            return _basic_messages(msgs, now, self.driver.metrics)
 
-        yield utils.HookedCursor(messages, denormalizer)
+        # The whole page is fetched in a single round trip
+        yield utils.BatchedCursor(messages, denormalizer, batch_size=limit)
         yield str(marker_id['next'])
 
     @utils.raises_conn_error
     @utils.retries_on_autoreconnect
     def first(self, queue_name, project=None, sort=1):
-        cursor = self._list(queue_name, project=project,
-                            include_claimed=True, sort=sort,
-                            limit=1)
-        try:
-            message = next(cursor)
-        except StopIteration:
-            raise errors.QueueIsEmpty(queue_name, project)
-
-        now = timeutils.utcnow_ts()
-        return _basic_message(message, now)
+        return self._first(queue_name, project=project, sort=sort)
 
     @utils.raises_conn_error
     @utils.retries_on_autoreconnect
@@ -453,14 +1003,18 @@ class MessageController(storage.Message):
             PROJ_QUEUE: utils.scope_queue_name(queue_name, project),
         }
 
-        collection = self._collection(queue_name, project)
-        message = list(collection.find(query).limit(1).hint(ID_INDEX_FIELDS))
+        options = self.driver.read_preferences.options('get')
 
-        if not message:
-            raise errors.MessageDoesNotExist(message_id, queue_name,
-                                             project)
+        for collection in self._collections_for(queue_name, project):
+            message = list(collection.find(query, fields=MESSAGE_FIELDS,
+                                           **options)
+                           .limit(1).hint(ID_INDEX_FIELDS))
+
+            if message:
+                return _basic_message(message[0], now,
+                                      self.driver.metrics)
 
-        return _basic_message(message[0], now)
+        raise errors.MessageDoesNotExist(message_id, queue_name, project)
 
     @utils.raises_conn_error
     @utils.retries_on_autoreconnect
@@ -477,16 +1031,24 @@ class MessageController(storage.Message):
             PROJ_QUEUE: utils.scope_queue_name(queue_name, project),
         }
 
-        collection = self._collection(queue_name, project)
+        options = self.driver.read_preferences.options('bulk_get')
 
         # NOTE(flaper87): Should this query
         # be sorted?
-        messages = collection.find(query).hint(ID_INDEX_FIELDS)
+        cursors = [collection.find(query, fields=MESSAGE_FIELDS,
+                                   **options).hint(ID_INDEX_FIELDS)
+                   for collection in self._collections_for(queue_name,
+                                                           project)]
+
+        if len(cursors) == 1:
+            messages = cursors[0]
+        else:
+            messages = iter(self._merge(cursors, sort=None))
 
-        def denormalizer(msg):
-            return _basic_message(msg, now)
+        def denormalizer(msgs):
+            return _basic_messages(msgs, now, self.driver.metrics)
 
-        return utils.HookedCursor(messages, denormalizer)
+        return utils.BatchedCursor(messages, denormalizer)
 
     @utils.raises_conn_error
     @utils.retries_on_autoreconnect
@@ -500,35 +1062,42 @@ class MessageController(storage.Message):
             raise errors.QueueDoesNotExist(queue_name, project)
 
         now = timeutils.utcnow_ts()
-        now_dt = datetime.datetime.utcfromtimestamp(now)
+        scope = utils.scope_queue_name(queue_name, project)
         collection = self._collection(queue_name, project)
 
-        # Set the next basis marker for the first attempt.
-        next_marker = self._queue_ctrl._get_counter(queue_name, project)
-
         # Unique transaction ID to facilitate atomic batch inserts
         transaction = objectid.ObjectId()
 
-        prepared_messages = [
-            {
-                PROJ_QUEUE: utils.scope_queue_name(queue_name, project),
-                't': message['ttl'],
-                'e': now_dt + datetime.timedelta(seconds=message['ttl']),
-                'u': client_uuid,
-                'c': {'id': None, 'e': now},
-                'b': message['body'] if 'body' in message else {},
-                'k': next_marker + index,
-                'tx': transaction,
-            }
+        prepared_messages = self._prepare_messages(queue_name, project,
+                                                   messages, client_uuid,
+                                                   now, transaction)
 
-            for index, message in enumerate(messages)
-        ]
+        # Set the next basis marker for the first attempt.
+        #
+        # When leasing is enabled, the markers are reserved up front,
+        # so the counter does not need to be incremented after the
+        # insert, and parallel producers can not collide on the
+        # unique index.
+        leased = self._marker_lease_size > 0
+        if leased:
+            next_marker = self._lease_markers(queue_name, project,
+                                              len(prepared_messages))
+        else:
+            next_marker = self._queue_ctrl._get_counter(queue_name, project)
+
+        for index, message in enumerate(prepared_messages):
+            message['k'] = next_marker + index
 
         # NOTE(kgriffs): Don't take the time to do a 2-phase insert
         # if there is no way for it to partially succeed.
-        if len(prepared_messages) == 1:
+        #
+        # Likewise, when the watermark is used, a partially-inserted
+        # batch is never visible to begin with, since the watermark is
+        # only advanced past the batch once the insert succeeds.
+        if len(prepared_messages) == 1 or self._use_watermark:
             transaction = None
-            prepared_messages[0]['tx'] = None
+            for message in prepared_messages:
+                message['tx'] = None
 
         # Use a retry range for sanity, although we expect
         # to rarely, if ever, reach the maximum number of
@@ -537,9 +1106,15 @@ class MessageController(storage.Message):
         # NOTE(kgriffs): With the default configuration (100 ms
         # max sleep, 1000 max attempts), the max stall time
         # before the operation is abandoned is 49.95 seconds.
+        write_concerns = self.driver.write_concerns
+
         for attempt in self._retry_range:
             try:
-                ids = collection.insert(prepared_messages)
+                # Conflicts must be reported for the markers to stay
+                # unique, so the insert is always acknowledged.
+                with write_concerns.write('post',
+                                          needs_result=True) as options:
+                    ids = collection.insert(prepared_messages, **options)
 
                 # Log a message if we retried, for debugging perf issues
                 if attempt != 0:
@@ -561,25 +1136,35 @@ class MessageController(storage.Message):
                 # such that the competing marker's will start at a
                 # unique number, 1 past the max of the messages just
                 # inserted above.
-                self._queue_ctrl._inc_counter(queue_name, project,
-                                              amount=len(ids))
+                if not leased:
+                    self._queue_ctrl._inc_counter(queue_name, project,
+                                                  amount=len(ids))
+
+                # When the watermark is used, the counter doubles as the
+                # watermark, so the increment above has also made the
+                # batch visible to listings.
 
                 # NOTE(kgriffs): Finalize the insert once we can say that
                 # all the messages made it. This makes bulk inserts
                 # atomic, assuming queries filter out any non-finalized
                 # messages.
                 if transaction is not None:
-                    collection.update({'tx': transaction},
-                                      {'$set': {'tx': None}},
-                                      upsert=False, multi=True)
+                    with write_concerns.write('post') as options:
+                        collection.update({'tx': transaction},
+                                          {'$set': {'tx': None}},
+                                          upsert=False, multi=True,
+                                          **options)
+
+                self._queue_ctrl._inc_stats(queue_name, project,
+                                            total=len(ids), ids=ids)
+
+                self._notify(queue_name, project, now)
+
+                self._contention.record(scope, attempt)
 
                 return [str(id_) for id_ in ids]
 
             except pymongo.errors.DuplicateKeyError as ex:
-                # TODO(kgriffs): Record stats of how often retries happen,
-                # and how many attempts, on average, are required to insert
-                # messages.
-
                 # NOTE(kgriffs): This can be used in conjunction with the
                 # log line, above, that is emitted after all messages have
                 # been posted, to gauge how long it is taking for messages
@@ -593,6 +1178,29 @@ class MessageController(storage.Message):
 
                     LOG.debug(msgtmpl, dict(queue=queue_name, project=project))
 
+                # A leased block can only collide if the counter was
+                # reset underneath us, e.g., because the queue was
+                # deleted and recreated by another worker. Drop the
+                # lease and fall back to the regular get/insert/increment
+                # algorithm for this batch.
+                if leased:
+                    leased = False
+                    self._release_markers(queue_name, project)
+
+                # Without a transaction ID to filter them out, any
+                # messages that made it in before the conflict must be
+                # removed before retrying the batch under new markers.
+                # They are not below the watermark, so are not visible
+                # in the meantime.
+                if self._use_watermark and len(prepared_messages) > 1:
+                    inserted = [message['_id']
+                                for message in prepared_messages
+                                if '_id' in message]
+                    with write_concerns.write(
+                            'post', needs_result=True) as options:
+                        collection.remove({'_id': {'$in': inserted}},
+                                          **options)
+
                 # NOTE(kgriffs): Never retry past the point that competing
                 # messages expire and are GC'd, since once they are gone,
                 # the unique index no longer protects us from getting out
@@ -609,7 +1217,7 @@ class MessageController(storage.Message):
                     break
 
                 # Chill out for a moment to mitigate thrashing/thundering
-                self._backoff_sleep(attempt)
+                self._backoff_sleep(attempt, scope)
 
                 # NOTE(kgriffs): Perhaps we failed because a worker crashed
                 # after inserting messages, but before incrementing the
@@ -629,8 +1237,18 @@ class MessageController(storage.Message):
                 # Note that we increment one at a time until the logjam is
                 # broken, since we don't know how many messages were posted
                 # by the worker before it crashed.
-                next_marker = self._queue_ctrl._inc_counter(
-                    queue_name, project, window=COUNTER_STALL_WINDOW)
+                #
+                # When the watermark is used, moving the counter past the
+                # crashed worker's messages would make them visible, even
+                # though the batch may only have been partially inserted.
+                # They are removed instead, and the counter stays put.
+                if self._use_watermark:
+                    next_marker = self._remove_stalled_batch(queue_name,
+                                                             project,
+                                                             collection)
+                else:
+                    next_marker = self._queue_ctrl._inc_counter(
+                        queue_name, project, window=COUNTER_STALL_WINDOW)
 
                 # Retry the entire batch with a new sequence of markers.
                 #
@@ -644,7 +1262,7 @@ class MessageController(storage.Message):
                     # it should be rare that a counter becomes stalled.
                     next_marker = self._queue_ctrl._get_counter(
                         queue_name, project)
-                else:
+                elif not self._use_watermark:
                     msgtmpl = (u'Detected a stalled message counter for '
                                u'queue "%(queue)s" under project %(project)s. '
                                u'The counter was incremented to %(value)d.')
@@ -661,6 +1279,8 @@ class MessageController(storage.Message):
                 LOG.exception(ex)
                 raise
 
+        self._contention.record(scope, self.driver.mongodb_conf.max_attempts)
+
         msgtmpl = _(u'Hit maximum number of attempts (%(max)s) for queue '
                     u'"%(queue)s" under project %(project)s')
 
@@ -673,6 +1293,132 @@ class MessageController(storage.Message):
         raise errors.MessageConflict(queue_name, project,
                                      succeeded_ids)
 
+    # Not retried on autoreconnect, since that could post the
+    # messages bound for some partitions twice. The per-queue posts
+    # it falls back to are retried as usual.
+    @utils.raises_conn_error
+    def post_many(self, batches, client_uuid, project=None):
+        """Posts messages to several queues at once.
+
+        Batches bound for queues in the same partition are inserted
+        together, under a single transaction ID, so posting to any
+        number of queues takes one insert and one update per
+        partition. No batch is finalized until every partition has
+        been inserted, and all of them are backed out if any insert
+        fails.
+
+        This relies on markers being leased, so that they can be
+        assigned without a round trip to each queue, and so it is
+        never used together with the watermark. Otherwise, and while
+        queues are being moved to new partitions, this falls back to
+        posting to each queue in turn.
+        """
+        if not self._marker_lease_size or self._migrating:
+            return super(MessageController, self).post_many(
+                batches, client_uuid, project=project)
+
+        # The messages may have to be prepared more than once
+        batches = dict((queue_name, list(messages))
+                       for queue_name, messages in six.iteritems(batches))
+
+        for queue_name in batches:
+            if not self._queue_ctrl.exists(queue_name, project):
+                raise errors.QueueDoesNotExist(queue_name, project)
+
+        now = timeutils.utcnow_ts()
+        write_concerns = self.driver.write_concerns
+
+        results = {}
+        partitions = collections.defaultdict(list)
+        for queue_name, messages in six.iteritems(batches):
+            if not messages:
+                results[queue_name] = []
+                continue
+
+            partition = utils.get_partition(self._num_partitions,
+                                            queue_name, project)
+            partitions[partition].append(queue_name)
+
+        transaction = objectid.ObjectId()
+        prepared = {}
+        pending = []
+        conflicted = []
+
+        try:
+            for partition, queue_names in six.iteritems(partitions):
+                for queue_name in queue_names:
+                    prepared_messages = self._prepare_messages(
+                        queue_name, project, batches[queue_name],
+                        client_uuid, now, transaction)
+
+                    next_marker = self._lease_markers(
+                        queue_name, project, len(prepared_messages))
+                    for index, message in enumerate(prepared_messages):
+                        message['k'] = next_marker + index
+
+                    prepared[queue_name] = prepared_messages
+
+                collection = self._collections[partition]
+                pending.append(collection)
+
+                try:
+                    with write_concerns.write(
+                            'post', needs_result=True) as options:
+                        collection.insert(
+                            [message for queue_name in queue_names
+                             for message in prepared[queue_name]],
+                            **options)
+
+                except pymongo.errors.DuplicateKeyError:
+                    # As in post(), a leased block can only collide if
+                    # the counter was reset underneath us. Back this
+                    # partition out, and leave it to post() to sort its
+                    # queues out once the rest have been finalized.
+                    self._remove_transaction(collection, transaction)
+                    pending.pop()
+
+                    for queue_name in queue_names:
+                        self._release_markers(queue_name, project)
+                        conflicted.append(queue_name)
+
+            for collection in pending:
+                with write_concerns.write('post') as options:
+                    collection.update({'tx': transaction},
+                                      {'$set': {'tx': None}},
+                                      upsert=False, multi=True, **options)
+
+        except Exception:
+            # Back out every partition that was not finalized, so that
+            # messages are not left pending forever. Unless the failure
+            # hit while finalizing, that leaves no trace of the call.
+            with excutils.save_and_reraise_exception():
+                for collection in pending:
+                    try:
+                        self._remove_transaction(collection, transaction)
+                    except pymongo.errors.PyMongoError as ex:
+                        LOG.exception(ex)
+
+        for queue_name in prepared:
+            if queue_name in conflicted:
+                continue
+
+            ids = [message['_id'] for message in prepared[queue_name]]
+
+            self._queue_ctrl._inc_stats(queue_name, project,
+                                        total=len(ids), ids=ids)
+            self._notify(queue_name, project, now)
+
+            results[queue_name] = [str(id_) for id_ in ids]
+
+        for queue_name in conflicted:
+            results[queue_name] = self.post(queue_name, batches[queue_name],
+                                            client_uuid, project=project)
+
+        self.driver.metrics.incr('messages.post_many.partitions',
+                                 len(partitions))
+
+        return results
+
     @utils.raises_conn_error
     @utils.retries_on_autoreconnect
     def delete(self, queue_name, message_id, project=None, claim=None):
@@ -682,7 +1428,7 @@ class MessageController(storage.Message):
         if mid is None:
             return
 
-        collection = self._collection(queue_name, project)
+        collections = self._collections_for(queue_name, project)
 
         query = {
             '_id': mid,
@@ -696,33 +1442,50 @@ class MessageController(storage.Message):
         if cid is None:
             return
 
+        # The claim check is folded into the remove itself, so
+        # that deleting a message, by far the most frequent call made
+        # by consumers, normally takes a single round trip. Unclaimed
+        # messages have 'c.e' set to the time they were posted or
+        # released, so an expired 'c.e' means the message is free.
         now = timeutils.utcnow_ts()
-        cursor = collection.find(query).hint(ID_INDEX_FIELDS)
-
-        try:
-            message = next(cursor)
-        except StopIteration:
-            return
-
-        is_claimed = (message['c']['id'] is not None and
-                      message['c']['e'] > now)
 
         if claim is None:
-            if is_claimed:
-                raise errors.MessageIsClaimed(message_id)
+            query['c.e'] = {'$lte': now}
+        else:
+            query['c.id'] = cid
+            query['c.e'] = {'$gt': now}
+
+        removed = 0
+        with self.driver.write_concerns.write(
+                'delete', needs_result=True) as options:
+            for collection in collections:
+                removed += collection.remove(query, **options)['n']
+
+        if removed:
+            self._queue_ctrl._inc_stats(queue_name, project, total=-1,
+                                        claimed=0 if claim is None else -1)
+            return
 
+        # Nothing matched, so either the message is already
+        # gone, in which case the delete is a no-op, or the claim
+        # check failed and we need to tell the caller why. Read from
+        # the primary in case the message was just barely claimed,
+        # and the claim hasn't made it to the secondary.
+        pref = pymongo.read_preferences.ReadPreference.PRIMARY
+        for collection in collections:
+            message = collection.find_one({'_id': mid,
+                                           PROJ_QUEUE: query[PROJ_QUEUE]},
+                                          fields={'_id': 1},
+                                          read_preference=pref)
+            if message is not None:
+                break
         else:
-            if message['c']['id'] != cid:
-                # NOTE(kgriffs): Read from primary in case the message
-                # was just barely claimed, and claim hasn't made it to
-                # the secondary.
-                pref = pymongo.read_preferences.ReadPreference.PRIMARY
-                message = collection.find_one(query, read_preference=pref)
+            return
 
-                if message['c']['id'] != cid:
-                    raise errors.MessageIsClaimedBy(message_id, claim)
+        if claim is None:
+            raise errors.MessageIsClaimed(message_id)
 
-        collection.remove(query['_id'], w=0)
+        raise errors.MessageIsClaimedBy(message_id, claim)
 
     @utils.raises_conn_error
     @utils.retries_on_autoreconnect
@@ -733,44 +1496,213 @@ class MessageController(storage.Message):
             PROJ_QUEUE: utils.scope_queue_name(queue_name, project),
         }
 
-        collection = self._collection(queue_name, project)
-        collection.remove(query, w=0)
+        collections = self._collections_for(queue_name, project)
+
+        write_concerns = self.driver.write_concerns
+
+        if not self.driver.mongodb_conf.stats_refresh_interval:
+            with write_concerns.write('delete',
+                                      default='unacknowledged') as options:
+                for collection in collections:
+                    collection.remove(query, **options)
+            return
+
+        # In order to keep the queue stats current, remove the
+        # claimed messages first, so that we know how many of the
+        # deleted messages were claimed.
+        claimed_query = dict(query, **{'c.e': {'$gt': timeutils.utcnow_ts()}})
+
+        claimed = total = 0
+        with write_concerns.write('delete', needs_result=True) as options:
+            for collection in collections:
+                removed = collection.remove(claimed_query, **options)['n']
+                claimed += removed
+                total += removed + collection.remove(query, **options)['n']
+
+        self._queue_ctrl._inc_stats(queue_name, project, total=-total,
+                                    claimed=-claimed)
 
     @utils.raises_conn_error
     @utils.retries_on_autoreconnect
     def pop(self, queue_name, limit, project=None):
-        query = {
-            PROJ_QUEUE: utils.scope_queue_name(queue_name, project),
-        }
+        """Removes and returns up to `limit` active messages.
+
+        Popping is done in a constant number of round trips,
+        regardless of `limit`. First, a batch of candidate messages
+        is fetched, together with the fields needed to return them.
+        If there are no candidates, the queue is empty and we are
+        done. Otherwise, the candidates are tagged with a short-lived,
+        private claim in a single update, and then every message
+        bearing that claim is removed.
+
+        Only one request can win the tag for any given message, since
+        the update filters out messages that are already claimed, so
+        a message is never returned by more than one pop, even when
+        several consumers are popping (or claiming) in parallel. If
+        some candidates were lost to a parallel request, one more,
+        id-only, query is needed to find out which messages we won.
+
+        Should the request fail after tagging the messages, the tag
+        simply expires after `POP_CLAIM_TTL` seconds and the messages
+        become available again.
+        """
+
+        collections = self._collections_for(queue_name, project)
 
         # Only include messages that are not part of
         # any claim, or are part of an expired claim.
+        candidates = list(self._active(queue_name,
+                                       echo=True,
+                                       fields=MESSAGE_FIELDS,
+                                       project=project,
+                                       limit=limit))
+        if not candidates:
+            return []
+
+        ids = [msg['_id'] for msg in candidates]
+
         now = timeutils.utcnow_ts()
-        query['c.e'] = {'$lte': now}
+        cid = objectid.ObjectId()
+        claim = {'id': cid, 't': POP_CLAIM_TTL, 'e': now + POP_CLAIM_TTL}
 
-        collection = self._collection(queue_name, project)
-        fields = {'_id': 1, 't': 1, 'b': 1}
+        write_concerns = self.driver.write_concerns
+
+        updated = 0
+        with write_concerns.write('claim', needs_result=True) as options:
+            for collection in collections:
+                updated += collection.update({'_id': {'$in': ids},
+                                              'c.e': {'$lte': now}},
+                                             {'$set': {'c': claim}},
+                                             upsert=False, multi=True,
+                                             **options)['n']
+
+        if updated == 0:
+            return []
+
+        # While the queue is being moved to a new partition,
+        # a message may be updated once per partition, so the count
+        # can not be relied on to tell whether we won every message.
+        if updated != len(ids) or len(collections) > 1:
+            query = {'_id': {'$in': ids}, 'c.id': cid}
+            won = set(msg['_id'] for collection in collections
+                      for msg in collection.find(
+                          query, fields={'_id': 1}).hint(ID_INDEX_FIELDS))
+
+            candidates = [msg for msg in candidates if msg['_id'] in won]
+
+        won_ids = [msg['_id'] for msg in candidates]
+        with write_concerns.write('delete') as options:
+            for collection in collections:
+                collection.remove({'_id': {'$in': won_ids}, 'c.id': cid},
+                                  **options)
 
-        messages = (collection.find_and_modify(query,
-                                               fields=fields,
-                                               remove=True)
-                    for _ in range(limit))
+        self._queue_ctrl._inc_stats(queue_name, project,
+                                    total=-len(candidates))
 
-        messages = itertools.ifilter(None, messages)
+        return _basic_messages(candidates, now, self.driver.metrics)
 
-        final_messages = [_basic_message(message, now)
-                          for message in messages]
+    @utils.raises_conn_error
+    def wait(self, queue_name, project=None, since=None, timeout=0):
+        """Blocks until messages are posted to the queue, or timeout.
+
+        Tails the notifications collection of the queue's partition,
+        so that waiting readers do not have to keep running the
+        listing query. Not retried on AutoReconnect, since callers
+        can simply list the queue again.
+        """
+        if self._notifications is None or timeout <= 0:
+            return False
+
+        if since is None:
+            since = timeutils.utcnow_ts()
+
+        partition = utils.get_partition(self._num_partitions,
+                                        queue_name, project)
+        collection = self._notifications[partition]
+
+        query = {
+            PROJ_QUEUE: utils.scope_queue_name(queue_name, project),
+            'n': {'$gte': since},
+        }
 
-        return final_messages
+        deadline = time.time() + timeout
+        while True:
+            # With await_data, each batch blocks on the server for a
+            # short while, until a new notification is inserted.
+            cursor = collection.find(query, fields={'_id': 1},
+                                     tailable=True, await_data=True)
 
+            while cursor.alive:
+                for _notification in cursor:
+                    self.driver.metrics.incr('notifications.woken')
+                    return True
 
-def _basic_message(msg, now):
+                if time.time() >= deadline:
+                    self.driver.metrics.incr('notifications.timeout')
+                    return False
+
+            # The cursor died, e.g., because the collection wrapped
+            # around while it was being tailed; open a new one.
+            if time.time() + NOTIFICATION_RETRY_INTERVAL >= deadline:
+                self.driver.metrics.incr('notifications.timeout')
+                return False
+
+            utils.cooperative_sleep(NOTIFICATION_RETRY_INTERVAL)
+
+
+def _body(stored, metrics=None):
+    """Returns a message body as stored, decompressing it if needed."""
+    if isinstance(stored, binary.Binary):
+        return jsonutils.loads(codecs.decompress(stored, metrics), 'utf-8')
+
+    return stored
+
+
+def _basic_message(msg, now, metrics=None):
     oid = msg['_id']
     age = now - utils.oid_ts(oid)
 
-    return {
+    message = {
         'id': str(oid),
         'age': int(age),
         'ttl': msg['t'],
-        'body': msg['b'],
     }
+
+    # The body is left out of the projection by body-less listings
+    if 'b' in msg:
+        message['body'] = _body(msg['b'], metrics)
+
+    return message
+
+
+def _basic_messages(msgs, now, metrics=None):
+    """Denormalizes a whole page of messages at once.
+
+    Equivalent to calling `_basic_message()` on each message, but
+    cheaper for large pages since lookups are hoisted out of the loop.
+
+    :param msgs: An iterable of message documents
+    :param now: Current UNIX timestamp, used to compute message ages
+    :param metrics: (Default None) Registry in which to record the
+        time spent decompressing bodies
+    :returns: A list of basic message dicts
+    """
+    oid_ts = utils.oid_ts
+    body = _body
+    result = []
+    append = result.append
+
+    for msg in msgs:
+        oid = msg['_id']
+        message = {
+            'id': str(oid),
+            'age': int(now - oid_ts(oid)),
+            'ttl': msg['t'],
+        }
+
+        if 'b' in msg:
+            message['body'] = body(msg['b'], metrics)
+
+        append(message)
+
+    return result
@@ -0,0 +1,81 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Moves messages between partitions when their number is changed."""
+
+from marconi.common import workers
+from marconi.i18n import _
+import marconi.openstack.common.log as logging
+from marconi.queues.storage.mongodb import messages
+
+LOG = logging.getLogger(__name__)
+
+# Seconds to wait between passes over the queues, and before retrying
+# after an error.
+PASS_INTERVAL = 60
+
+
+class PartitionMover(workers.PeriodicWorker):
+    """Background thread that moves messages to their new partition.
+
+    While `previous_partitions` is set, makes passes over every queue,
+    moving its messages from the partition it hashed to under the
+    previous number of partitions to the one it hashes to now. See
+    also `MessageController._migrate_queue()`.
+
+    Once a pass finds no more messages to move, the migration is
+    complete, and the thread exits after logging a message to let
+    the operator know `previous_partitions` may be unset.
+
+    :param driver: The MongoDB data driver
+    :param message_controller: The driver's message controller
+    """
+
+    def __init__(self, driver, message_controller):
+        super(PartitionMover, self).__init__(
+            'marconi-partition-mover', driver.metrics, PASS_INTERVAL,
+            batch_size=messages.MIGRATION_BATCH_SIZE)
+
+        self._driver = driver
+        self._controller = message_controller
+
+    def run_once(self):
+        """Makes a single pass over every queue.
+
+        :returns: The number of messages moved
+        """
+        queues = self._driver.queues_database.queues
+        total = 0
+
+        for doc in queues.find({}, fields={'p_q': 1, '_id': 0}):
+            project, _sep, name = doc['p_q'].partition('/')
+            project = project or None
+
+            def migrate(limit):
+                return self._controller._migrate_queue(name, project,
+                                                       limit)
+
+            total += self.drain(migrate, 'partitions.moved')
+
+        return total
+
+    def is_done(self, moved):
+        if moved:
+            return False
+
+        LOG.info(_(u'All messages have been moved to their new '
+                   u'partitions; previous_partitions may now '
+                   u'be unset.'))
+        return True
@@ -54,16 +54,67 @@ MONGODB_OPTIONS = (
 
     cfg.StrOpt('database', default='marconi', help='Database name.'),
 
+    cfg.IntOpt('max_pool_size', default=0,
+               help=('Maximum number of connections the client will keep '
+                     'open to each server. Requests that need a socket '
+                     'while all of them are in use wait for one to be '
+                     'returned to the pool. Set to 0 to use the '
+                     'library default.')),
+
+    cfg.IntOpt('wait_queue_timeout', default=0,
+               help=('Milliseconds a request will wait for a socket to be '
+                     'returned to a saturated pool before failing with a '
+                     'connection error. Set to 0 to wait indefinitely.')),
+
+    cfg.IntOpt('wait_queue_multiple', default=0,
+               help=('Limits the number of requests that may wait for a '
+                     'socket at any one time to this multiple of '
+                     '``max_pool_size``. Requests beyond that limit fail '
+                     'immediately. Set to 0 to allow an unbounded queue.')),
+
+    cfg.IntOpt('connect_timeout', default=0,
+               help=('Milliseconds to wait when opening a new connection '
+                     'before giving up. Set to 0 to use the library '
+                     'default.')),
+
+    cfg.IntOpt('socket_timeout', default=0,
+               help=('Milliseconds to wait for a response to a request '
+                     'sent on an open connection before giving up. Set '
+                     'to 0 to wait indefinitely.')),
+
+    cfg.BoolOpt('socket_keepalive', default=False,
+                help=('Enable TCP keepalive on pooled sockets, so that '
+                      'idle connections dropped by firewalls or load '
+                      'balancers are detected.')),
+
     cfg.IntOpt('partitions', default=2,
                help=('Number of databases across which to '
                      'partition message data, in order to '
                      'reduce writer lock %. DO NOT change '
-                     'this setting after initial deployment. '
-                     'It MUST remain static. Also, you '
+                     'this setting after initial deployment, '
+                     'unless previous_partitions is set to the '
+                     'old value at the same time, so that '
+                     'existing messages can be migrated. Also, you '
                      'should not need a large number of partitions '
                      'to improve performance, esp. if deploying '
                      'MongoDB on SSD storage.')),
 
+    cfg.IntOpt('previous_partitions', default=0,
+               help=('Number of partitions messages were previously '
+                     'spread across, when changing the "partitions" '
+                     'option on a live deployment. While set, new '
+                     'messages are written to their queue\'s new '
+                     'partition, but reads and updates also consult '
+                     'the old one, until the partition mover has '
+                     'moved every message. Set back to 0 (the '
+                     'default) once the migration has completed.')),
+
+    cfg.BoolOpt('partition_mover', default=False,
+                help=('Run a background thread that moves messages '
+                      'from their queue\'s previous partition to its '
+                      'new one, while previous_partitions is set. It '
+                      'is enough to enable this on a single node.')),
+
     cfg.IntOpt('max_attempts', default=1000,
                help=('Maximum number of times to retry a failed operation. '
                      'Currently only used for retrying a message post.')),
@@ -88,6 +139,172 @@ MONGODB_OPTIONS = (
                        'after a primary node failover. '
                        'The actual sleep time increases exponentially (power '
                        'of 2) each time the operation is retried.')),
+
+    cfg.IntOpt('circuit_breaker_threshold', default=0,
+               help=('Number of consecutive operations that must fail '
+                     'to reach the database, after exhausting their '
+                     'reconnect attempts, before further operations are '
+                     'failed right away rather than retried. Set to 0 '
+                     '(the default) to disable the circuit breaker.')),
+
+    cfg.FloatOpt('circuit_breaker_cooldown', default=5.0,
+                 help=('Number of seconds to fail operations right away '
+                       'once the circuit breaker has opened, before '
+                       'letting a single operation through to check '
+                       'whether the database is reachable again.')),
+
+    cfg.IntOpt('marker_lease_size', default=0,
+               help=('Number of message markers to reserve per queue, '
+                     'in a single atomic counter update, each time a '
+                     'worker runs out of markers for that queue. '
+                     'Subsequent posts hand out markers from the '
+                     'reserved block without touching the queue '
+                     'document. Markers are then only ordered per '
+                     'worker, so an observer paging by marker may skip '
+                     'messages posted concurrently by other workers '
+                     'within the lease window. Set to 0 (the default) '
+                     'to disable leasing.')),
+
+    cfg.IntOpt('marker_lease_ttl', default=5,
+               help=('Maximum number of seconds a worker may hand out '
+                     'markers from a leased block before reserving a '
+                     'fresh one. Bounds the window during which '
+                     'markers from different workers may interleave.')),
+
+    cfg.BoolOpt('visibility_watermark', default=False,
+                help=('Post batches of messages with a single insert, '
+                      'rather than tagging them with a transaction ID '
+                      'that must be cleared with a second update. '
+                      'Listings instead only return messages whose '
+                      'marker is below the queue\'s message counter, '
+                      'which is only advanced once a batch has been '
+                      'completely inserted. This also avoids the need '
+                      'for the "transaction" index. Can not be combined '
+                      'with marker_lease_size, since leasing advances '
+                      'the counter before a batch is inserted.')),
+
+    cfg.IntOpt('stats_refresh_interval', default=0,
+               help=('Serve queue stats from counters kept on the queue '
+                     'document, which are maintained incrementally as '
+                     'messages are posted, claimed, released, popped '
+                     'and deleted, and as expired claims are cleared '
+                     'by the claim sweeper (see claim_sweep_interval). '
+                     'Messages are expired by the TTL index, which does '
+                     'not touch the counters, and neither do expired '
+                     'claims replaced or deleted before being swept. '
+                     'To correct for this, the counters are reconciled '
+                     'against the messages collection when stats are '
+                     'requested, at most once every this many seconds, '
+                     'which bounds how stale the reported total, '
+                     'claimed and free counts and oldest/newest '
+                     'messages may be. Set to 0 (the default) to '
+                     'disable the counters, in which case every stats '
+                     'request counts the messages in the queue.')),
+
+    cfg.BoolOpt('notifications', default=False,
+                help=('Record a notification in a capped collection in '
+                      'the partition\'s database whenever messages are '
+                      'posted to a queue, so that readers waiting on '
+                      'the queue can be woken up by tailing the '
+                      'collection, rather than by repeatedly listing '
+                      'messages.')),
+
+    cfg.IntOpt('notification_log_size', default=1024 * 1024,
+               help=('Size, in bytes, of the capped collection holding '
+                     'notifications in each partition. Must be large '
+                     'enough to hold the notifications recorded '
+                     'during the longest wait allowed by the '
+                     'transport, or waiting readers may have to fall '
+                     'back to polling.')),
+
+    cfg.BoolOpt('compact_indexes', default=False,
+                help=('Create a smaller set of indexes on the messages '
+                      'collections, relying on partial indexes, which '
+                      'require MongoDB 3.2 or later. Indexes left over '
+                      'from the regular set are not dropped '
+                      'automatically; see "marconi-manage '
+                      'mongodb-indexes --drop-unused".')),
+
+    cfg.BoolOpt('fast_start', default=False,
+                help=('Skip creating collections and indexes whenever '
+                      'a controller is first used, as long as the '
+                      'schema recorded by "marconi-manage '
+                      'mongodb-bootstrap" matches this version of the '
+                      'driver and the options that determine the '
+                      'schema, such as partitions. Otherwise, they are '
+                      'created as usual. For pooled drivers, set this '
+                      'in each pool\'s options.')),
+
+    cfg.IntOpt('claim_sweep_interval', default=0,
+               help=('Run a background thread that, every this many '
+                     'seconds, clears the claim IDs left behind on '
+                     'messages by expired claims, so that claim '
+                     'lookups and the index on claim IDs only have '
+                     'to deal with live claims. Works best with '
+                     'compact_indexes enabled. Set to 0 (the default) '
+                     'to disable.')),
+
+    cfg.IntOpt('claim_sweep_batch_size', default=100,
+               help=('Maximum number of messages cleared by the claim '
+                     'sweeper in a single update.')),
+
+    cfg.FloatOpt('claim_sweep_batch_delay', default=0.1,
+                 help=('Seconds for the claim sweeper to pause between '
+                       'batches, to limit its impact on the database.')),
+
+    cfg.DictOpt('read_preferences', default={},
+                help=('Read preference to use for each kind of read '
+                      'that does not need to see the latest writes, as '
+                      'a comma-separated list of operation:mode pairs, '
+                      'e.g., "list:secondaryPreferred,stats:nearest". '
+                      'Operations are list, get and bulk_get (of '
+                      'messages), stats, and queues (listing); modes '
+                      'are primary, primaryPreferred, secondary, '
+                      'secondaryPreferred and nearest. Reads not listed '
+                      'here use the connection\'s default, and message '
+                      'listings always go to the primary when '
+                      'visibility_watermark is enabled.')),
+
+    cfg.IntOpt('max_staleness', default=0,
+               help=('Max replication lag, in seconds, tolerated for '
+                     'reads sent to secondaries per read_preferences. '
+                     'Such reads fall back to the primary while any '
+                     'healthy secondary lags further behind, or while '
+                     'the lag can not be determined. Checking the lag '
+                     'requires the clusterMonitor role. Set to 0 (the '
+                     'default) for no bound.')),
+
+    cfg.DictOpt('write_concerns', default={},
+                help=('Write concern to use for each class of writes, '
+                      'as a comma-separated list of profile:mode pairs, '
+                      'e.g., "post:majority,delete:unacknowledged". '
+                      'Profiles are post (posting messages), claim '
+                      '(claiming and releasing messages), delete '
+                      '(deleting messages), and admin (managing '
+                      'queues, pools and the catalogue); modes are '
+                      'acknowledged, unacknowledged, journaled and '
+                      'majority. Writes whose result is needed, such '
+                      'as single message deletes, are always '
+                      'acknowledged. Profiles not listed here keep '
+                      'their previous behaviour: deleting messages '
+                      'in bulk or along with their queue, and '
+                      'deleting pools and catalogue entries, is '
+                      'unacknowledged; all other writes use the '
+                      'connection\'s default.')),
+
+    cfg.StrOpt('body_codec', default=None,
+               help=('Name of the codec used to compress message bodies '
+                     'at rest, e.g., "zlib". Other codecs may be '
+                     'registered under the '
+                     '"marconi.queues.storage.codecs" entry point '
+                     'namespace. Bodies are only decompressed when '
+                     'they are returned to clients. Compressed bodies '
+                     'remain readable after the codec is changed or '
+                     'unset (the default).')),
+
+    cfg.IntOpt('body_compression_threshold', default=1024,
+               help=('Bodies that are smaller than this many bytes, once '
+                     'serialized, are stored uncompressed.')),
 )
 
 MONGODB_GROUP = 'drivers:storage:mongodb'
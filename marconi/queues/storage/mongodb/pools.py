@@ -48,6 +48,11 @@ class PoolsController(base.PoolsBase):
         super(PoolsController, self).__init__(*args, **kwargs)
 
         self._col = self.driver.database.pools
+
+        if not self.driver.schema_bootstrapped:
+            self._ensure_indexes()
+
+    def _ensure_indexes(self):
         self._col.ensure_index(POOLS_INDEX,
                                background=True,
                                name='pools_name',
@@ -62,7 +67,8 @@ class PoolsController(base.PoolsBase):
         cursor = self._col.find(query, fields=_field_spec(detailed),
                                 limit=limit)
         normalizer = functools.partial(_normalize, detailed=detailed)
-        return utils.HookedCursor(cursor, normalizer)
+        return utils.BatchedCursor(cursor, utils.denormalize_each(normalizer),
+                                   batch_size=limit)
 
     @utils.raises_conn_error
     def get(self, name, detailed=False):
@@ -76,10 +82,11 @@ class PoolsController(base.PoolsBase):
     @utils.raises_conn_error
     def create(self, name, weight, uri, options=None):
         options = {} if options is None else options
-        self._col.update({'n': name},
-                         {'$set': {'n': name, 'w': weight, 'u': uri,
-                                   'o': options}},
-                         upsert=True)
+        with self.driver.write_concerns.write('admin') as write_options:
+            self._col.update({'n': name},
+                             {'$set': {'n': name, 'w': weight, 'u': uri,
+                                       'o': options}},
+                             upsert=True, **write_options)
 
     @utils.raises_conn_error
     def exists(self, name):
@@ -92,15 +99,19 @@ class PoolsController(base.PoolsBase):
                                      pred=lambda x: x is not None,
                                      key_transform=lambda x: x[0])
         assert fields, '`weight`, `uri`, or `options` not found in kwargs'
-        res = self._col.update({'n': name},
-                               {'$set': fields},
-                               upsert=False)
+        with self.driver.write_concerns.write(
+                'admin', needs_result=True) as options:
+            res = self._col.update({'n': name},
+                                   {'$set': fields},
+                                   upsert=False, **options)
         if not res['updatedExisting']:
             raise errors.PoolDoesNotExist(name)
 
     @utils.raises_conn_error
     def delete(self, name):
-        self._col.remove({'n': name}, w=0)
+        with self.driver.write_concerns.write(
+                'admin', default='unacknowledged') as options:
+            self._col.remove({'n': name}, **options)
 
     @utils.raises_conn_error
     def drop_all(self):
@@ -72,6 +72,7 @@ class QueueController(storage.Queue):
         name         ->   p_q
         msg counter  ->     c
         metadata     ->     m
+        msg stats    ->     s
 
     Message Counter:
 
@@ -79,6 +80,17 @@ class QueueController(storage.Queue):
         -------------------
         value        ->   v
         modified ts  ->   t
+        watermark    ->   w
+
+    Message Stats:
+
+        Name          Field
+        -------------------
+        total        ->   t
+        claimed      ->   c
+        oldest id    ->   o
+        newest id    ->   n
+        reconciled   ->   r
     """
 
     def __init__(self, *args, **kwargs):
@@ -87,6 +99,14 @@ class QueueController(storage.Queue):
         self._cache = self.driver.cache
         self._collection = self.driver.queues_database.queues
 
+        if not self.driver.schema_bootstrapped:
+            self._ensure_indexes()
+
+    # ----------------------------------------------------------------------
+    # Helpers
+    # ----------------------------------------------------------------------
+
+    def _ensure_indexes(self):
         # NOTE(flaper87): This creates a unique index for
         # project and name. Using project as the prefix
         # allows for querying by project and project+name.
@@ -94,10 +114,6 @@ class QueueController(storage.Queue):
         # a specific project, for example. Order matters!
         self._collection.ensure_index([('p_q', 1)], unique=True)
 
-    # ----------------------------------------------------------------------
-    # Helpers
-    # ----------------------------------------------------------------------
-
     def _get(self, name, project=None, fields={'m': 1, '_id': 0}):
         queue = self._collection.find_one(_get_scoped_query(name, project),
                                           fields=fields)
@@ -136,6 +152,28 @@ class QueueController(storage.Queue):
 
         return doc['c']['v']
 
+    def _get_watermark(self, name, project=None):
+        """Retrieves the visibility watermark for a given queue.
+
+        Every message with a marker below the watermark belongs to a
+        batch that was completely inserted, and so may be returned
+        to clients. Messages at or above the watermark may be part
+        of a batch that is still being inserted.
+
+        The counter is only incremented once a batch has been
+        inserted, and so it doubles as the watermark. That is why
+        `visibility_watermark` can not be combined with
+        `marker_lease_size`, which increments the counter before
+        a batch is inserted.
+
+        :param name: Name of the queue to which the watermark is scoped
+        :param project: Queue's project
+        :returns: current watermark as an integer
+        :raises: storage.errors.QueueDoesNotExist
+        """
+
+        return self._get_counter(name, project)
+
     def _inc_counter(self, name, project=None, amount=1, window=None):
         """Increments the message counter and returns the new value.
 
@@ -190,6 +228,129 @@ class QueueController(storage.Queue):
 
         return doc['c']['v']
 
+    def _inc_stats(self, name, project=None, total=0, claimed=0,
+                   ids=None):
+        """Adjusts the message stats kept on the queue document.
+
+        This is a no-op unless `stats_refresh_interval` is set. The
+        update is not acknowledged, since any drift is corrected the
+        next time the stats are reconciled.
+
+        :param name: Name of the queue to which the stats are scoped
+        :param project: Queue's project
+        :param total: Amount by which to adjust the message total
+        :param claimed: Amount by which to adjust the claimed count
+        :param ids: IDs of newly posted messages, if any, used to
+            track the oldest and newest messages in the queue
+        """
+
+        if not self.driver.mongodb_conf.stats_refresh_interval:
+            return
+
+        update = {}
+
+        inc = {}
+        if total:
+            inc['s.t'] = total
+        if claimed:
+            inc['s.c'] = claimed
+        if inc:
+            update['$inc'] = inc
+
+        if ids:
+            update['$min'] = {'s.o': min(ids)}
+            update['$max'] = {'s.n': max(ids)}
+
+        if update:
+            self._collection.update(_get_scoped_query(name, project),
+                                    update, upsert=False, w=0)
+
+    def _expire_claims(self, expirations):
+        """Takes expired claims off the claimed counts of their queues.
+
+        Only claims that expired after a queue's stats were last
+        reconciled are counted, since the reconciliation already
+        left out any that had expired by then. This is a no-op unless
+        `stats_refresh_interval` is set.
+
+        :param expirations: A dict mapping scoped queue names to the
+            expiration times of the claims cleared from their messages
+        """
+
+        if not self.driver.mongodb_conf.stats_refresh_interval:
+            return
+
+        docs = self._collection.find({'p_q': {'$in': list(expirations)}},
+                                     fields={'p_q': 1, 's.r': 1, '_id': 0})
+
+        for doc in docs:
+            reconciled = doc.get('s', {}).get('r')
+            if reconciled is None:
+                continue
+
+            expired = sum(1 for expires in expirations[doc['p_q']]
+                          if expires > reconciled)
+            if expired:
+                self._collection.update({'p_q': doc['p_q']},
+                                        {'$inc': {'s.c': -expired}},
+                                        upsert=False, w=0)
+
+    def _refresh_stats(self, name, project=None, stats=None):
+        """Recounts the messages in a queue and saves the result.
+
+        When several requests notice that the stats are due to be
+        reconciled at the same time, only the first one to bump the
+        reconciliation timestamp actually counts the messages. The
+        others simply return the current, slightly stale, stats.
+
+        :param name: Name of the queue to which the stats are scoped
+        :param project: Queue's project
+        :param stats: The stats currently kept on the queue document,
+            or None if they have never been reconciled
+        :returns: The reconciled stats document
+        """
+
+        now = timeutils.utcnow_ts()
+        query = _get_scoped_query(name, project)
+        reconciled = stats and stats.get('r')
+        query['s.r'] = reconciled or {'$exists': False}
+
+        won = self._collection.update(query, {'$set': {'s.r': now}},
+                                      upsert=False)['n']
+
+        if not won and reconciled:
+            return stats
+
+        controller = self.driver.message_controller
+
+        active = controller._count(name, project=project,
+                                   include_claimed=False)
+        total = controller._count(name, project=project,
+                                  include_claimed=True)
+
+        stats = {'t': total, 'c': total - active, 'r': now}
+
+        try:
+            oldest = controller.first(name, project=project, sort=1)
+            newest = controller.first(name, project=project, sort=-1)
+        except errors.QueueIsEmpty:
+            # Unsetting the references lets the $min and $max
+            # in _inc_stats() pick up the next message posted.
+            update = {'$unset': {'s.o': 1, 's.n': 1}}
+        else:
+            stats['o'] = utils.to_oid(oldest['id'])
+            stats['n'] = utils.to_oid(newest['id'])
+            update = {}
+
+        update['$set'] = {'s.t': stats['t'], 's.c': stats['c']}
+        update['$set'].update(('s.' + k, stats[k]) for k in ('o', 'n')
+                              if k in stats)
+
+        self._collection.update(_get_scoped_query(name, project),
+                                update, upsert=False)
+
+        return stats
+
     # ----------------------------------------------------------------------
     # Interface
     # ----------------------------------------------------------------------
@@ -203,7 +364,9 @@ class QueueController(storage.Queue):
         if detailed:
             fields['m'] = 1
 
-        cursor = self._collection.find(query, fields=fields)
+        options = self.driver.read_preferences.options('queues')
+
+        cursor = self._collection.find(query, fields=fields, **options)
         cursor = cursor.limit(limit).sort('p_q')
         marker_name = {}
 
@@ -214,7 +377,8 @@ class QueueController(storage.Queue):
                 queue['metadata'] = record['m']
             return queue
 
-        yield utils.HookedCursor(cursor, normalizer)
+        yield utils.BatchedCursor(cursor, utils.denormalize_each(normalizer),
+                                  batch_size=limit)
         yield marker_name and marker_name['next']
 
     @utils.raises_conn_error
@@ -239,11 +403,13 @@ class QueueController(storage.Queue):
             # NOTE(kgriffs): Start counting at 1, and assume the first
             # message ever posted will succeed and set t to a UNIX
             # "modified at" timestamp.
-            counter = {'v': 1, 't': 0}
+            counter = {'v': 1, 't': 0, 'w': 1}
 
             scoped_name = utils.scope_queue_name(name, project)
-            self._collection.insert({'p_q': scoped_name, 'm': {},
-                                     'c': counter})
+            with self.driver.write_concerns.write(
+                    'admin', needs_result=True) as options:
+                self._collection.insert({'p_q': scoped_name, 'm': {},
+                                         'c': counter}, **options)
 
         except pymongo.errors.DuplicateKeyError:
             return False
@@ -262,10 +428,13 @@ class QueueController(storage.Queue):
     @utils.raises_conn_error
     @utils.retries_on_autoreconnect
     def set_metadata(self, name, metadata, project=None):
-        rst = self._collection.update(_get_scoped_query(name, project),
-                                      {'$set': {'m': metadata}},
-                                      multi=False,
-                                      manipulate=False)
+        with self.driver.write_concerns.write(
+                'admin', needs_result=True) as options:
+            rst = self._collection.update(_get_scoped_query(name, project),
+                                          {'$set': {'m': metadata}},
+                                          multi=False,
+                                          manipulate=False,
+                                          **options)
 
         if not rst['updatedExisting']:
             raise errors.QueueDoesNotExist(name, project)
@@ -275,20 +444,29 @@ class QueueController(storage.Queue):
     @exists.purges
     def delete(self, name, project=None):
         self.driver.message_controller._purge_queue(name, project)
-        self._collection.remove(_get_scoped_query(name, project))
+
+        with self.driver.write_concerns.write('admin') as options:
+            self._collection.remove(_get_scoped_query(name, project),
+                                    **options)
 
     @utils.raises_conn_error
     @utils.retries_on_autoreconnect
     def stats(self, name, project=None):
+        if self.driver.mongodb_conf.stats_refresh_interval:
+            return self._tracked_stats(name, project)
+
         if not self.exists(name, project=project):
             raise errors.QueueDoesNotExist(name, project)
 
         controller = self.driver.message_controller
+        preference = self.driver.read_preferences.get('stats')
 
         active = controller._count(name, project=project,
-                                   include_claimed=False)
+                                   include_claimed=False,
+                                   read_preference=preference)
         total = controller._count(name, project=project,
-                                  include_claimed=True)
+                                  include_claimed=True,
+                                  read_preference=preference)
 
         message_stats = {
             'claimed': total - active,
@@ -297,8 +475,10 @@ class QueueController(storage.Queue):
         }
 
         try:
-            oldest = controller.first(name, project=project, sort=1)
-            newest = controller.first(name, project=project, sort=-1)
+            oldest = controller._first(name, project=project, sort=1,
+                                       read_preference=preference)
+            newest = controller._first(name, project=project, sort=-1,
+                                       read_preference=preference)
         except errors.QueueIsEmpty:
             pass
         else:
@@ -308,6 +488,47 @@ class QueueController(storage.Queue):
 
         return {'messages': message_stats}
 
+    def _tracked_stats(self, name, project=None):
+        """Returns stats based on the counters kept on the queue document.
+
+        This normally takes a single read of the queue document,
+        regardless of the number of messages in the queue.
+        """
+
+        options = self.driver.read_preferences.options('stats')
+
+        doc = self._collection.find_one(_get_scoped_query(name, project),
+                                        fields={'s': 1, '_id': 0},
+                                        **options)
+        if doc is None:
+            raise errors.QueueDoesNotExist(name, project)
+
+        now = timeutils.utcnow_ts()
+        interval = self.driver.mongodb_conf.stats_refresh_interval
+
+        stats = doc.get('s')
+        if stats is None or stats.get('r', 0) + interval <= now:
+            stats = self._refresh_stats(name, project, stats)
+
+        # Counters may briefly drift below zero when a message that
+        # has already expired is deleted before being reconciled.
+        total = max(stats.get('t', 0), 0)
+        claimed = min(max(stats.get('c', 0), 0), total)
+
+        message_stats = {
+            'claimed': claimed,
+            'free': total - claimed,
+            'total': total,
+        }
+
+        if total and stats.get('o') and stats.get('n'):
+            message_stats['oldest'] = utils.stat_message(
+                {'id': str(stats['o'])}, now)
+            message_stats['newest'] = utils.stat_message(
+                {'id': str(stats['n'])}, now)
+
+        return {'messages': message_stats}
+
 
 def _get_scoped_query(name, project):
     return {'p_q': utils.scope_queue_name(name, project)}
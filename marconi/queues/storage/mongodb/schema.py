@@ -0,0 +1,116 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Records which collections and indexes have been created.
+
+Controllers normally make sure their collections and indexes exist
+when they are constructed, which costs a round trip per index, and
+per partition for messages. `bootstrap()` does this once, e.g., from
+"marconi-manage mongodb-bootstrap", and records the layout it
+created, so that drivers with `fast_start` enabled only have to check
+that the recorded layout is still current.
+"""
+
+from marconi.i18n import _
+import marconi.openstack.common.log as logging
+from marconi.openstack.common import timeutils
+from marconi.queues.storage.mongodb import controllers
+from marconi.queues.storage.mongodb import utils
+
+LOG = logging.getLogger(__name__)
+
+# Bump whenever a controller's collections or indexes are changed,
+# so that drivers stop trusting layouts recorded by older versions.
+SCHEMA_VERSION = 1
+
+_LAYOUT_ID = 'layout'
+
+
+def data_layout(conf):
+    """Returns the layout a data driver expects, given its options."""
+    return {
+        'version': SCHEMA_VERSION,
+        'partitions': max(conf.partitions, conf.previous_partitions),
+        'compact_indexes': conf.compact_indexes,
+        'visibility_watermark': conf.visibility_watermark,
+        'notifications': conf.notifications,
+    }
+
+
+def control_layout(conf):
+    """Returns the layout a control driver expects."""
+    return {'version': SCHEMA_VERSION}
+
+
+@utils.raises_conn_error
+def is_current(database, layout):
+    """Returns True if `layout` was recorded in the database."""
+    doc = database.schema.find_one({'_id': _LAYOUT_ID})
+    recorded = doc and doc['layout']
+
+    if recorded != layout:
+        LOG.warning(_(u'The schema recorded in %(db)s is %(recorded)s, '
+                      u'expected %(layout)s; creating indexes on '
+                      u'startup. Run "marconi-manage mongodb-bootstrap" '
+                      u'to avoid this.'),
+                    {'db': database.name, 'recorded': recorded,
+                     'layout': layout})
+        return False
+
+    return True
+
+
+@utils.raises_conn_error
+def record(database, layout):
+    """Records `layout` as the one created in the database."""
+    database.schema.update({'_id': _LAYOUT_ID},
+                           {'$set': {'layout': layout,
+                                     'recorded': timeutils.utcnow()}},
+                           upsert=True)
+
+
+def bootstrap(driver):
+    """Creates a data driver's collections and indexes.
+
+    Controllers are created directly, rather than through the
+    driver, so that no background threads are started.
+    """
+    queue_controller = controllers.QueueController(driver)
+    message_controller = controllers.MessageController(driver)
+
+    # Controllers of drivers that trust the recorded layout
+    # skip this when constructed.
+    if driver.schema_bootstrapped:
+        queue_controller._ensure_indexes()
+        for collection in message_controller._collections:
+            message_controller._ensure_indexes(collection)
+
+        if driver.mongodb_conf.notifications:
+            for database in driver.message_databases:
+                message_controller._ensure_notifications(database)
+
+    record(driver.queues_database, data_layout(driver.mongodb_conf))
+
+
+def bootstrap_control(driver):
+    """Creates a control driver's collections and indexes."""
+    catalogue_controller = controllers.CatalogueController(driver)
+    pools_controller = controllers.PoolsController(driver)
+
+    if driver.schema_bootstrapped:
+        catalogue_controller._ensure_indexes()
+        pools_controller._ensure_indexes()
+
+    record(driver.database, control_layout(driver.mongodb_conf))
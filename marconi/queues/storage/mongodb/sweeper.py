@@ -0,0 +1,63 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Clears expired claims from messages in the background."""
+
+from marconi.common import workers
+
+
+class ClaimSweeper(workers.PeriodicWorker):
+    """Background thread that clears expired claims from messages.
+
+    Every `claim_sweep_interval` seconds, walks each partition in
+    batches of up to `claim_sweep_batch_size` messages, pausing for
+    `claim_sweep_batch_delay` seconds between batches, until no
+    expired claims are left. See also
+    `MessageController._sweep_expired_claims()`.
+
+    The number of messages cleared is recorded in the driver's
+    metrics as "claims.swept", and the time spent per pass under
+    "claims.sweep".
+
+    :param driver: The MongoDB data driver
+    :param message_controller: The driver's message controller
+    """
+
+    def __init__(self, driver, message_controller):
+        conf = driver.mongodb_conf
+        super(ClaimSweeper, self).__init__(
+            'marconi-claim-sweeper', driver.metrics,
+            conf.claim_sweep_interval,
+            batch_size=conf.claim_sweep_batch_size,
+            batch_delay=conf.claim_sweep_batch_delay,
+            timer='claims.sweep')
+
+        self._controller = message_controller
+
+    def run_once(self):
+        """Sweeps every partition once.
+
+        :returns: The number of messages cleared
+        """
+        total = 0
+
+        for partition in range(len(self._controller._collections)):
+            def sweep(limit):
+                return self._controller._sweep_expired_claims(partition,
+                                                              limit)
+
+            total += self.drain(sweep, 'claims.swept')
+
+        return total
@@ -16,29 +16,43 @@
 from __future__ import division
 import binascii
 import collections
+import contextlib
 import datetime
 import functools
+import itertools
 import random
+import struct
+import sys
+import threading
 import time
 
 from bson import errors as berrors
 from bson import objectid
 from bson import tz_util
 from pymongo import errors
+from pymongo import pool
+from pymongo import read_preferences
 
 from marconi.i18n import _
 import marconi.openstack.common.log as logging
 from marconi.openstack.common import timeutils
 from marconi.queues.storage import errors as storage_errors
 
-
 # BSON ObjectId gives TZ-aware datetime, so we generate a
 # TZ-aware UNIX epoch for convenience.
 EPOCH = datetime.datetime.utcfromtimestamp(0).replace(tzinfo=tz_util.utc)
 
+# Default number of documents pulled from a cursor per round trip,
+# and denormalized at a time, by BatchedCursor.
+CURSOR_BATCH_SIZE = 100
+
 # NOTE(cpp-cabrera): the authoritative form of project/queue keys.
 PROJ_QUEUE_KEY = 'p_q'
 
+# The first 4 bytes of an ObjectId are its creation time, in seconds
+# since the UNIX epoch, stored as a big-endian unsigned int.
+_OID_TIMESTAMP = struct.Struct('>I')
+
 LOG = logging.getLogger(__name__)
 
 
@@ -105,6 +119,391 @@ def calculate_backoff(attempt, max_attempts, max_sleep, max_jitter=0):
     return backoff_sec + jitter_sec
 
 
+def _green_sleep():
+    """Returns the green sleep function of the running hub, if any.
+
+    Only a process in which eventlet or gevent has monkey-patched the
+    time module runs under a green thread server; merely importing
+    either library, e.g., as some dependency does, is not enough.
+    Patching always loads the library's patcher module, so neither
+    library is imported here if it has not been already.
+    """
+    patcher = sys.modules.get('eventlet.patcher')
+    if patcher is not None and patcher.is_monkey_patched('time'):
+        return sys.modules['eventlet'].sleep
+
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('time'):
+        return sys.modules['gevent'].sleep
+
+    return None
+
+
+def cooperative_sleep(seconds):
+    """Sleeps without blocking other requests served by this worker.
+
+    When running under a green thread server (i.e., eventlet or
+    gevent has monkey-patched the time module), the current green
+    thread yields to the hub for the duration of the sleep, so that
+    the worker can keep serving other requests in the meantime.
+    Otherwise, falls back to `time.sleep()`, which only blocks the
+    calling thread.
+
+    :param seconds: Number of seconds to sleep (may be fractional)
+    """
+    sleep = _green_sleep()
+    if sleep is not None:
+        sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+class ContentionTracker(object):
+    """Tracks the recent rate of write conflicts, per key.
+
+    Keeps an exponentially-weighted moving average of the number of
+    conflicts each operation ran into before succeeding, so that
+    backoff can be tuned to the contention actually observed on, e.g.,
+    a given queue. Keys whose average decays to (nearly) zero are
+    dropped, so only contended keys take up any memory.
+
+    :param weight: Weight given to each new observation, in (0, 1]
+    """
+
+    def __init__(self, weight=0.2):
+        self._weight = weight
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, conflicts):
+        """Records the number of conflicts hit by an operation."""
+        with self._lock:
+            rate = self._rates.get(key, 0.0)
+            rate += self._weight * (conflicts - rate)
+
+            if rate < 0.01:
+                self._rates.pop(key, None)
+            else:
+                self._rates[key] = rate
+
+    def rate(self, key):
+        """Returns the average number of conflicts per operation."""
+        return self._rates.get(key, 0.0)
+
+
+class CircuitBreaker(object):
+    """Fails fast while the database appears to be unreachable.
+
+    Once `threshold` consecutive operations have exhausted all of
+    their attempts to reconnect, the breaker opens, and operations
+    are rejected right away instead of each one spending several
+    seconds retrying. After `cooldown` seconds, a single operation is
+    let through to probe the database; if it succeeds, the breaker
+    closes again, otherwise it stays open for another cooldown period.
+
+    :param threshold: Number of consecutive failed operations that
+        cause the breaker to open, or 0 to disable the breaker.
+    :param cooldown: Seconds to wait before probing the database
+    """
+
+    def __init__(self, threshold, cooldown):
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if an operation may be attempted."""
+        if not self._threshold or self._opened_at is None:
+            return True
+
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            now = time.time()
+            if now - self._opened_at < self._cooldown:
+                return False
+
+            # Let this operation probe the database, while
+            # others continue to fail fast until it is done.
+            self._opened_at = now
+            return True
+
+    def record_success(self):
+        """Closes the breaker, if it was open."""
+        if not self._threshold:
+            return
+
+        # Avoid taking the lock in the common case
+        if not self._failures and self._opened_at is None:
+            return
+
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        """Records an operation that could not reach the database.
+
+        :returns: True if this failure caused the breaker to open
+        """
+        if not self._threshold:
+            return False
+
+        with self._lock:
+            self._failures += 1
+            if self._failures < self._threshold:
+                return False
+
+            was_open = self._opened_at is not None
+            self._opened_at = time.time()
+
+            return not was_open
+
+
+# Operations whose read preference may be configured
+READ_OPERATIONS = ('list', 'get', 'bulk_get', 'stats', 'queues')
+
+_PRIMARY = read_preferences.ReadPreference.PRIMARY
+
+
+class ReadPreferences(object):
+    """Resolves the read preference to use for each operation.
+
+    Operations that are not configured otherwise use the
+    connection's default read preference, i.e., the primary unless
+    set differently in the URI. When `max_staleness` is set, reads
+    that may go to a secondary fall back to the primary whenever the
+    replication lag of any healthy secondary exceeds the bound, or
+    can not be determined. The lag is checked at most once every
+    `max_staleness / 2` seconds, so reads may be up to 1.5 times as
+    stale as the bound.
+
+    :param preferences: A dict mapping operation names, as listed in
+        `READ_OPERATIONS`, to read preference mode names, e.g.,
+        "secondaryPreferred".
+    :param max_staleness: Max replication lag, in seconds, tolerated
+        for reads from secondaries, or 0 for no bound.
+    :param status: A callable returning the output of the
+        replSetGetStatus command.
+    :raises: ValueError if an operation or mode is unknown
+    """
+
+    def __init__(self, preferences, max_staleness, status):
+        self._preferences = {}
+        for operation, mode in (preferences or {}).items():
+            if operation not in READ_OPERATIONS:
+                raise ValueError(_(u'Unknown read operation: {0}')
+                                 .format(operation))
+
+            self._preferences[operation] = _read_preference(mode)
+
+        self._max_staleness = max_staleness
+        self._check_interval = max_staleness / 2
+        self._status = status
+        self._lag = 0
+        self._checked_at = None
+
+    def get(self, operation):
+        """Returns the pymongo read preference for an operation.
+
+        :returns: A read preference, or None to use the default
+        """
+        preference = self._preferences.get(operation)
+
+        if (preference not in (None, _PRIMARY) and self._max_staleness and
+                self._replication_lag() > self._max_staleness):
+            return _PRIMARY
+
+        return preference
+
+    def options(self, operation):
+        """Returns keyword arguments for find() for an operation."""
+        preference = self.get(operation)
+        if preference is None:
+            return {}
+
+        return {'read_preference': preference}
+
+    def _replication_lag(self):
+        now = time.time()
+        if (self._checked_at is not None and
+                now - self._checked_at < self._check_interval):
+            return self._lag
+
+        try:
+            self._lag = _replication_lag(self._status())
+        except errors.PyMongoError as ex:
+            LOG.warning(_(u'Could not determine the replication lag, '
+                          u'reading from the primary: %s'), ex)
+            self._lag = float('inf')
+
+        self._checked_at = now
+        return self._lag
+
+
+# Classes of writes whose write concern may be configured
+WRITE_PROFILES = ('post', 'claim', 'delete', 'admin')
+
+# Write concern modes, and the keyword arguments that select them
+WRITE_MODES = {
+    'acknowledged': {'w': 1},
+    'unacknowledged': {'w': 0},
+    'journaled': {'w': 1, 'j': True},
+    'majority': {'w': 'majority'},
+}
+
+
+class WriteConcerns(object):
+    """Resolves the write concern to use for each class of writes.
+
+    Writes are grouped into profiles, as listed in `WRITE_PROFILES`:
+    posting messages, claiming and releasing them, deleting them,
+    and managing queues, pools and the catalogue. The number of
+    writes made under each profile, and the time they took, are
+    recorded in the driver's metrics as::
+
+        writes.<profile>.<mode>.count
+        writes.<profile>.<mode>.seconds
+
+    where the mode is "default" for writes that use the write
+    concern of the connection, e.g., as set in the URI.
+
+    :param profiles: A dict mapping profile names to mode names, as
+        listed in `WRITE_MODES`.
+    :param metrics: The driver's `marconi.common.metrics.Registry`
+    :raises: ValueError if a profile or mode is unknown
+    """
+
+    def __init__(self, profiles, metrics):
+        for profile, mode in (profiles or {}).items():
+            if profile not in WRITE_PROFILES:
+                raise ValueError(_(u'Unknown write profile: {0}')
+                                 .format(profile))
+
+            if mode not in WRITE_MODES:
+                raise ValueError(_(u'Unknown write concern mode: {0}')
+                                 .format(mode))
+
+        self._modes = dict(profiles or {})
+        self._metrics = metrics
+
+    @contextlib.contextmanager
+    def write(self, profile, default=None, needs_result=False):
+        """Times a block of writes, yielding the options to pass them.
+
+        :param profile: The profile the writes belong to
+        :param default: Mode to use if none is configured for the
+            profile, or None for the connection's default
+        :param needs_result: Whether the caller relies on the result
+            of the writes, e.g., the number of documents updated, in
+            which case an unacknowledged mode falls back to
+            acknowledged writes.
+        :returns: A context manager yielding a dict of keyword
+            arguments for insert(), update() and remove()
+        """
+        mode = self._modes.get(profile, default)
+        if mode == 'unacknowledged' and needs_result:
+            mode = 'acknowledged'
+
+        options = WRITE_MODES[mode] if mode else {}
+
+        with self._metrics.timed('writes.{0}.{1}'.format(
+                profile, mode or 'default')):
+            yield options
+
+
+def _read_preference(mode):
+    """Maps a read preference mode name to its pymongo constant."""
+
+    # E.g., "secondaryPreferred" -> "SECONDARY_PREFERRED"
+    name = ''.join('_' + c if c.isupper() else c for c in mode).upper()
+
+    try:
+        return getattr(read_preferences.ReadPreference, name)
+    except AttributeError:
+        raise ValueError(_(u'Unknown read preference: {0}').format(mode))
+
+
+def _replication_lag(status):
+    """Returns the max lag, in seconds, of any healthy secondary."""
+
+    members = status.get('members', [])
+    primaries = [m['optimeDate'] for m in members
+                 if m.get('stateStr') == 'PRIMARY']
+    secondaries = [m['optimeDate'] for m in members
+                   if m.get('stateStr') == 'SECONDARY' and m.get('health')]
+
+    if not secondaries:
+        # All reads go to the primary anyway
+        return 0
+
+    if not primaries:
+        return float('inf')
+
+    return max(timeutils.delta_seconds(optime, primaries[0])
+               for optime in secondaries)
+
+
+def instrumented_pool_class(metrics):
+    """Returns a pool class that records socket checkouts.
+
+    The class is given to the client as its `_pool_class`. It times
+    each call to `get_socket()`, which is where requests wait for a
+    socket once the pool is saturated. The following counters are
+    maintained:
+
+        pool.connects: Sockets opened by the pool
+        pool.in_use: Sockets currently checked out (a gauge)
+        pool.checkout.count: Sockets checked out so far
+        pool.checkout.seconds: Total time spent waiting for them
+        pool.checkout_failures: Requests that did not get a socket
+        pool.timeouts: ...because the wait queue timeout expired
+
+    :param metrics: The driver's `marconi.common.metrics.Registry`
+    """
+
+    # pymongo 2.x defines Pool as an old-style class on
+    # py2, so the base methods are called directly, not via super().
+    class InstrumentedPool(pool.Pool):
+
+        def connect(self):
+            sock_info = pool.Pool.connect(self)
+            metrics.incr('pool.connects')
+            return sock_info
+
+        def get_socket(self, *args, **kwargs):
+            start = time.time()
+            try:
+                sock_info = pool.Pool.get_socket(self, *args, **kwargs)
+            except errors.ConnectionFailure:
+                metrics.incr('pool.checkout_failures')
+
+                # The pool gives up waiting for a socket with a plain
+                # ConnectionFailure, so tell timeouts apart by how
+                # long the request waited.
+                timeout = getattr(self, 'wait_queue_timeout', None)
+                if timeout and time.time() - start >= timeout:
+                    metrics.incr('pool.timeouts')
+
+                raise
+
+            metrics.incr('pool.checkout.count')
+            metrics.incr('pool.checkout.seconds', time.time() - start)
+            metrics.incr('pool.in_use')
+            return sock_info
+
+        def maybe_return_socket(self, sock_info):
+            if sock_info:
+                metrics.incr('pool.in_use', -1)
+
+            pool.Pool.maybe_return_socket(self, sock_info)
+
+    return InstrumentedPool
+
+
 def to_oid(obj):
     """Creates a new ObjectId based on the input.
 
@@ -123,18 +522,33 @@ def to_oid(obj):
 def oid_ts(oid):
     """Converts an ObjectId to a UNIX timestamp.
 
+    The timestamp is read directly from the ObjectId's binary
+    representation, rather than going through `generation_time`,
+    which is comparatively slow since it builds a TZ-aware datetime.
+
     :raises: TypeError if oid isn't an ObjectId
     """
     try:
-        return timeutils.delta_seconds(EPOCH, oid.generation_time)
+        return _OID_TIMESTAMP.unpack_from(oid.binary)[0]
     except AttributeError:
         raise TypeError(u'Expected ObjectId and got %s' % type(oid))
 
 
+def oid_str_ts(oid_str):
+    """Converts the hex string form of an ObjectId to a UNIX timestamp.
+
+    Equivalent to `oid_ts(to_oid(oid_str))` for valid IDs, but without
+    creating an ObjectId.
+
+    :raises: ValueError if oid_str isn't a valid ObjectId string
+    """
+    return int(oid_str[:8], 16)
+
+
 def stat_message(message, now):
     """Creates a stat document from the given message, relative to now."""
     msg_id = message['id']
-    created = oid_ts(to_oid(msg_id))
+    created = oid_str_ts(msg_id)
     age = now - created
 
     return {
@@ -265,6 +679,11 @@ def retries_on_autoreconnect(func):
     This decorator catches MongoDB's AutoReconnect error and retries
     the function call.
 
+    Sleeps between attempts yield to other green threads, if any. If
+    the driver has a `circuit_breaker`, calls are rejected right away
+    while it is open. If the driver has `metrics`, the number of
+    retries and the time spent sleeping are recorded.
+
     .. Note::
        Assumes that the decorated function has defined self.driver.mongodb_conf
        so that `max_reconnect_attempts` and `reconnect_sleep` can be taken
@@ -280,46 +699,129 @@ def retries_on_autoreconnect(func):
         max_attemps = self.driver.mongodb_conf.max_reconnect_attempts
         sleep_sec = self.driver.mongodb_conf.reconnect_sleep
 
+        breaker = getattr(self.driver, 'circuit_breaker', None)
+        metrics = getattr(self.driver, 'metrics', None)
+
+        if breaker is not None and not breaker.allow():
+            if metrics is not None:
+                metrics.incr('breaker.rejected')
+
+            # Raise the storage error directly, rather than a
+            # pymongo one, so that outer calls do not retry it.
+            raise storage_errors.ConnectionError()
+
         last_ex = None
         for attempt in range(max_attemps):
             try:
-                return func(self, *args, **kwargs)
-                break
+                result = func(self, *args, **kwargs)
+
+                if breaker is not None:
+                    breaker.record_success()
+
+                return result
 
             except errors.AutoReconnect as ex:
                 LOG.warn(_(u'Caught AutoReconnect, retrying the '
                            'call to {0}').format(func))
 
                 last_ex = ex
-                time.sleep(sleep_sec * (2 ** attempt))
+
+                # No point in sleeping after the final attempt
+                if attempt + 1 < max_attemps:
+                    seconds = sleep_sec * (2 ** attempt)
+
+                    if metrics is not None:
+                        metrics.incr('retries.reconnect')
+                        metrics.incr('retries.reconnect.seconds', seconds)
+
+                    cooperative_sleep(seconds)
         else:
             LOG.error(_(u'Caught AutoReconnect, maximum attempts '
                         'to {0} exceeded.').format(func))
 
+            if breaker is not None and breaker.record_failure():
+                LOG.error(_(u'Opened the circuit breaker after repeated '
+                            'failures to reach the database.'))
+
+                if metrics is not None:
+                    metrics.incr('breaker.opened')
+
             raise last_ex
 
     return wrapper
 
 
-class HookedCursor(object):
+def denormalize_each(func):
+    """Adapts a function that denormalizes a single document.
+
+    :returns: A denormalizer for `BatchedCursor`
+    """
+    return lambda docs: [func(doc) for doc in docs]
+
+
+class BatchedCursor(object):
+    """Iterates over a cursor, denormalizing a batch at a time.
+
+    Documents are pulled from the cursor `batch_size` at a time,
+    which is also the batch size requested from the server when
+    `cursor` is a pymongo cursor, rather than, e.g., a list of
+    documents merged from several cursors. Each batch is then
+    denormalized by a single call.
+
+    :param cursor: An iterable of documents
+    :param denormalizer: A callable that takes a list of documents,
+        and returns the list of items to yield; see also
+        `denormalize_each()`
+    :param batch_size: Number of documents to pull from the cursor
+        and denormalize at a time, e.g., the limit of a listing.
+        Defaults to `CURSOR_BATCH_SIZE` when None or 0.
+    """
 
-    def __init__(self, cursor, denormalizer):
-        self.cursor = cursor
-        self.denormalizer = denormalizer
+    def __init__(self, cursor, denormalizer, batch_size=None):
+        batch_size = batch_size or CURSOR_BATCH_SIZE
 
-    def __getattr__(self, attr):
-        return getattr(self.cursor, attr)
+        if hasattr(cursor, 'batch_size'):
+            cursor.batch_size(batch_size)
+
+        self._documents = iter(cursor)
+        self._denormalizer = denormalizer
+        self._batch_size = batch_size
+        self._buffer = collections.deque()
 
     def __iter__(self):
         return self
 
     def __len__(self):
-        return self.cursor.count(True)
+        """Returns the number of items not yet iterated over.
+
+        Rather than asking the server for a count, pulls all the
+        remaining documents from the cursor, which is cheap since
+        the results of a listing are always either limited or
+        about to be iterated over anyway.
+        """
+        while self._fetch():
+            pass
+
+        return len(self._buffer)
 
     @raises_conn_error
+    def _fetch(self):
+        """Pulls and denormalizes the next batch of documents.
+
+        :returns: False once the cursor is exhausted
+        """
+        batch = list(itertools.islice(self._documents, self._batch_size))
+        if not batch:
+            return False
+
+        self._buffer.extend(self._denormalizer(batch))
+        return True
+
     def next(self):
-        item = next(self.cursor)
-        return self.denormalizer(item)
+        if not self._buffer and not self._fetch():
+            raise StopIteration
+
+        return self._buffer.popleft()
 
     def __next__(self):
         return self.next()
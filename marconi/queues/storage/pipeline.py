@@ -17,6 +17,7 @@ from stevedore import driver
 
 from marconi import common
 from marconi.common import decorators
+from marconi.common import metrics
 from marconi.i18n import _
 from marconi.openstack.common import log as logging
 from marconi.queues.storage import base
@@ -35,11 +36,21 @@ _PIPELINE_CONFIGS = tuple((
     for resource in _PIPELINE_RESOURCES
 ))
 
+_METRICS_OPTIONS = (
+    cfg.IntOpt('metrics_log_interval', default=0,
+               help=('Number of seconds between log messages that '
+                     'report the storage drivers\' counters at INFO '
+                     'level, such as claim contention, codec timings '
+                     'and connection pool usage. Counters only ever '
+                     'accumulate, so rates can be computed from two '
+                     'messages. Set to 0 to disable these messages.')),
+)
+
 _PIPELINE_GROUP = 'storage'
 
 
 def _config_options():
-    return [(_PIPELINE_GROUP, _PIPELINE_CONFIGS)]
+    return [(_PIPELINE_GROUP, _PIPELINE_CONFIGS + _METRICS_OPTIONS)]
 
 
 def _get_storage_pipeline(resource_name, conf):
@@ -96,9 +107,22 @@ class DataDriver(base.DataDriverBase):
         super(DataDriver, self).__init__(conf, None)
         self._storage = storage
 
+        self.conf.register_opts(_METRICS_OPTIONS, group=_PIPELINE_GROUP)
+        interval = self.conf[_PIPELINE_GROUP].metrics_log_interval
+        if interval > 0:
+            self._start_worker(metrics.Reporter(self.metrics_snapshot,
+                                                interval))
+
     def is_alive(self):
         return self._storage.is_alive()
 
+    def close_connection(self):
+        super(DataDriver, self).close_connection()
+        self._storage.close_connection()
+
+    def metrics_snapshot(self):
+        return self._storage.metrics_snapshot()
+
     @decorators.lazy_property(write=False)
     def queue_controller(self):
         stages = _get_storage_pipeline('queue', self.conf)
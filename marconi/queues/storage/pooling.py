@@ -16,6 +16,7 @@ import heapq
 import itertools
 
 from oslo.config import cfg
+import six
 
 from marconi.common import decorators
 from marconi.common.storage import select
@@ -70,6 +71,20 @@ class DataDriver(storage.DataDriverBase):
         super(DataDriver, self).__init__(conf, cache)
         self._pool_catalog = Catalog(conf, cache, control)
 
+    def close_connection(self):
+        """Closes the connection of every pool's driver loaded so far."""
+        super(DataDriver, self).close_connection()
+        self._pool_catalog.close()
+
+    def metrics_snapshot(self):
+        """Includes the counters of every pool's driver loaded so far.
+
+        These are prefixed with 'pools.<pool name>.'.
+        """
+        snapshot = super(DataDriver, self).metrics_snapshot()
+        snapshot.update(self._pool_catalog.metrics_snapshot())
+        return snapshot
+
     def is_alive(self):
         return all(self._pool_catalog.get_driver(pool['name']).is_alive()
                    for pool in
@@ -246,6 +261,37 @@ class MessageController(RoutingController):
                                 client_uuid=client_uuid)
         raise errors.QueueDoesNotExist(queue, project)
 
+    def post_many(self, batches, client_uuid, project=None):
+        # Group the batches by pool, so that each pool can post to
+        # all of its queues at once.
+        targets = {}
+        for queue, messages in six.iteritems(batches):
+            target = self._lookup(queue, project)
+            if not target:
+                raise errors.QueueDoesNotExist(queue, project)
+
+            targets.setdefault(id(target), (target, {}))[1][queue] = messages
+
+        # Pools are posted to in turn, so report what was posted to
+        # the others if one of them fails.
+        results = {}
+        for target, pool_batches in six.itervalues(targets):
+            control = target.message_controller
+            try:
+                results.update(control.post_many(pool_batches,
+                                                 client_uuid=client_uuid,
+                                                 project=project))
+            except errors.FanoutIncomplete as ex:
+                results.update(ex.succeeded_ids)
+                raise errors.FanoutIncomplete(project, results)
+            except Exception:
+                if not results:
+                    raise
+
+                raise errors.FanoutIncomplete(project, results)
+
+        return results
+
     def delete(self, queue, message_id, project=None, claim=None):
         target = self._lookup(queue, project)
         if target:
@@ -269,6 +315,14 @@ class MessageController(RoutingController):
             return control.pop(queue, project=project, limit=limit)
         return None
 
+    def wait(self, queue, project=None, since=None, timeout=0):
+        target = self._lookup(queue, project)
+        if target:
+            control = target.message_controller
+            return control.wait(queue, project=project,
+                                since=since, timeout=timeout)
+        return False
+
     def bulk_get(self, queue, message_ids, project=None):
         target = self._lookup(queue, project)
         if target:
@@ -279,14 +333,16 @@ class MessageController(RoutingController):
 
     def list(self, queue, project=None, marker=None,
              limit=storage.DEFAULT_MESSAGES_PER_PAGE,
-             echo=False, client_uuid=None, include_claimed=False):
+             echo=False, client_uuid=None, include_claimed=False,
+             include_body=True):
         target = self._lookup(queue, project)
         if target:
             control = target.message_controller
             return control.list(queue, project=project,
                                 marker=marker, limit=limit,
                                 echo=echo, client_uuid=client_uuid,
-                                include_claimed=include_claimed)
+                                include_claimed=include_claimed,
+                                include_body=include_body)
         return iter([[]])
 
     def get(self, queue, message_id, project=None):
@@ -458,6 +514,28 @@ class Catalog(object):
 
         return self.get_driver(pool_id)
 
+    def close(self):
+        """Closes the connections of the drivers loaded so far."""
+        drivers, self._drivers = self._drivers, {}
+
+        for driver in drivers.values():
+            driver.close_connection()
+
+    def metrics_snapshot(self):
+        """Returns the counters of the drivers loaded so far.
+
+        :returns: A dict of counters, each prefixed with
+            'pools.<pool name>.'
+        """
+        snapshot = {}
+
+        # Drivers may be loaded by other threads in the meantime
+        for pool_id, driver in list(self._drivers.items()):
+            for name, value in six.iteritems(driver.metrics_snapshot()):
+                snapshot['pools.%s.%s' % (pool_id, name)] = value
+
+        return snapshot
+
     def get_driver(self, pool_id):
         """Get storage driver, preferably cached, from a pool name.
 
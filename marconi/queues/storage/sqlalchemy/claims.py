@@ -14,7 +14,6 @@
 # limitations under the License.
 
 import sqlalchemy as sa
-from sqlalchemy.sql import func as sfunc
 
 from marconi.openstack.common import timeutils
 from marconi.queues import storage
@@ -33,11 +32,9 @@ class ClaimController(storage.Claim):
                              tables.Messages.c.ttl,
                              tables.Messages.c.created],
                             sa.and_(
-                                tables.Messages.c.ttl >
-                                utils.get_age(tables.Messages.c.created),
-                                # tables.Messages.c.ttl >
-                                # utils.get_age(tables.Claims.c.created),
-                                tables.Messages.c.cid == cid))
+                                tables.Messages.c.cid == cid,
+                                tables.Messages.c.expires >
+                                timeutils.utcnow_ts()))
 
         records = trans.execute(sel)
 
@@ -46,7 +43,7 @@ class ClaimController(storage.Claim):
                 'id': utils.msgid_encode(int(id)),
                 'ttl': ttl,
                 'age': (timeutils.utcnow() - created).seconds,
-                'body': utils.json_decode(body),
+                'body': utils.body_decode(body, self.driver.metrics),
             }
 
     def get(self, queue, claim_id, project=None):
@@ -57,16 +54,19 @@ class ClaimController(storage.Claim):
         if cid is None:
             raise errors.ClaimDoesNotExist(claim_id, queue, project)
 
+        try:
+            qid = utils.get_qid(self.driver, queue, project)
+        except errors.QueueDoesNotExist:
+            raise errors.ClaimDoesNotExist(claim_id, queue, project)
+
         with self.driver.trans() as trans:
             sel = sa.sql.select([tables.Claims.c.id,
                                  tables.Claims.c.ttl,
                                  tables.Claims.c.created],
-                                sa.and_(tables.Claims.c.ttl >
-                                        utils.get_age(tables.Claims.c.created),
+                                sa.and_(tables.Claims.c.expires >
+                                        timeutils.utcnow_ts(),
                                         tables.Claims.c.id == cid,
-                                        tables.Queues.c.project == project,
-                                        tables.Queues.c.name == queue),
-                                from_obj=[tables.Queues.join(tables.Claims)])
+                                        tables.Claims.c.qid == qid))
 
             res = trans.execute(sel).fetchone()
             if res is None:
@@ -92,23 +92,28 @@ class ClaimController(storage.Claim):
             except errors.QueueDoesNotExist:
                 return None, iter([])
 
-            # Clean up all expired claims in this queue
-            dlt = tables.Claims.delete().where(sa.and_(
-                tables.Claims.c.ttl <=
-                utils.get_age(tables.Claims.c.created),
-                tables.Claims.c.qid == qid))
-            trans.execute(dlt)
+            now = timeutils.utcnow_ts()
+
+            # Clean up all expired claims in this queue, unless the
+            # reaper is there to do it in the background.
+            if not self.driver.sqlalchemy_conf.reap_interval:
+                dlt = tables.Claims.delete().where(sa.and_(
+                    tables.Claims.c.qid == qid,
+                    tables.Claims.c.expires <= now))
+                trans.execute(dlt)
 
-            ins = tables.Claims.insert().values(qid=qid, ttl=metadata['ttl'])
+            ins = tables.Claims.insert().values(
+                qid=qid, ttl=metadata['ttl'],
+                expires=now + metadata['ttl'])
             res = trans.execute(ins)
 
             cid = res.lastrowid
 
-            and_stmt = sa.and_(tables.Messages.c.cid == (None),
-                               tables.Messages.c.ttl >
-                               sfunc.now() - tables.Messages.c.created,
-                               tables.Messages.c.qid == qid)
-            sel = sa.sql.select([tables.Messages.c.id], and_stmt).limit(limit)
+            and_stmt = sa.and_(tables.Messages.c.qid == qid,
+                               utils.unclaimed(qid, now),
+                               tables.Messages.c.expires > now)
+            sel = sa.sql.select([tables.Messages.c.id], and_stmt)
+            sel = sel.order_by(tables.Messages.c.id).limit(limit)
 
             records = [t[0] for t in trans.execute(sel)]
             and_stmt = sa.and_(tables.Messages.c.id.in_(records))
@@ -118,10 +123,12 @@ class ClaimController(storage.Claim):
             # NOTE(flaper87): I bet there's a better way
             # to do this.
             messages_ttl = metadata['ttl'] + metadata['grace']
-            update = (tables.Messages.update().values(ttl=messages_ttl).
+            messages_expires = now + messages_ttl
+            update = (tables.Messages.update().
+                      values(ttl=messages_ttl, expires=messages_expires).
                       where(sa.and_(
-                          tables.Messages.c.ttl < messages_ttl,
-                          tables.Messages.c.cid == cid)))
+                          tables.Messages.c.cid == cid,
+                          tables.Messages.c.expires < messages_expires)))
             trans.execute(update)
 
             return (utils.cid_encode(int(cid)), list(self.__get(cid, trans)))
@@ -134,28 +141,51 @@ class ClaimController(storage.Claim):
         if cid is None:
             raise errors.ClaimDoesNotExist(claim_id, queue, project)
 
-        age = utils.get_age(tables.Claims.c.created)
+        now = timeutils.utcnow_ts()
+        expires = now + metadata['ttl']
         with self.driver.trans() as trans:
             qid = utils.get_qid(self.driver, queue, project)
 
             update = tables.Claims.update().where(sa.and_(
-                tables.Claims.c.ttl > age,
+                tables.Claims.c.expires > now,
                 tables.Claims.c.id == cid,
-                tables.Claims.c.id == qid))
+                tables.Claims.c.qid == qid))
 
-            update = update.values(ttl=metadata['ttl'])
+            update = update.values(ttl=metadata['ttl'], expires=expires)
 
             res = trans.execute(update)
             if res.rowcount != 1:
                 raise errors.ClaimDoesNotExist(claim_id, queue, project)
 
             update = (tables.Messages.update().
-                      values(ttl=metadata['ttl']).
+                      values(ttl=metadata['ttl'], expires=expires).
                       where(sa.and_(
-                          tables.Messages.c.ttl < metadata['ttl'],
-                          tables.Messages.c.cid == cid)))
+                          tables.Messages.c.cid == cid,
+                          tables.Messages.c.expires < expires)))
             trans.execute(update)
 
+    def _reap_expired(self, limit):
+        """Deletes up to `limit` expired claims, from any queue.
+
+        Their messages are released first, rather than relying on
+        the database to enforce ON DELETE SET NULL.
+
+        :returns: The number of claims deleted
+        """
+        sel = sa.sql.select([tables.Claims.c.id],
+                            tables.Claims.c.expires <= timeutils.utcnow_ts())
+        sel = sel.order_by(tables.Claims.c.expires).limit(limit)
+
+        with self.driver.trans() as trans:
+            ids = [row[0] for row in trans.execute(sel)]
+            if ids:
+                trans.execute(tables.Messages.update().values(cid=None).
+                              where(tables.Messages.c.cid.in_(ids)))
+                trans.execute(tables.Claims.delete().where(
+                    tables.Claims.c.id.in_(ids)))
+
+        return len(ids)
+
     def delete(self, queue, claim_id, project=None):
         if project is None:
             project = ''
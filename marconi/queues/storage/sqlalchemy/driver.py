@@ -17,12 +17,42 @@ import contextlib
 import sqlalchemy as sa
 
 from marconi.common import decorators
+from marconi.i18n import _
+from marconi.openstack.common import log as logging
 from marconi.queues import storage
 from marconi.queues.storage.sqlalchemy import controllers
+from marconi.queues.storage.sqlalchemy import migration
 from marconi.queues.storage.sqlalchemy import options
+from marconi.queues.storage.sqlalchemy import reaper
 from marconi.queues.storage.sqlalchemy import tables
 from marconi.queues.storage.sqlalchemy import utils
 
+LOG = logging.getLogger(__name__)
+
+_MEMORY_URIS = ('sqlite://', 'sqlite:///:memory:')
+
+
+def _engine(conf, metrics):
+    """Creates an engine whose pool is configured and instrumented.
+
+    :param conf: The driver's config group
+    :param metrics: The driver's `marconi.common.metrics.Registry`
+    """
+    engine = sa.create_engine(conf.uri, **utils.pool_options(conf))
+    utils.PoolMonitor(metrics, conf.pool_pre_ping).listen(engine)
+    return engine
+
+
+def _execute(engine, metrics, statement):
+    # The connection goes back to the pool once the result has been
+    # read in full or closed.
+    conn = utils.connect(engine, metrics, close_with_result=True)
+    try:
+        return conn.execute(statement)
+    except Exception:
+        conn.close()
+        raise
+
 
 class DataDriver(storage.DataDriverBase):
 
@@ -30,10 +60,22 @@ class DataDriver(storage.DataDriverBase):
         super(DataDriver, self).__init__(conf, cache)
 
         opts = options.SQLALCHEMY_OPTIONS
+
+        # As with the mongodb driver, skip the options that were
+        # given by the pool catalogue when loaded dynamically. Pools
+        # with a sqlite:// URI register theirs under a group named
+        # after that scheme instead, in which case none were given.
+        if 'dynamic' in conf and options.SQLALCHEMY_GROUP in conf:
+            names = conf[options.SQLALCHEMY_GROUP].keys()
+            opts = filter(lambda x: x.name not in names, opts)
+
         self.conf.register_opts(opts,
                                 group=options.SQLALCHEMY_GROUP)
         self.sqlalchemy_conf = self.conf[options.SQLALCHEMY_GROUP]
 
+        self.qid_cache = utils.QidCache(self.sqlalchemy_conf.qid_cache_size,
+                                        self.metrics)
+
     def _sqlite_on_connect(self, conn, record):
         # NOTE(flaper87): This is necessary in order
         # to ensure FK are treated correctly by sqlite.
@@ -46,9 +88,9 @@ class DataDriver(storage.DataDriverBase):
         conn.query('SET time_zone = "+0:00"')
 
     @decorators.lazy_property(write=False)
-    def engine(self, *args, **kwargs):
+    def engine(self):
         uri = self.sqlalchemy_conf.uri
-        engine = sa.create_engine(uri, **kwargs)
+        engine = _engine(self.sqlalchemy_conf, self.metrics)
 
         # TODO(flaper87): Find a better way
         # to do this.
@@ -61,30 +103,32 @@ class DataDriver(storage.DataDriverBase):
                             self._mysql_on_connect)
 
         tables.metadata.create_all(engine, checkfirst=True)
-        return engine
 
-    # TODO(cpp-cabrera): expose connect/close as a context manager
-    # that acquires the connection to the DB for the desired scope and
-    # closes it once the operations are completed
-    @decorators.lazy_property(write=False)
-    def connection(self):
-        return self.engine.connect()
+        if not migration.is_current(engine):
+            LOG.warning(_(u'The database was created by an earlier '
+                          u'release and lacks columns or indexes this '
+                          u'driver relies on. Please run '
+                          u'"marconi-manage sqlalchemy-migrate".'))
+
+        return engine
 
     def close_connection(self):
-        self.connection.close()
+        """Stops the reaper, if any, and closes idle connections."""
+        super(DataDriver, self).close_connection()
+        self.engine.dispose()
 
     @contextlib.contextmanager
     def trans(self):
-        with self.engine.begin() as connection:
-            yield connection
+        with utils.connect(self.engine, self.metrics) as connection:
+            with connection.begin():
+                yield connection
 
     def run(self, statement):
-        """Performs a SQL query.
+        """Performs a SQL query on a connection from the pool.
 
-        :param sql: a query string with the '?' placeholders
-        :param args: the arguments to substitute the placeholders
+        :param statement: The statement to execute
         """
-        return self.connection.execute(statement)
+        return _execute(self.engine, self.metrics, statement)
 
     def get(self, statement):
         """Runs sql and returns the first entry in the results.
@@ -105,7 +149,18 @@ class DataDriver(storage.DataDriverBase):
 
     @decorators.lazy_property(write=False)
     def message_controller(self):
-        return controllers.MessageController(self)
+        controller = controllers.MessageController(self)
+
+        if self.sqlalchemy_conf.reap_interval > 0:
+            # Every thread gets its own in-memory database
+            if self.sqlalchemy_conf.uri in _MEMORY_URIS:
+                LOG.warning(_(u'The expiry reaper is not supported for '
+                              u'in-memory SQLite databases; disabling '
+                              u'it.'))
+            else:
+                self._start_worker(reaper.ExpiryReaper(self, controller))
+
+        return controller
 
     @decorators.lazy_property(write=False)
     def claim_controller(self):
@@ -124,20 +179,21 @@ class ControlDriver(storage.ControlDriverBase):
         self.sqlalchemy_conf = self.conf[options.SQLALCHEMY_GROUP]
 
     @decorators.lazy_property(write=False)
-    def engine(self, *args, **kwargs):
-        engine = sa.create_engine(self.sqlalchemy_conf.uri, **kwargs)
+    def engine(self):
+        engine = _engine(self.sqlalchemy_conf, self.metrics)
         tables.metadata.create_all(engine, checkfirst=True)
         return engine
 
-    # TODO(cpp-cabrera): expose connect/close as a context manager
-    # that acquires the connection to the DB for the desired scope and
-    # closes it once the operations are completed
-    @decorators.lazy_property(write=False)
-    def connection(self):
-        return self.engine.connect()
-
     def close_connection(self):
-        self.connection.close()
+        """Closes every connection in the pool that is not in use."""
+        self.engine.dispose()
+
+    def run(self, statement):
+        """Performs a SQL query on a connection from the pool.
+
+        :param statement: The statement to execute
+        """
+        return _execute(self.engine, self.metrics, statement)
 
     @property
     def pools_controller(self):
@@ -15,18 +15,86 @@
 
 import calendar
 
+import six
 import sqlalchemy as sa
 from sqlalchemy.sql import func as sfunc
 
 from marconi.openstack.common import timeutils
 from marconi.queues import storage
+from marconi.queues.storage import codecs
 from marconi.queues.storage import errors
 from marconi.queues.storage.sqlalchemy import tables
 from marconi.queues.storage.sqlalchemy import utils
 
+# Rows per multi-row INSERT, which keeps the number of bound
+# parameters well below SQLite's limit of 999.
+INSERT_CHUNK_SIZE = 100
+
+
+def _chunks(rows):
+    for start in six.moves.range(0, len(rows), INSERT_CHUNK_SIZE):
+        yield rows[start:start + INSERT_CHUNK_SIZE]
+
+
+def insert_returning(trans, rows):
+    """Inserts rows, getting their ids back through RETURNING."""
+    ids = []
+    for chunk in _chunks(rows):
+        ins = tables.Messages.insert().values(chunk)
+        ins = ins.returning(tables.Messages.c.id)
+        ids.extend(sorted(row[0] for row in trans.execute(ins)))
+
+    return ids
+
+
+def insert_contiguous(trans, rows):
+    """Inserts rows, deriving their ids from the last one inserted.
+
+    Only valid where the rows of a single INSERT are given consecutive
+    ids, as SQLite does while holding the database's write lock.
+    """
+    ids = []
+    for chunk in _chunks(rows):
+        last = trans.execute(tables.Messages.insert().values(chunk)).lastrowid
+        ids.extend(six.moves.range(last - len(chunk) + 1, last + 1))
+
+    return ids
+
+
+def insert_each(trans, rows):
+    """Inserts rows one at a time, which any database supports.
+
+    Used for MySQL, where the ids given to a multi-row INSERT are only
+    consecutive under some settings of innodb_autoinc_lock_mode.
+    """
+    ins = tables.Messages.insert()
+    return [trans.execute(ins, row).inserted_primary_key[0]
+            for row in rows]
+
+
+def insert_strategy(dialect):
+    """Returns the fastest way to insert rows and learn their ids."""
+    if not dialect.supports_multivalues_insert:
+        return insert_each
+
+    if dialect.implicit_returning:
+        return insert_returning
+
+    if dialect.name == 'sqlite':
+        return insert_contiguous
+
+    return insert_each
+
 
 class MessageController(storage.Message):
 
+    def __init__(self, *args, **kwargs):
+        super(MessageController, self).__init__(*args, **kwargs)
+
+        # Compresses large bodies at rest, if enabled for this pool
+        self._compressor = codecs.compressor_from_conf(
+            self.driver.sqlalchemy_conf, self.driver.metrics)
+
     def _get(self, queue, message_id, project, count=False):
 
         if project is None:
@@ -38,8 +106,7 @@ class MessageController(storage.Message):
             raise errors.MessageDoesNotExist(message_id, queue, project)
 
         try:
-            j = sa.join(tables.Messages, tables.Queues,
-                        tables.Messages.c.qid == tables.Queues.c.id)
+            qid = utils.get_qid(self.driver, queue, project)
 
             sel = sa.sql.select([tables.Messages.c.body,
                                  tables.Messages.c.ttl,
@@ -48,15 +115,13 @@ class MessageController(storage.Message):
             if count:
                 sel = sa.sql.select([sfunc.count(tables.Messages.c.id)])
 
-            sel = sel.select_from(j)
             sel = sel.where(sa.and_(tables.Messages.c.id == mid,
-                                    tables.Queues.c.project == project,
-                                    tables.Queues.c.name == queue,
-                                    tables.Messages.c.ttl >
-                                    sfunc.now() - tables.Messages.c.created))
+                                    tables.Messages.c.qid == qid,
+                                    tables.Messages.c.expires >
+                                    timeutils.utcnow_ts()))
 
             return self.driver.get(sel)
-        except utils.NoResult:
+        except (errors.QueueDoesNotExist, utils.NoResult):
             raise errors.MessageDoesNotExist(message_id, queue, project)
 
     def _exists(self, queue, message_id, project):
@@ -75,7 +140,7 @@ class MessageController(storage.Message):
             'id': message_id,
             'ttl': ttl,
             'age': now - calendar.timegm(created.timetuple()),
-            'body': utils.json_decode(body),
+            'body': utils.body_decode(body, self.driver.metrics),
         }
 
     def bulk_get(self, queue, message_ids, project):
@@ -86,30 +151,30 @@ class MessageController(storage.Message):
                        map(utils.msgid_decode, message_ids)
                        if id is not None]
 
+        try:
+            qid = utils.get_qid(self.driver, queue, project)
+        except errors.QueueDoesNotExist:
+            return
+
         statement = sa.sql.select([tables.Messages.c.id,
                                    tables.Messages.c.body,
                                    tables.Messages.c.ttl,
                                    tables.Messages.c.created])
 
+        now = timeutils.utcnow_ts()
         and_stmt = [tables.Messages.c.id.in_(message_ids),
-                    tables.Queues.c.name == queue,
-                    tables.Queues.c.project == project,
-                    tables.Messages.c.ttl >
-                    sfunc.now() - tables.Messages.c.created]
-
-        j = sa.join(tables.Messages, tables.Queues,
-                    tables.Messages.c.qid == tables.Queues.c.id)
+                    tables.Messages.c.qid == qid,
+                    tables.Messages.c.expires > now]
 
-        statement = statement.select_from(j).where(sa.and_(*and_stmt))
+        statement = statement.where(sa.and_(*and_stmt))
 
-        now = timeutils.utcnow_ts()
         records = self.driver.run(statement)
         for id, body, ttl, created in records:
             yield {
                 'id': utils.msgid_encode(int(id)),
                 'ttl': ttl,
                 'age': now - calendar.timegm(created.timetuple()),
-                'body': utils.json_decode(body),
+                'body': utils.body_decode(body, self.driver.metrics),
             }
 
     def first(self, queue, project=None, sort=1):
@@ -123,9 +188,9 @@ class MessageController(storage.Message):
                              tables.Messages.c.ttl,
                              tables.Messages.c.created],
                             sa.and_(
-                                tables.Messages.c.ttl >
-                                sfunc.now() - tables.Messages.c.created,
-                                tables.Messages.c.qid == qid))
+                                tables.Messages.c.qid == qid,
+                                tables.Messages.c.expires >
+                                timeutils.utcnow_ts()))
         if sort not in (1, -1):
             raise ValueError(u'sort must be either 1 (ascending) '
                              u'or -1 (descending)')
@@ -152,22 +217,31 @@ class MessageController(storage.Message):
 
     def list(self, queue, project, marker=None,
              limit=storage.DEFAULT_MESSAGES_PER_PAGE,
-             echo=False, client_uuid=None, include_claimed=False):
+             echo=False, client_uuid=None, include_claimed=False,
+             include_body=True):
 
         if project is None:
             project = ''
+
+        try:
+            qid = utils.get_qid(self.driver, queue, project)
+        except errors.QueueDoesNotExist:
+            # qid is never NULL, so this matches no messages at all
+            qid = None
+
         with self.driver.trans() as trans:
-            sel = sa.sql.select([tables.Messages.c.id,
-                                 tables.Messages.c.body,
-                                 tables.Messages.c.ttl,
-                                 tables.Messages.c.created])
+            columns = [tables.Messages.c.id,
+                       tables.Messages.c.ttl,
+                       tables.Messages.c.created]
 
-            j = sa.join(tables.Messages, tables.Queues,
-                        tables.Messages.c.qid == tables.Queues.c.id)
+            if include_body:
+                columns.append(tables.Messages.c.body)
 
-            sel = sel.select_from(j)
-            and_clause = [tables.Queues.c.name == queue,
-                          tables.Queues.c.project == project]
+            sel = sa.sql.select(columns)
+
+            now = timeutils.utcnow_ts()
+            and_clause = [tables.Messages.c.qid == qid,
+                          tables.Messages.c.expires > now]
 
             if not echo:
                 and_clause.append(tables.Messages.c.client != str(client_uuid))
@@ -185,25 +259,32 @@ class MessageController(storage.Message):
                     and_clause.append(tables.Messages.c.id < -1)
 
             if not include_claimed:
-                and_clause.append(tables.Messages.c.cid == (None))
+                and_clause.append(utils.unclaimed(qid, now))
 
             sel = sel.where(sa.and_(*and_clause))
-            sel = sel.limit(limit)
+            sel = sel.order_by(tables.Messages.c.id).limit(limit)
 
             records = trans.execute(sel)
             marker_id = {}
 
             def it():
                 now = timeutils.utcnow_ts()
-                for id, body, ttl, created in records:
+                metrics = self.driver.metrics
+                for record in records:
+                    id, ttl, created = record[:3]
                     marker_id['next'] = id
-                    yield {
+                    message = {
                         'id': utils.msgid_encode(id),
                         'ttl': ttl,
                         'age': now - calendar.timegm(created.timetuple()),
-                        'body': utils.json_decode(body),
                     }
 
+                    if include_body:
+                        message['body'] = utils.body_decode(record[3],
+                                                            metrics)
+
+                    yield message
+
             yield it()
             yield utils.marker_encode(marker_id['next'])
 
@@ -212,34 +293,53 @@ class MessageController(storage.Message):
             project = ''
 
         with self.driver.trans() as trans:
-            qid = utils.get_qid(self.driver, queue, project)
+            return self._insert(trans, queue, messages, client_uuid,
+                                project)
 
-            # TODO(kgriffs): Need to port this to sqla! Bug #1331228
-            #
-            # cleanup all expired messages in this queue
-            # self.driver.run('''
-            #     delete from Messages
-            #      where ttl <= julianday() * 86400.0 - created
-            #        and qid = ?''', qid)
-
-            # executemany() sets lastrowid to None, so no matter we manually
-            # generate the IDs or not, we still need to query for it.
+    def post_many(self, batches, client_uuid, project=None):
+        if project is None:
+            project = ''
 
-            def it():
-                for m in messages:
-                    yield dict(qid=qid,
-                               ttl=m['ttl'],
-                               body=utils.json_encode(m['body']),
-                               client=str(client_uuid))
+        # All or nothing: a queue that does not exist rolls back the
+        # messages posted to the others.
+        with self.driver.trans() as trans:
+            return dict((queue, self._insert(trans, queue, messages,
+                                             client_uuid, project))
+                        for queue, messages in six.iteritems(batches))
 
-            result = trans.execute(tables.Messages.insert(), list(it()))
+    def _insert(self, trans, queue, messages, client_uuid, project):
+        """Inserts messages as part of the given transaction.
 
-            statement = sa.sql.select([tables.Messages.c.id])
-            statement = statement.limit(result.rowcount)
-            statement = statement.order_by(tables.Messages.c.id.desc())
-            result = trans.execute(statement).fetchall()
+        :returns: List of message ids
+        :raises: QueueDoesNotExist
+        """
+        qid = utils.get_qid(self.driver, queue, project)
 
-        return [utils.msgid_encode(i[0]) for i in reversed(result)]
+        # TODO(kgriffs): Need to port this to sqla! Bug #1331228
+        #
+        # cleanup all expired messages in this queue
+        # self.driver.run('''
+        #     delete from Messages
+        #      where ttl <= julianday() * 86400.0 - created
+        #        and qid = ?''', qid)
+
+        # Every column is given explicitly, since multi-row INSERTs
+        # do not apply Python-side column defaults to each row.
+        created = timeutils.utcnow()
+        now = calendar.timegm(created.timetuple())
+        client = str(client_uuid)
+
+        rows = [dict(qid=qid,
+                     ttl=m['ttl'],
+                     expires=now + m['ttl'],
+                     body=utils.body_encode(m['body'], self._compressor),
+                     client=client,
+                     created=created,
+                     cid=None)
+                for m in messages]
+
+        insert_rows = insert_strategy(trans.dialect)
+        return [utils.msgid_encode(id) for id in insert_rows(trans, rows)]
 
     def delete(self, queue, message_id, project, claim=None):
         if project is None:
@@ -266,7 +366,11 @@ class MessageController(storage.Message):
             if claim and cid is None:
                 return
 
-            and_stmt.append(tables.Messages.c.cid == cid)
+            if cid is None:
+                qid = utils.get_qid(self.driver, queue, project)
+                and_stmt.append(utils.unclaimed(qid, timeutils.utcnow_ts()))
+            else:
+                and_stmt.append(tables.Messages.c.cid == cid)
 
             statement = statement.where(sa.and_(*and_stmt))
             res = trans.execute(statement)
@@ -274,6 +378,24 @@ class MessageController(storage.Message):
             if res.rowcount == 0:
                 raise errors.MessageIsClaimed(mid)
 
+    def _reap_expired(self, limit):
+        """Deletes up to `limit` expired messages, from any queue.
+
+        :returns: The number of messages deleted
+        """
+        sel = sa.sql.select([tables.Messages.c.id],
+                            tables.Messages.c.expires <=
+                            timeutils.utcnow_ts())
+        sel = sel.order_by(tables.Messages.c.expires).limit(limit)
+
+        with self.driver.trans() as trans:
+            ids = [row[0] for row in trans.execute(sel)]
+            if ids:
+                trans.execute(tables.Messages.delete().where(
+                    tables.Messages.c.id.in_(ids)))
+
+        return len(ids)
+
     def bulk_delete(self, queue, message_ids, project):
         if project is None:
             project = ''
@@ -298,26 +420,23 @@ class MessageController(storage.Message):
         if project is None:
             project = ''
 
+        qid = utils.get_qid(self.driver, queue_name, project)
+
         with self.driver.trans() as trans:
             sel = sa.sql.select([tables.Messages.c.id,
                                  tables.Messages.c.body,
                                  tables.Messages.c.ttl,
                                  tables.Messages.c.created])
 
-            j = sa.join(tables.Messages, tables.Queues,
-                        tables.Messages.c.qid == tables.Queues.c.id)
-
-            sel = sel.select_from(j)
-            and_clause = [tables.Queues.c.name == queue_name,
-                          tables.Queues.c.project == project]
-
-            and_clause.append(tables.Messages.c.cid == (None))
+            now = timeutils.utcnow_ts()
+            and_clause = [tables.Messages.c.qid == qid,
+                          tables.Messages.c.expires > now,
+                          utils.unclaimed(qid, now)]
 
             sel = sel.where(sa.and_(*and_clause))
             sel = sel.limit(limit)
 
             records = trans.execute(sel)
-            now = timeutils.utcnow_ts()
             messages = []
             message_ids = []
             for id, body, ttl, created in records:
@@ -325,14 +444,12 @@ class MessageController(storage.Message):
                     'id': utils.msgid_encode(id),
                     'ttl': ttl,
                     'age': now - calendar.timegm(created.timetuple()),
-                    'body': utils.json_decode(body),
+                    'body': utils.body_decode(body, self.driver.metrics),
                 })
                 message_ids.append(id)
 
             statement = tables.Messages.delete()
 
-            qid = utils.get_qid(self.driver, queue_name, project)
-
             and_stmt = [tables.Messages.c.id.in_(message_ids),
                         tables.Messages.c.qid == qid]
 
@@ -0,0 +1,122 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Brings databases created by earlier releases up to date.
+
+`metadata.create_all()` creates missing tables, but never alters the
+ones that already exist. The changes below are applied in place
+instead, and are safe to apply more than once:
+
+- The `expires` column of Messages and Claims is added, and filled in
+  from each row's `created` and `ttl`.
+- The indexes declared in `tables` are created.
+"""
+
+import calendar
+
+import sqlalchemy as sa
+
+from marconi.queues.storage.sqlalchemy import tables
+
+# Number of rows whose expiration is filled in per transaction
+BACKFILL_BATCH_SIZE = 1000
+
+_EXPIRING_TABLES = (tables.Messages, tables.Claims)
+
+
+def _missing_columns(inspector, table):
+    names = set(c['name'] for c in inspector.get_columns(table.name))
+    return [c for c in table.columns if c.name not in names]
+
+
+def _missing_indexes(inspector, table):
+    names = set(i['name'] for i in inspector.get_indexes(table.name))
+    return [i for i in table.indexes if i.name not in names]
+
+
+def is_current(engine):
+    """Returns True if the database needs no migration."""
+    inspector = sa.inspect(engine)
+
+    for table in _EXPIRING_TABLES:
+        if (_missing_columns(inspector, table) or
+                _missing_indexes(inspector, table)):
+            return False
+
+    return True
+
+
+def _add_column(engine, table, column):
+    preparer = engine.dialect.identifier_preparer
+    engine.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+        preparer.format_table(table),
+        preparer.quote(column.name),
+        column.type.compile(dialect=engine.dialect)))
+
+
+def _backfill_expires(engine, table):
+    """Sets `expires` on the rows that lack it, one batch at a time.
+
+    :returns: The number of rows updated
+    """
+    sel = sa.sql.select([table.c.id, table.c.ttl, table.c.created],
+                        table.c.expires == (None))
+    sel = sel.limit(BACKFILL_BATCH_SIZE)
+
+    update = table.update().where(table.c.id == sa.bindparam('_id'))
+    update = update.values(expires=sa.bindparam('_expires'))
+
+    total = 0
+    while True:
+        with engine.begin() as trans:
+            rows = trans.execute(sel).fetchall()
+            if not rows:
+                return total
+
+            # Rows without a ttl can not have been live; they expire
+            # as soon as they were created.
+            trans.execute(update, [
+                {'_id': id,
+                 '_expires': calendar.timegm(created.timetuple()) + (ttl or 0)}
+                for id, ttl, created in rows
+            ])
+
+        total += len(rows)
+
+
+def upgrade(engine):
+    """Applies every pending change to the database.
+
+    :returns: A list of messages describing the changes made
+    """
+    tables.metadata.create_all(engine, checkfirst=True)
+    inspector = sa.inspect(engine)
+    changes = []
+
+    for table in _EXPIRING_TABLES:
+        for column in _missing_columns(inspector, table):
+            _add_column(engine, table, column)
+            changes.append('Added column {0}.{1}'.format(table.name,
+                                                         column.name))
+
+        count = _backfill_expires(engine, table)
+        if count:
+            changes.append('Set the expiration of {0} rows in {1}'.format(
+                count, table.name))
+
+        for index in _missing_indexes(inspector, table):
+            index.create(engine)
+            changes.append('Created index {0}'.format(index.name))
+
+    return changes
@@ -17,6 +17,79 @@ from oslo.config import cfg
 SQLALCHEMY_OPTIONS = (
     cfg.StrOpt('uri', default='sqlite:///:memory:',
                help='An sqlalchemy URL'),
+
+    cfg.StrOpt('body_codec', default=None,
+               help=('Name of the codec used to compress message bodies '
+                     'at rest, e.g., "zlib". Other codecs may be '
+                     'registered under the '
+                     '"marconi.queues.storage.codecs" entry point '
+                     'namespace. Bodies are only decompressed when '
+                     'they are returned to clients. Compressed bodies '
+                     'remain readable after the codec is changed or '
+                     'unset (the default).')),
+
+    cfg.IntOpt('body_compression_threshold', default=1024,
+               help=('Bodies that are smaller than this many bytes, once '
+                     'serialized, are stored uncompressed.')),
+
+    # The pool options below only apply to databases served through a
+    # connection pool, which SQLite databases are not.
+    cfg.IntOpt('pool_size', default=0,
+               help=('Number of connections kept open in the pool. '
+                     'Set to 0 to use the library default of 5.')),
+
+    cfg.IntOpt('max_overflow', default=-1,
+               help=('Number of connections that may be opened beyond '
+                     '``pool_size`` while all of the pooled ones are in '
+                     'use; they are closed once returned. Set to 0 to '
+                     'allow no overflow, or -1 to use the library '
+                     'default of 10.')),
+
+    cfg.IntOpt('pool_timeout', default=0,
+               help=('Seconds to wait for a connection to be returned to '
+                     'a saturated pool before failing with a connection '
+                     'error. Set to 0 to use the library default of '
+                     '30.')),
+
+    cfg.IntOpt('pool_recycle', default=0,
+               help=('Seconds after which a connection is replaced when it '
+                     'is next checked out, e.g., to stay below MySQL\'s '
+                     'wait_timeout. Set to 0 to never recycle '
+                     'connections.')),
+
+    cfg.BoolOpt('pool_pre_ping', default=False,
+                help=('Test each connection with a lightweight query as it '
+                      'is checked out, replacing it if the database has '
+                      'closed it, at the cost of one round trip per '
+                      'checkout.')),
+
+    cfg.IntOpt('qid_cache_size', default=1000,
+               help=('Number of queue ids to keep in memory, keyed by '
+                     'project and queue name, saving a lookup of the '
+                     'Queues table on most operations. Entries are '
+                     'dropped, least recently used first, once the '
+                     'cache is full, and are refreshed after a few '
+                     'seconds so that queues deleted by other '
+                     'processes are noticed. Set to 0 to disable '
+                     'the cache.')),
+
+    cfg.IntOpt('reap_interval', default=0,
+               help=('Run a background thread that, every this many '
+                     'seconds, deletes expired messages and claims, '
+                     'which are otherwise only hidden from reads, and '
+                     'releases the messages of expired claims. While '
+                     'enabled, claiming messages no longer deletes '
+                     'expired claims inline. Not supported for '
+                     'in-memory SQLite databases. Set to 0 (the '
+                     'default) to disable.')),
+
+    cfg.IntOpt('reap_batch_size', default=100,
+               help=('Maximum number of messages or claims deleted by '
+                     'the reaper in a single statement.')),
+
+    cfg.FloatOpt('reap_batch_delay', default=0.1,
+                 help=('Seconds for the reaper to pause between '
+                       'batches, to limit its impact on the database.')),
 )
 
 SQLALCHEMY_GROUP = 'drivers:storage:sqlalchemy'
@@ -35,11 +35,6 @@ from marconi.queues.storage.sqlalchemy import utils
 
 class PoolsController(base.PoolsBase):
 
-    def __init__(self, *args, **kwargs):
-        super(PoolsController, self).__init__(*args, **kwargs)
-
-        self._conn = self.driver.connection
-
     @utils.raises_conn_error
     def list(self, marker=None, limit=10, detailed=False):
         marker = marker or ''
@@ -52,7 +47,7 @@ class PoolsController(base.PoolsBase):
         )
         if limit > 0:
             stmt = stmt.limit(limit)
-        cursor = self._conn.execute(stmt)
+        cursor = self.driver.run(stmt)
 
         normalizer = functools.partial(_normalize, detailed=detailed)
         return (normalizer(v) for v in cursor)
@@ -63,7 +58,7 @@ class PoolsController(base.PoolsBase):
             tables.Pools.c.name == name
         )
 
-        pool = self._conn.execute(stmt).fetchone()
+        pool = self.driver.run(stmt).first()
         if pool is None:
             raise errors.PoolDoesNotExist(name)
 
@@ -78,7 +73,7 @@ class PoolsController(base.PoolsBase):
             stmt = sa.sql.expression.insert(tables.Pools).values(
                 name=name, weight=weight, uri=uri, options=opts
             )
-            self._conn.execute(stmt)
+            self.driver.run(stmt)
 
         except sa.exc.IntegrityError:
             # TODO(cpp-cabrera): merge update/create into a single
@@ -91,7 +86,7 @@ class PoolsController(base.PoolsBase):
         stmt = sa.sql.select([tables.Pools.c.name]).where(
             tables.Pools.c.name == name
         ).limit(1)
-        return self._conn.execute(stmt).fetchone() is not None
+        return self.driver.run(stmt).first() is not None
 
     @utils.raises_conn_error
     def update(self, name, **kwargs):
@@ -110,7 +105,7 @@ class PoolsController(base.PoolsBase):
         stmt = sa.sql.update(tables.Pools).where(
             tables.Pools.c.name == name).values(**fields)
 
-        res = self._conn.execute(stmt)
+        res = self.driver.run(stmt)
         if res.rowcount == 0:
             raise errors.PoolDoesNotExist(name)
 
@@ -119,12 +114,12 @@ class PoolsController(base.PoolsBase):
         stmt = sa.sql.expression.delete(tables.Pools).where(
             tables.Pools.c.name == name
         )
-        self._conn.execute(stmt)
+        self.driver.run(stmt)
 
     @utils.raises_conn_error
     def drop_all(self):
         stmt = sa.sql.expression.delete(tables.Pools)
-        self._conn.execute(stmt)
+        self.driver.run(stmt)
 
 
 def _normalize(pool, detailed=False):
@@ -13,8 +13,8 @@
 # the License.
 
 import sqlalchemy as sa
-from sqlalchemy.sql import func as sfunc
 
+from marconi.openstack.common import timeutils
 from marconi.queues import storage
 from marconi.queues.storage import errors
 from marconi.queues.storage.sqlalchemy import tables
@@ -79,6 +79,11 @@ class QueueController(storage.Queue):
         except sa.exc.IntegrityError:
             return False
 
+        # Replaces any entry left over from a queue of the same name
+        # that was deleted by another process.
+        self.driver.qid_cache.set(project, name,
+                                  res.inserted_primary_key[0])
+
         return res.rowcount == 1
 
     def exists(self, name, project):
@@ -121,24 +126,25 @@ class QueueController(storage.Queue):
             tables.Queues.c.name == name))
         self.driver.run(dlt)
 
+        self.driver.qid_cache.purge(project, name)
+
     def stats(self, name, project):
         if project is None:
             project = ''
 
         qid = utils.get_qid(self.driver, name, project)
+        now = timeutils.utcnow_ts()
         sel = sa.sql.select([
             sa.sql.select([sa.func.count(tables.Messages.c.id)],
                           sa.and_(
                               tables.Messages.c.qid == qid,
-                              tables.Messages.c.cid != (None),
-                              tables.Messages.c.ttl >
-                              sfunc.now() - tables.Messages.c.created)),
+                              sa.not_(utils.unclaimed(qid, now)),
+                              tables.Messages.c.expires > now)),
             sa.sql.select([sa.func.count(tables.Messages.c.id)],
                           sa.and_(
                               tables.Messages.c.qid == qid,
-                              tables.Messages.c.cid == (None),
-                              tables.Messages.c.ttl >
-                              sfunc.now() - tables.Messages.c.created))
+                              utils.unclaimed(qid, now),
+                              tables.Messages.c.expires > now))
         ])
 
         claimed, free = self.driver.get(sel)
@@ -0,0 +1,63 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Deletes expired messages and claims in the background."""
+
+from marconi.common import workers
+
+
+class ExpiryReaper(workers.PeriodicWorker):
+    """Background thread that deletes expired messages and claims.
+
+    Every `reap_interval` seconds, deletes expired claims, releasing
+    their messages, and then expired messages, in batches of up to
+    `reap_batch_size` rows, pausing for `reap_batch_delay` seconds
+    between batches, until none are left. Expired rows are found
+    through the indexes on the expires column. See also
+    `ClaimController._reap_expired()` and
+    `MessageController._reap_expired()`.
+
+    The number of rows deleted is recorded in the driver's metrics
+    as "reaper.claims" and "reaper.messages", and the time spent per
+    pass under "reaper.pass".
+
+    :param driver: The SQLAlchemy data driver
+    :param message_controller: The driver's message controller
+    """
+
+    def __init__(self, driver, message_controller):
+        conf = driver.sqlalchemy_conf
+        super(ExpiryReaper, self).__init__(
+            'marconi-expiry-reaper', driver.metrics, conf.reap_interval,
+            batch_size=conf.reap_batch_size,
+            batch_delay=conf.reap_batch_delay,
+            timer='reaper.pass')
+
+        self._driver = driver
+        self._controller = message_controller
+
+    def run_once(self):
+        """Makes a single pass over the claims and then the messages.
+
+        Claims go first, so that messages whose claim expired are
+        released even if they are not yet due for deletion.
+
+        :returns: The number of claims and messages deleted, as a tuple
+        """
+        claims = self.drain(self._driver.claim_controller._reap_expired,
+                            'reaper.claims')
+        messages = self.drain(self._controller._reap_expired,
+                              'reaper.messages')
+
+        return claims, messages
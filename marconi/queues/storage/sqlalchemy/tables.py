@@ -33,6 +33,15 @@ Messages = sa.Table('Messages', metadata,
                               default=now, onupdate=now),
                     sa.Column('cid', sa.INTEGER,
                               sa.ForeignKey("Claims.id", ondelete='SET NULL')),
+
+                    # UNIX timestamp after which the message is gone;
+                    # stored, rather than derived from ttl and created,
+                    # so that expiry checks can be served by an index.
+                    sa.Column('expires', sa.INTEGER),
+                    sa.Index('Messages_qid_cid_expires_id',
+                             'qid', 'cid', 'expires', 'id'),
+                    sa.Index('Messages_cid_expires', 'cid', 'expires'),
+                    sa.Index('Messages_expires', 'expires'),
                     )
 
 
@@ -45,6 +54,9 @@ Claims = sa.Table('Claims', metadata,
                   sa.Column('ttl', sa.INTEGER),
                   sa.Column('created', sa.TIMESTAMP,
                             default=now, onupdate=now),
+                  sa.Column('expires', sa.INTEGER),
+                  sa.Index('Claims_qid_expires', 'qid', 'expires'),
+                  sa.Index('Claims_expires', 'expires'),
                   )
 
 
@@ -13,15 +13,19 @@
 # License for the specific language governing permissions and limitations under
 # the License.
 
+import collections
 import functools
+import threading
+import time
 
 import sqlalchemy as sa
 from sqlalchemy import exc
-from sqlalchemy.sql import func as sfunc
 
 from marconi.openstack.common import jsonutils
 from marconi.openstack.common import log as logging
 from marconi.openstack.common import strutils
+from marconi.openstack.common import timeutils
+from marconi.queues.storage import codecs
 from marconi.queues.storage import errors
 from marconi.queues.storage.sqlalchemy import tables
 
@@ -53,18 +57,196 @@ class NoResult(Exception):
     pass
 
 
+def pool_options(conf):
+    """Returns `create_engine()` arguments for the configured pool.
+
+    SQLite databases are not served through a `QueuePool`, which is
+    the only pool class that accepts these arguments, so none are
+    returned for them.
+
+    :param conf: The driver's config group
+    """
+    if conf.uri.startswith('sqlite://'):
+        return {}
+
+    kwargs = {}
+    if conf.pool_size:
+        kwargs['pool_size'] = conf.pool_size
+
+    if conf.max_overflow >= 0:
+        kwargs['max_overflow'] = conf.max_overflow
+
+    if conf.pool_timeout:
+        kwargs['pool_timeout'] = conf.pool_timeout
+
+    if conf.pool_recycle:
+        kwargs['pool_recycle'] = conf.pool_recycle
+
+    return kwargs
+
+
+class PoolMonitor(object):
+    """Records connection pool events in the driver's metrics.
+
+    Counters and gauges recorded:
+
+        pool.connects: New connections opened by the pool
+        pool.in_use: Connections currently checked out (gauge)
+        pool.stale: Connections found dead by the pre-ping, if enabled
+
+    The time spent waiting for a connection is recorded separately,
+    by `connect()`.
+
+    :param metrics: The driver's `marconi.common.metrics.Registry`
+    :param pre_ping: Whether to test connections as they are
+        checked out, replacing those the database has closed.
+    """
+
+    def __init__(self, metrics, pre_ping=False):
+        self._metrics = metrics
+        self._pre_ping = pre_ping
+
+    def listen(self, engine):
+        sa.event.listen(engine, 'connect', self._on_connect)
+        sa.event.listen(engine, 'checkout', self._on_checkout)
+        sa.event.listen(engine, 'checkin', self._on_checkin)
+
+    def _on_connect(self, dbapi_conn, record):
+        self._metrics.incr('pool.connects')
+
+    def _on_checkout(self, dbapi_conn, record, proxy):
+        if self._pre_ping:
+            cursor = dbapi_conn.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            except Exception:
+                # The pool retries the checkout with a new connection
+                self._metrics.incr('pool.stale')
+                raise exc.DisconnectionError()
+            finally:
+                cursor.close()
+
+        self._metrics.incr('pool.in_use')
+
+    def _on_checkin(self, dbapi_conn, record):
+        self._metrics.incr('pool.in_use', -1)
+
+
+def connect(engine, metrics, **kwargs):
+    """Checks out a connection from the engine's pool.
+
+    The time spent waiting is recorded in `metrics`, as
+    pool.checkout.count and pool.checkout.seconds. Checkouts that
+    time out are counted as pool.timeouts.
+
+    :param kwargs: Passed on to `engine.connect()`
+    :raises: ConnectionError if the pool remained saturated
+    """
+    start = time.time()
+    try:
+        conn = engine.connect(**kwargs)
+    except exc.TimeoutError as ex:
+        metrics.incr('pool.timeouts')
+        LOG.exception(ex)
+        raise errors.ConnectionError()
+
+    metrics.incr('pool.checkout.count')
+    metrics.incr('pool.checkout.seconds', time.time() - start)
+    return conn
+
+
+# Seconds for which a queue id may be served from the cache. Another
+# process may delete a queue, and possibly re-create it under a new id,
+# without this driver knowing; until the entry expires, operations on
+# that queue fail or, for reads, come back empty. Deletions made
+# through this driver invalidate the entry right away.
+QID_CACHE_TTL = 5
+
+
+class QidCache(object):
+    """Bounded map of (project, queue name) to queue id.
+
+    Once full, the least recently used entry is evicted to make room
+    for a new one. Hits and misses are recorded in the driver's
+    metrics, as qid_cache.hits and qid_cache.misses.
+
+    :param size: Maximum number of entries; 0 disables the cache
+    :param metrics: The driver's `marconi.common.metrics.Registry`
+    """
+
+    def __init__(self, size, metrics):
+        self._size = size
+        self._metrics = metrics
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, project, queue):
+        """Returns the cached queue id, or None."""
+        if not self._size:
+            return None
+
+        key = (project, queue)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[1] > timeutils.utcnow_ts():
+                # Re-inserting marks the entry as the most recently used
+                self._entries[key] = entry
+                self._metrics.incr('qid_cache.hits')
+                return entry[0]
+
+        self._metrics.incr('qid_cache.misses')
+        return None
+
+    def set(self, project, queue, qid):
+        if not self._size:
+            return
+
+        expires = timeutils.utcnow_ts() + QID_CACHE_TTL
+        with self._lock:
+            self._entries.pop((project, queue), None)
+            while len(self._entries) >= self._size:
+                self._entries.popitem(last=False)
+
+            self._entries[(project, queue)] = (qid, expires)
+
+    def purge(self, project, queue):
+        with self._lock:
+            self._entries.pop((project, queue), None)
+
+
 def get_qid(driver, queue, project):
+    qid = driver.qid_cache.get(project, queue)
+    if qid is not None:
+        return qid
+
     sel = sa.sql.select([tables.Queues.c.id], sa.and_(
                         tables.Queues.c.project == project,
                         tables.Queues.c.name == queue))
     try:
-        return driver.get(sel)[0]
+        qid = driver.get(sel)[0]
     except NoResult:
         raise errors.QueueDoesNotExist(queue, project)
 
+    driver.qid_cache.set(project, queue, qid)
+    return qid
+
+
+def unclaimed(qid, now):
+    """Returns a clause matching the queue's unclaimed messages.
+
+    Messages whose claim has expired count as unclaimed, whether or
+    not the claim has been deleted yet.
+
+    :param qid: The queue's id
+    :param now: The current time, as a UNIX timestamp
+    """
+    expired = sa.sql.select([tables.Claims.c.id],
+                            sa.and_(tables.Claims.c.qid == qid,
+                                    tables.Claims.c.expires <= now))
+
+    return sa.or_(tables.Messages.c.cid == (None),
+                  tables.Messages.c.cid.in_(expired))
 
-def get_age(created):
-    return sfunc.now() - created
 
 # The utilities below make the database IDs opaque to the users
 # of Marconi API.  The only purpose is to advise the users NOT to
@@ -133,3 +315,22 @@ def json_encode(obj):
 
 def json_decode(binary):
     return jsonutils.loads(binary, 'utf-8')
+
+
+def body_encode(body, compressor=None):
+    """Serializes a message body, compressing it if enabled."""
+    data = json_encode(body)
+    if compressor is None:
+        return data
+
+    return compressor.compress(data)
+
+
+def body_decode(binary, metrics=None):
+    """Deserializes a message body, decompressing it if needed.
+
+    :param binary: The body as stored
+    :param metrics: (Default None) The driver's metrics registry, in
+        which to record the time spent decompressing the body
+    """
+    return json_decode(codecs.decompress(binary, metrics))
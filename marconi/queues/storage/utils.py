@@ -44,7 +44,16 @@ def dynamic_conf(uri, options):
 
     # NOTE(cpp-cabrera): parse storage-specific opts:
     # 'drivers:storage:{type}'
-    storage_opts = utils.dict_to_conf({'uri': uri, 'options': options})
+    storage_opts = {'uri': uri, 'options': options}
+
+    # Pool options that are not None are also given as regular driver
+    # options, e.g., so that each pool can be sized independently.
+    # Drivers skip registering their own defaults for these.
+    for name, value in six.iteritems(options or {}):
+        if name not in storage_opts and value is not None:
+            storage_opts[name] = value
+
+    storage_opts = utils.dict_to_conf(storage_opts)
     storage_group = u'drivers:storage:%s' % storage_type
 
     # NOTE(cpp-cabrera): register those options!
@@ -16,6 +16,7 @@
 import re
 
 from oslo.config import cfg
+import six
 
 from marconi.i18n import _
 
@@ -43,6 +44,18 @@ _TRANSPORT_LIMITS_OPTIONS = (
                deprecated_name='message_size_uplimit',
                deprecated_group='limits:transport'),
 
+    cfg.IntOpt('max_queues_per_post', default=20,
+               help='The maximum number of queues that the same messages '
+                    'can be posted to in a single request'),
+
+    cfg.IntOpt('max_message_wait', default=20,
+               help='The maximum number of seconds a client may ask to '
+                    'wait for new messages when listing an empty queue. '
+                    'Only honored by storage drivers that support it. '
+                    'A waiting request ties up a server worker, so the '
+                    'number of requests that may wait at once is '
+                    'limited separately by the transport driver.'),
+
     cfg.IntOpt('max_message_ttl', default=1209600,
                deprecated_name='message_ttl_max',
                deprecated_group='limits:transport'),
@@ -145,6 +158,27 @@ class Validator(object):
         for msg in messages:
             self.message_content(msg)
 
+    def message_fanout(self, queues, project):
+        """Restrictions on the queues messages are posted to at once.
+
+        :param queues: A list of queue names
+        :param project: Project id
+        :raises: ValidationFailed if there are no queues, or more than
+            the configured maximum, or if any of their names is invalid
+        """
+
+        uplimit = self._limits_conf.max_queues_per_post
+        if not (0 < len(queues) <= uplimit):
+            msg = _(u'Messages must be posted to at least 1 and no more '
+                    'than {0} queues.')
+            raise ValidationFailed(msg, uplimit)
+
+        for queue in queues:
+            if not isinstance(queue, six.string_types):
+                raise ValidationFailed(_(u'Queue names must be strings.'))
+
+            self.queue_identification(queue, project)
+
     def message_length(self, content_length):
         """Restrictions on message post length.
 
@@ -170,12 +204,13 @@ class Validator(object):
             raise ValidationFailed(
                 msg, self._limits_conf.max_message_ttl, MIN_MESSAGE_TTL)
 
-    def message_listing(self, limit=None, **kwargs):
+    def message_listing(self, limit=None, wait=None, **kwargs):
         """Restrictions involving a list of messages.
 
         :param limit: The expected number of messages in the list
+        :param wait: Seconds to wait for messages if there are none
         :param kwargs: Ignored arguments passed to storage API
-        :raises: ValidationFailed if the limit is exceeded
+        :raises: ValidationFailed if the limit or wait is exceeded
         """
 
         uplimit = self._limits_conf.max_messages_per_page
@@ -186,6 +221,13 @@ class Validator(object):
             raise ValidationFailed(
                 msg, self._limits_conf.max_messages_per_page)
 
+        wait_uplimit = self._limits_conf.max_message_wait
+        if wait is not None and not (0 <= wait <= wait_uplimit):
+            msg = _(u'Wait must be at least 0 and may not '
+                    'be greater than {0} seconds.')
+
+            raise ValidationFailed(msg, wait_uplimit)
+
     def message_deletion(self, ids=None, pop=None):
         """Restrictions involving deletion of messages.
 
@@ -35,6 +35,17 @@ _WSGI_OPTIONS = (
 
     cfg.IntOpt('port', default=8888,
                help='Port on which the self-hosting server will listen.'),
+
+    cfg.IntOpt('max_message_waiters', default=8,
+               help='The maximum number of requests per server process '
+                    'that may wait for new messages at the same time '
+                    '(see max_message_wait). Each of these holds a '
+                    'worker for as long as it waits, so under servers '
+                    'with a fixed number of synchronous workers this '
+                    'should be well below that number. Requests over '
+                    'the limit get an empty listing right away, as if '
+                    'they had not asked to wait. Set to 0 to disable '
+                    'waiting.'),
 )
 
 _WSGI_GROUP = 'drivers:transport:wsgi'
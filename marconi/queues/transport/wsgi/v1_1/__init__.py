@@ -54,6 +54,10 @@ def public_endpoints(driver):
                                      queue_controller)),
         ('/queues/{queue_name}/messages/{message_id}',
          messages.ItemResource(message_controller)),
+        ('/messages',
+         messages.FanoutResource(driver._validate,
+                                 message_controller,
+                                 queue_controller)),
 
         # Claims Endpoints
         ('/queues/{queue_name}/claims',
@@ -77,13 +77,16 @@ JSON_HOME = {
         # -----------------------------------------------------------------
         'rel/messages': {
             'href-template': ('/v1.1/queues/{queue_name}/messages'
-                              '{?marker,limit,echo,include_claimed}'),
+                              '{?marker,limit,echo,include_claimed,'
+                              'include_body,wait}'),
             'href-vars': {
                 'queue_name': 'param/queue_name',
                 'marker': 'param/marker',
                 'limit': 'param/messages_limit',
                 'echo': 'param/echo',
                 'include_claimed': 'param/include_claimed',
+                'include_body': 'param/include_body',
+                'wait': 'param/wait',
             },
             'hints': {
                 'allow': ['GET'],
@@ -105,6 +108,16 @@ JSON_HOME = {
                 'accept-post': ['application/json'],
             },
         },
+        'rel/post-messages-fanout': {
+            'href-template': '/v1.1/messages',
+            'hints': {
+                'allow': ['POST'],
+                'formats': {
+                    'application/json': {},
+                },
+                'accept-post': ['application/json'],
+            },
+        },
 
         # -----------------------------------------------------------------
         # Claims
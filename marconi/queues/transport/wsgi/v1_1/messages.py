@@ -13,11 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+
 import falcon
 import six
 
 from marconi.i18n import _
 import marconi.openstack.common.log as logging
+from marconi.openstack.common import timeutils
 from marconi.queues.storage import errors as storage_errors
 from marconi.queues.transport import utils
 from marconi.queues.transport import validation
@@ -27,12 +30,13 @@ from marconi.queues.transport.wsgi import utils as wsgi_utils
 LOG = logging.getLogger(__name__)
 
 MESSAGE_POST_SPEC = (('ttl', int), ('body', '*'))
+MESSAGE_FANOUT_SPEC = (('queues', list), ('messages', list))
 
 
 class CollectionResource(object):
 
     __slots__ = ('message_controller', '_wsgi_conf', '_validate',
-                 'queue_controller')
+                 'queue_controller', '_waiters')
 
     def __init__(self, wsgi_conf, validate, message_controller,
                  queue_controller):
@@ -41,6 +45,11 @@ class CollectionResource(object):
         self.message_controller = message_controller
         self.queue_controller = queue_controller
 
+        # Each request waiting for new messages holds a worker, so
+        # only so many of them may wait at once.
+        self._waiters = threading.Semaphore(
+            wsgi_conf.max_message_waiters)
+
     # ----------------------------------------------------------------------
     # Helpers
     # ----------------------------------------------------------------------
@@ -85,9 +94,12 @@ class CollectionResource(object):
         req.get_param_as_int('limit', store=kwargs)
         req.get_param_as_bool('echo', store=kwargs)
         req.get_param_as_bool('include_claimed', store=kwargs)
+        req.get_param_as_bool('include_body', store=kwargs)
 
-        try:
-            self._validate.message_listing(**kwargs)
+        # Handled here, rather than passed through to list()
+        wait = req.get_param_as_int('wait')
+
+        def list_messages():
             results = self.message_controller.list(
                 queue_name,
                 project=project_id,
@@ -96,7 +108,20 @@ class CollectionResource(object):
 
             # Buffer messages
             cursor = next(results)
-            messages = list(cursor)
+            return results, list(cursor)
+
+        try:
+            self._validate.message_listing(wait=wait, **kwargs)
+
+            listed_at = timeutils.utcnow_ts()
+            results, messages = list_messages()
+
+            # Rather than have the client poll a quiet queue, wait
+            # for new messages, if the driver is able to, and then
+            # list the queue once more.
+            if not messages and wait:
+                if self._wait(queue_name, project_id, listed_at, wait):
+                    results, messages = list_messages()
 
         except validation.ValidationFailed as ex:
             LOG.debug(ex)
@@ -131,6 +156,25 @@ class CollectionResource(object):
             ]
         }
 
+    def _wait(self, queue_name, project_id, since, timeout):
+        """Waits for new messages, unless too many requests already are.
+
+        :returns: True if new messages may have been posted
+        """
+        if not self._waiters.acquire(False):
+            LOG.debug(u'Too many requests waiting for messages; '
+                      u'not waiting on queue %(queue)s',
+                      {'queue': queue_name})
+            return False
+
+        try:
+            return self.message_controller.wait(queue_name,
+                                                project=project_id,
+                                                since=since,
+                                                timeout=timeout)
+        finally:
+            self._waiters.release()
+
     # ----------------------------------------------------------------------
     # Interface
     # ----------------------------------------------------------------------
@@ -356,3 +400,92 @@ class ItemResource(object):
 
         # Alles guete
         resp.status = falcon.HTTP_204
+
+
+class FanoutResource(object):
+    """Posts the same messages to several queues in one request."""
+
+    __slots__ = ('message_controller', '_validate', 'queue_controller')
+
+    def __init__(self, validate, message_controller, queue_controller):
+        self._validate = validate
+        self.message_controller = message_controller
+        self.queue_controller = queue_controller
+
+    def on_post(self, req, resp, project_id):
+        LOG.debug(u'Messages fanout POST - project: %(project)s',
+                  {'project': project_id})
+
+        client_uuid = wsgi_utils.get_client_uuid(req)
+
+        try:
+            # Place JSON size restriction before parsing
+            self._validate.message_length(req.content_length)
+        except validation.ValidationFailed as ex:
+            LOG.debug(ex)
+            raise wsgi_errors.HTTPBadRequestAPI(six.text_type(ex))
+
+        document, = wsgi_utils.filter_stream(req.stream,
+                                             req.content_length,
+                                             MESSAGE_FANOUT_SPEC)
+
+        if not all(isinstance(message, wsgi_utils.JSONObject)
+                   for message in document['messages']):
+            description = _(u'Messages must be JSON objects.')
+            raise wsgi_errors.HTTPBadRequestBody(description)
+
+        queue_names = document['queues']
+        messages = [wsgi_utils.filter(message, MESSAGE_POST_SPEC)
+                    for message in document['messages']]
+
+        partial = False
+
+        try:
+            self._validate.message_fanout(queue_names, project_id)
+            self._validate.message_posting(messages)
+
+            for queue_name in queue_names:
+                if not self.queue_controller.exists(queue_name, project_id):
+                    self.queue_controller.create(queue_name, project_id)
+
+            batches = dict((queue_name, messages)
+                           for queue_name in queue_names)
+
+            message_ids = self.message_controller.post_many(
+                batches,
+                project=project_id,
+                client_uuid=client_uuid)
+
+        except validation.ValidationFailed as ex:
+            LOG.debug(ex)
+            raise wsgi_errors.HTTPBadRequestAPI(six.text_type(ex))
+
+        except storage_errors.DoesNotExist as ex:
+            LOG.debug(ex)
+            raise falcon.HTTPNotFound()
+
+        except storage_errors.FanoutIncomplete as ex:
+            # Some queues already have the messages, so tell the
+            # client which ones instead of inviting a blind retry.
+            LOG.exception(ex)
+            partial = True
+            message_ids = ex.succeeded_ids
+
+        except Exception as ex:
+            LOG.exception(ex)
+            description = _(u'Messages could not be enqueued.')
+            raise wsgi_errors.HTTPServiceUnavailable(description)
+
+        # Prepare the response, listing each queue's messages
+        # separately. Queues missing from a partial response did
+        # not receive any of the messages.
+        base_path = req.path.rsplit('/', 1)[0] + '/queues/'
+
+        resources = {}
+        for queue_name, ids in six.iteritems(message_ids):
+            path = base_path + queue_name + '/messages/'
+            resources[queue_name] = [path + id for id in ids]
+
+        body = {'resources': resources, 'partial': partial}
+        resp.body = utils.to_json(body)
+        resp.status = falcon.HTTP_201
@@ -94,7 +94,8 @@ class MessageController(storage.Message):
         raise NotImplementedError()
 
     def list(self, queue, project=None, marker=None,
-             limit=None, echo=False, client_uuid=None):
+             limit=None, echo=False, client_uuid=None,
+             include_claimed=False, include_body=True):
         raise NotImplementedError()
 
     def post(self, queue, messages, project=None):
@@ -13,12 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import datetime
 import random
 import time
 import uuid
 
 import ddt
+import mock
 import six
 from testtools import matchers
 
@@ -297,6 +299,112 @@ class MessageControllerTest(ControllerBaseTest):
         with testing.expect(storage.errors.DoesNotExist):
             self.controller.get(queue_name, message_id, project=self.project)
 
+    def test_list_without_body(self):
+        client_uuid = uuid.uuid4()
+        _insert_fixtures(self.controller, self.queue_name,
+                         project=self.project, client_uuid=client_uuid,
+                         num=3)
+
+        interaction = self.controller.list(self.queue_name,
+                                           project=self.project,
+                                           client_uuid=client_uuid,
+                                           echo=True, include_body=False)
+
+        messages = list(next(interaction))
+        self.assertEqual(len(messages), 3)
+
+        for message in messages:
+            self.assertEqual(set(message), set(('id', 'ttl', 'age')))
+
+        # The marker still allows paging through the queue
+        interaction = self.controller.list(self.queue_name,
+                                           project=self.project,
+                                           client_uuid=client_uuid,
+                                           marker=next(interaction),
+                                           echo=True, include_body=False)
+
+        self.assertEqual(len(list(next(interaction))), 0)
+
+    def test_post_many(self):
+        other_queue = 'test_queue_other'
+        self.queue_controller.create(other_queue, project=self.project)
+        self.addCleanup(self.queue_controller.delete, other_queue,
+                        project=self.project)
+
+        batches = {
+            self.queue_name: [{'ttl': 60, 'body': {'n': i}}
+                              for i in range(3)],
+            other_queue: [{'ttl': 60, 'body': {'n': 'other'}}],
+        }
+
+        created = self.controller.post_many(batches,
+                                            project=self.project,
+                                            client_uuid=uuid.uuid4())
+        self.assertEqual(sorted(created), sorted(batches))
+
+        for queue, messages in six.iteritems(batches):
+            self.assertEqual(len(created[queue]), len(messages))
+
+            stored = self.controller.bulk_get(queue, created[queue],
+                                              project=self.project)
+            self.assertEqual(sorted(msg['body']['n'] for msg in stored),
+                             sorted(msg['body']['n'] for msg in messages))
+
+        # Nothing is posted if any of the queues does not exist
+        batches['nonexistent'] = [{'ttl': 60, 'body': {}}]
+        self.assertRaises(storage.errors.QueueDoesNotExist,
+                          self.controller.post_many, batches,
+                          project=self.project, client_uuid=uuid.uuid4())
+
+        stats = self.queue_controller.stats(other_queue,
+                                            project=self.project)
+        self.assertEqual(stats['messages']['total'], 1)
+
+    def test_post_many_partial(self):
+        if not isinstance(self.controller, storage.Message):
+            self.skipTest('Does not use the default implementation')
+
+        other_queue = 'test_queue_other'
+        self.queue_controller.create(other_queue, project=self.project)
+        self.addCleanup(self.queue_controller.delete, other_queue,
+                        project=self.project)
+
+        batches = collections.OrderedDict([
+            (self.queue_name, [{'ttl': 60, 'body': {'n': 1}}]),
+            (other_queue, [{'ttl': 60, 'body': {'n': 2}}]),
+        ])
+
+        post = self.controller.post
+
+        def post_all_but_other(queue, *args, **kwargs):
+            if queue == other_queue:
+                raise RuntimeError('Failed to post')
+
+            return post(queue, *args, **kwargs)
+
+        # The default implementation posts to each queue in turn, so
+        # it reports what was posted before the failure.
+        post_many = six.get_unbound_function(storage.Message.post_many)
+        with mock.patch.object(self.controller, 'post',
+                               side_effect=post_all_but_other):
+            ex = self.assertRaises(errors.FanoutIncomplete, post_many,
+                                   self.controller, batches,
+                                   project=self.project,
+                                   client_uuid=uuid.uuid4())
+
+            self.assertEqual(list(ex.succeeded_ids), [self.queue_name])
+            stored = list(self.controller.bulk_get(
+                self.queue_name, ex.succeeded_ids[self.queue_name],
+                project=self.project))
+            self.assertEqual(len(stored), 1)
+
+            # Nothing was posted if the first queue fails
+            batches = collections.OrderedDict(reversed(batches.items()))
+            self.assertRaises(RuntimeError, post_many,
+                              self.controller, batches,
+                              project=self.project,
+                              client_uuid=uuid.uuid4())
+
     def test_get_multi(self):
         client_uuid = uuid.uuid4()
 
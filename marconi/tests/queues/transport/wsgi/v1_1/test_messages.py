@@ -26,7 +26,9 @@ from testtools import matchers
 
 from marconi.openstack.common import jsonutils
 from marconi.openstack.common import timeutils
+from marconi.queues.storage import errors as storage_errors
 from marconi.queues.transport import validation
+from marconi.queues.transport.wsgi import driver
 from marconi import tests as testing
 from marconi.tests.queues.transport.wsgi import base
 
@@ -374,6 +376,145 @@ class MessagesBaseTest(base.V1_1Base):
         self.assertEqual(self.srmock.status, falcon.HTTP_200)
         self._empty_message_list(body)
 
+    def test_list_without_body(self):
+        path = self.queue_path + '/messages'
+        self._post_messages(path, repeat=3)
+
+        body = self.simulate_get(path,
+                                 query_string='echo=true&include_body=false',
+                                 headers=self.headers)
+
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        contents = self._deserialize(body[0])
+        self.assertEqual(len(contents['messages']), 3)
+
+        for msg in contents['messages']:
+            self.assertNotIn('body', msg)
+            self.assertIn('href', msg)
+
+    def test_post_fanout(self):
+        other_path = self.url_prefix + '/queues/fanout-other'
+        self.addCleanup(self.simulate_delete, other_path,
+                        headers=self.headers)
+
+        path = self.url_prefix + '/messages'
+        doc = {
+            'queues': ['fizbit', 'fanout-other'],
+            'messages': [{'body': 239, 'ttl': 300}] * 2,
+        }
+
+        result = self.simulate_post(path, body=self._serialize(doc),
+                                    headers=self.headers)
+        self.assertEqual(self.srmock.status, falcon.HTTP_201)
+
+        result_doc = self._deserialize(result[0])
+        self.assertFalse(result_doc['partial'])
+
+        resources = result_doc['resources']
+        self.assertEqual(sorted(resources), ['fanout-other', 'fizbit'])
+
+        for queue_path in (self.queue_path, other_path):
+            hrefs = resources[queue_path.rsplit('/', 1)[-1]]
+            self.assertEqual(len(hrefs), 2)
+
+            for href in hrefs:
+                self.assertTrue(href.startswith(queue_path + '/messages/'))
+                self.simulate_get(href, headers=self.headers)
+                self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+    def test_post_fanout_partial(self):
+        other_path = self.url_prefix + '/queues/fanout-other'
+        self.addCleanup(self.simulate_delete, other_path,
+                        headers=self.headers)
+
+        path = self.url_prefix + '/messages'
+        doc = {
+            'queues': ['fizbit', 'fanout-other'],
+            'messages': [{'body': 239, 'ttl': 300}],
+        }
+
+        controller = self.boot.storage._storage.message_controller
+
+        def post_to_fizbit(batches, client_uuid, project=None):
+            ids = controller.post('fizbit', batches['fizbit'],
+                                  client_uuid, project=project)
+            raise storage_errors.FanoutIncomplete(project, {'fizbit': ids})
+
+        with mock.patch.object(controller, 'post_many',
+                               side_effect=post_to_fizbit):
+            result = self.simulate_post(path, body=self._serialize(doc),
+                                        headers=self.headers)
+
+        self.assertEqual(self.srmock.status, falcon.HTTP_201)
+
+        result_doc = self._deserialize(result[0])
+        self.assertTrue(result_doc['partial'])
+        self.assertEqual(list(result_doc['resources']), ['fizbit'])
+
+        href, = result_doc['resources']['fizbit']
+        self.simulate_get(href, headers=self.headers)
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        # A failure before anything was posted is still an error
+        with mock.patch.object(controller, 'post_many',
+                               side_effect=RuntimeError):
+            self.simulate_post(path, body=self._serialize(doc),
+                               headers=self.headers)
+
+        self.assertEqual(self.srmock.status, falcon.HTTP_503)
+
+    @ddt.data(
+        {'queues': [], 'messages': [{'body': 239, 'ttl': 300}]},
+        {'queues': ['fizbit'], 'messages': []},
+        {'queues': ['fizbit'], 'messages': ['hello']},
+        {'queues': ['fiz bit'], 'messages': [{'body': 239, 'ttl': 300}]},
+        {'queues': ['fizbit']},
+    )
+    def test_post_fanout_bad_request(self, doc):
+        self.simulate_post(self.url_prefix + '/messages',
+                           body=self._serialize(doc), headers=self.headers)
+        self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
+    def test_list_with_wait(self):
+        path = self.queue_path + '/messages'
+
+        body = self.simulate_get(path, query_string='wait=1',
+                                 headers=self.headers)
+
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self._empty_message_list(body)
+
+        self.simulate_get(path, query_string='wait=3600',
+                          headers=self.headers)
+
+        self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
+    def test_list_with_wait_over_limit(self):
+        path = self.queue_path + '/messages'
+        controller = self.boot.storage._storage.message_controller
+
+        with mock.patch.object(controller, 'wait',
+                               return_value=False) as wait:
+            self.simulate_get(path, query_string='wait=1',
+                              headers=self.headers)
+
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertTrue(wait.called)
+
+        # No request may wait at all
+        self.config(group=driver._WSGI_GROUP, max_message_waiters=0)
+        self.app = driver.Driver(self.conf, self.boot.storage,
+                                 self.boot.cache, self.boot.control).app
+
+        with mock.patch.object(controller, 'wait') as wait:
+            body = self.simulate_get(path, query_string='wait=1',
+                                     headers=self.headers)
+
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self._empty_message_list(body)
+        self.assertFalse(wait.called)
+
     def test_list_with_bad_marker(self):
         path = self.queue_path + '/messages'
         self._post_messages(path, repeat=5)
@@ -0,0 +1,84 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import mock
+
+from marconi.common import metrics
+from marconi.queues.storage import pipeline
+from marconi.tests import base
+from marconi.tests import faulty_storage
+
+
+class TestMetrics(base.TestBase):
+
+    def test_incr(self):
+        registry = metrics.Registry()
+        self.assertEqual(registry.get('claims.lost'), 0)
+
+        registry.incr('claims.lost')
+        registry.incr('claims.lost', 4)
+        self.assertEqual(registry.get('claims.lost'), 5)
+
+    def test_timed(self):
+        registry = metrics.Registry()
+
+        for _ in range(3):
+            with registry.timed('post'):
+                pass
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['post.count'], 3)
+        self.assertTrue(snapshot['post.seconds'] >= 0)
+
+    def test_snapshot_is_a_copy(self):
+        registry = metrics.Registry()
+        registry.incr('a')
+
+        snapshot = registry.snapshot()
+        registry.incr('a')
+
+        self.assertEqual(snapshot, {'a': 1})
+        self.assertEqual(registry.get('a'), 2)
+
+    def test_reporter(self):
+        registry = metrics.Registry()
+        reporter = metrics.Reporter(registry.snapshot, 60)
+
+        with mock.patch.object(metrics.LOG, 'info') as info:
+            # Nothing to report yet
+            reporter.run_once()
+            self.assertFalse(info.called)
+
+            registry.incr('claims.lost', 2)
+            registry.incr('codec.encode.seconds', 0.12345)
+            reporter.run_once()
+
+        info.assert_called_once_with(
+            u'Metrics: %s', u'claims.lost=2, codec.encode.seconds=0.123')
+
+    def test_pipeline_reports_storage_metrics(self):
+        storage_driver = faulty_storage.DataDriver(self.conf, None)
+        storage_driver.metrics.incr('claims.lost')
+
+        self.conf.register_opts(pipeline._METRICS_OPTIONS, group='storage')
+        self.config(group='storage', metrics_log_interval=60)
+
+        driver = pipeline.DataDriver(self.conf, storage_driver)
+        self.assertEqual(driver.metrics_snapshot(), {'claims.lost': 1})
+
+        reporter, = driver._workers
+        self.assertTrue(reporter.is_alive())
+
+        driver.close_connection()
+        self.assertFalse(reporter.is_alive())
@@ -0,0 +1,89 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+from marconi.common import metrics
+from marconi.common import workers
+from marconi.tests import base
+from marconi.tests import faulty_storage
+
+
+class ScriptedWorker(workers.PeriodicWorker):
+    """Returns, or raises, the given results one pass at a time."""
+
+    def __init__(self, results, batch_size=1, interval=0):
+        super(ScriptedWorker, self).__init__(
+            'test-worker', metrics.Registry(), interval,
+            batch_size=batch_size, timer='worker.pass')
+
+        self.results = list(results)
+
+    def run_once(self):
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    def is_done(self, result):
+        return not self.results
+
+
+class TestWorkers(base.TestBase):
+
+    def test_survives_errors(self):
+        worker = ScriptedWorker([RuntimeError(), KeyError('k'), 0])
+        worker.start()
+        worker.join(5)
+
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(worker.results, [])
+        self.assertEqual(worker._metrics.get('worker.pass.count'), 3)
+
+    def test_stop(self):
+        worker = ScriptedWorker([])
+        worker.stop()
+        self.assertTrue(worker.stopping)
+
+        # A stopped worker exits before making a single pass
+        worker.start()
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(worker._metrics.get('worker.pass.count'), 0)
+
+    def test_drain(self):
+        worker = ScriptedWorker([], batch_size=3)
+        batches = [3, 3, 1, 3]
+
+        def process(limit):
+            self.assertEqual(limit, 3)
+            return batches.pop(0)
+
+        self.assertEqual(worker.drain(process, 'worker.items'), 7)
+        self.assertEqual(batches, [3])
+        self.assertEqual(worker._metrics.get('worker.items'), 7)
+
+        worker.stop()
+        self.assertEqual(worker.drain(process), 0)
+        self.assertEqual(batches, [3])
+
+    def test_driver_stops_workers(self):
+        driver = faulty_storage.DataDriver(None, None)
+
+        worker = ScriptedWorker([0, 0], interval=60)
+        driver._start_worker(worker)
+        self.assertTrue(worker.is_alive())
+
+        driver.close_connection()
+        self.assertFalse(worker.is_alive())
+        self.assertTrue(worker.stopping)
@@ -0,0 +1,64 @@
+# Copyright (c) 2014 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+
+from marconi.common import metrics
+from marconi.queues.storage import codecs
+from marconi.tests import base
+
+
+class TestCodecs(base.TestBase):
+
+    def setUp(self):
+        super(TestCodecs, self).setUp()
+        self.metrics = metrics.Registry()
+
+    def test_round_trip(self):
+        compressor = codecs.BodyCompressor('zlib', 0, self.metrics)
+        data = b'{"event": "BackupStarted"}' * 100
+
+        compressed = compressor.compress(data)
+        self.assertTrue(codecs.is_compressed(compressed))
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(codecs.decompress(compressed, self.metrics), data)
+
+        self.assertEqual(self.metrics.get('compression.compressed'), 1)
+        self.assertEqual(self.metrics.get('compression.bytes_in'), len(data))
+        self.assertEqual(self.metrics.get('compression.bytes_out'),
+                         len(compressed))
+
+        self.assertEqual(self.metrics.get('compression.decompressed'), 1)
+        self.assertTrue(
+            self.metrics.get('compression.decompress_seconds') >= 0)
+
+    def test_below_threshold(self):
+        compressor = codecs.BodyCompressor('zlib', 1024, self.metrics)
+        data = b'{"event": "BackupStarted"}'
+
+        self.assertIs(compressor.compress(data), data)
+        self.assertFalse(codecs.is_compressed(data))
+        self.assertEqual(codecs.decompress(data, self.metrics), data)
+        self.assertEqual(self.metrics.get('compression.compressed'), 0)
+        self.assertEqual(self.metrics.get('compression.decompressed'), 0)
+
+    def test_incompressible(self):
+        compressor = codecs.BodyCompressor('zlib', 0, self.metrics)
+        data = os.urandom(256)
+
+        self.assertIs(compressor.compress(data), data)
+        self.assertEqual(self.metrics.get('compression.skipped'), 1)
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, codecs.load, 'no-such-codec')
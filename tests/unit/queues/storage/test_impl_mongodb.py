@@ -15,24 +15,36 @@
 
 import collections
 import datetime
+import socket
+import sys
 import time
 import uuid
 
+from bson import binary
+from bson import objectid
 import mock
 from pymongo import cursor
 import pymongo.errors
+import pymongo.pool
+import pymongo.read_preferences
 import six
 from testtools import matchers
 
+from marconi.common import errors as common_errors
+from marconi.common import metrics
 from marconi.openstack.common.cache import cache as oslo_cache
 from marconi.openstack.common import timeutils
 from marconi.queues import storage
 from marconi.queues.storage import errors
 from marconi.queues.storage import mongodb
 from marconi.queues.storage.mongodb import controllers
+from marconi.queues.storage.mongodb import indexes
 from marconi.queues.storage.mongodb import options
+from marconi.queues.storage.mongodb import schema
+from marconi.queues.storage.mongodb import sweeper
 from marconi.queues.storage.mongodb import utils
 from marconi.queues.storage import pooling
+from marconi.queues.storage import utils as storage_utils
 from marconi import tests as testing
 from marconi.tests.queues.storage import base
 
@@ -80,6 +92,15 @@ class MongodbUtilsTest(testing.TestBase):
         self.assertEqual(utils.descope_queue_name('radiant/some-pig'),
                          'some-pig')
 
+    def test_oid_ts(self):
+        oid = objectid.ObjectId()
+        expected = timeutils.delta_seconds(utils.EPOCH, oid.generation_time)
+
+        self.assertEqual(utils.oid_ts(oid), expected)
+        self.assertEqual(utils.oid_str_ts(str(oid)), expected)
+
+        self.assertRaises(TypeError, utils.oid_ts, str(oid))
+
     def test_calculate_backoff(self):
         sec = utils.calculate_backoff(0, 10, 2, 0)
         self.assertEqual(sec, 0)
@@ -134,6 +155,262 @@ class MongodbUtilsTest(testing.TestBase):
 
         self.assertEqual(num_calls, [self.mongodb_conf.max_reconnect_attempts])
 
+    @mock.patch('marconi.queues.storage.mongodb.utils.cooperative_sleep')
+    def test_retries_on_autoreconnect_breaker(self, sleep):
+        MockDriver = collections.namedtuple(
+            'MockDriver', 'mongodb_conf circuit_breaker metrics')
+
+        self.driver = MockDriver(self.mongodb_conf,
+                                 utils.CircuitBreaker(1, 60),
+                                 metrics.Registry())
+
+        num_calls = [0]
+
+        @utils.retries_on_autoreconnect
+        def _raises_autoreconnect(self):
+            num_calls[0] += 1
+            raise pymongo.errors.AutoReconnect()
+
+        max_attempts = self.mongodb_conf.max_reconnect_attempts
+
+        self.assertRaises(pymongo.errors.AutoReconnect,
+                          _raises_autoreconnect, self)
+        self.assertEqual(num_calls, [max_attempts])
+
+        # No sleep after the final attempt
+        self.assertEqual(sleep.call_count, max_attempts - 1)
+        self.assertEqual(self.driver.metrics.get('retries.reconnect'),
+                         max_attempts - 1)
+        self.assertEqual(self.driver.metrics.get('breaker.opened'), 1)
+
+        # The breaker is now open, so fail fast
+        self.assertRaises(errors.ConnectionError,
+                          _raises_autoreconnect, self)
+        self.assertEqual(num_calls, [max_attempts])
+        self.assertEqual(self.driver.metrics.get('breaker.rejected'), 1)
+
+    def test_circuit_breaker(self):
+        breaker = utils.CircuitBreaker(2, 10)
+
+        with mock.patch('time.time', return_value=1000):
+            self.assertFalse(breaker.record_failure())
+            self.assertTrue(breaker.allow())
+
+            self.assertTrue(breaker.record_failure())
+            self.assertFalse(breaker.allow())
+
+        # After the cooldown, only a single probe is let through
+        with mock.patch('time.time', return_value=1010):
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+
+            breaker.record_success()
+            self.assertTrue(breaker.allow())
+
+        disabled = utils.CircuitBreaker(0, 10)
+        for _ in range(10):
+            self.assertFalse(disabled.record_failure())
+
+        self.assertTrue(disabled.allow())
+
+    def test_read_preferences(self):
+        ReadPreference = pymongo.read_preferences.ReadPreference
+        now = datetime.datetime.utcnow()
+
+        def status(lag):
+            return {
+                'members': [
+                    {'stateStr': 'PRIMARY', 'health': 1,
+                     'optimeDate': now},
+                    {'stateStr': 'SECONDARY', 'health': 1,
+                     'optimeDate': now - datetime.timedelta(seconds=lag)},
+                ]
+            }
+
+        preferences = {'list': 'secondaryPreferred', 'stats': 'nearest'}
+
+        resolver = utils.ReadPreferences(preferences, 10, lambda: status(5))
+        self.assertEqual(resolver.get('list'),
+                         ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(resolver.get('stats'), ReadPreference.NEAREST)
+        self.assertIsNone(resolver.get('get'))
+        self.assertEqual(resolver.options('get'), {})
+
+        # Secondaries lag too far behind
+        resolver = utils.ReadPreferences(preferences, 10, lambda: status(20))
+        self.assertEqual(resolver.get('list'), ReadPreference.PRIMARY)
+
+        # The lag can not be determined
+        def unauthorized():
+            raise pymongo.errors.OperationFailure('unauthorized')
+
+        resolver = utils.ReadPreferences(preferences, 10, unauthorized)
+        self.assertEqual(resolver.options('list'),
+                         {'read_preference': ReadPreference.PRIMARY})
+
+        # Without a bound, the lag is never checked
+        resolver = utils.ReadPreferences(preferences, 0, unauthorized)
+        self.assertEqual(resolver.get('list'),
+                         ReadPreference.SECONDARY_PREFERRED)
+
+        self.assertRaises(ValueError, utils.ReadPreferences,
+                          {'claim': 'secondary'}, 0, unauthorized)
+        self.assertRaises(ValueError, utils.ReadPreferences,
+                          {'list': 'tertiary'}, 0, unauthorized)
+
+    def test_batched_cursor(self):
+        batches = []
+
+        def denormalizer(docs):
+            batches.append(len(docs))
+            return [doc * 2 for doc in docs]
+
+        cursor = utils.BatchedCursor(range(5), denormalizer, batch_size=2)
+        self.assertEqual(next(cursor), 0)
+        self.assertEqual(batches, [2])
+
+        # Fetches the rest, without asking for a count
+        self.assertEqual(len(cursor), 4)
+        self.assertEqual(list(cursor), [2, 4, 6, 8])
+        self.assertEqual(batches, [2, 2, 1])
+
+        # The batch size is passed on to pymongo cursors
+        mongo_cursor = mock.MagicMock()
+        mongo_cursor.__iter__.return_value = iter([{'a': 1}])
+        cursor = utils.BatchedCursor(mongo_cursor,
+                                     utils.denormalize_each(len))
+        mongo_cursor.batch_size.assert_called_once_with(
+            utils.CURSOR_BATCH_SIZE)
+        self.assertEqual(list(cursor), [1])
+        self.assertFalse(mongo_cursor.count.called)
+
+    def test_cooperative_sleep(self):
+        eventlet = mock.Mock()
+        patcher = mock.Mock()
+        patcher.is_monkey_patched.return_value = False
+
+        modules = {'eventlet': eventlet, 'eventlet.patcher': patcher}
+        with mock.patch.dict(sys.modules, modules):
+            # Imported, but not monkey-patched
+            with mock.patch('time.sleep') as sleep:
+                utils.cooperative_sleep(0.5)
+
+            sleep.assert_called_once_with(0.5)
+            self.assertFalse(eventlet.sleep.called)
+
+            patcher.is_monkey_patched.return_value = True
+            with mock.patch('time.sleep') as sleep:
+                utils.cooperative_sleep(0.5)
+
+            eventlet.sleep.assert_called_once_with(0.5)
+            self.assertFalse(sleep.called)
+            patcher.is_monkey_patched.assert_called_with('time')
+
+    def test_instrumented_pool(self):
+        registry = metrics.Registry()
+        pool_class = utils.instrumented_pool_class(registry)
+
+        # The pool opens plain TCP connections, so any listener will do
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+
+        instance = pool_class(listener.getsockname(), max_size=1,
+                              net_timeout=None, conn_timeout=5,
+                              use_ssl=False, use_greenlets=False,
+                              wait_queue_timeout=0.1)
+        self.addCleanup(instance.reset)
+
+        sock_info = instance.get_socket()
+        self.assertEqual(registry.get('pool.connects'), 1)
+        self.assertEqual(registry.get('pool.checkout.count'), 1)
+        self.assertEqual(registry.get('pool.in_use'), 1)
+
+        # The only socket is checked out, so the next request times out
+        self.assertRaises(pymongo.errors.ConnectionFailure,
+                          instance.get_socket)
+        self.assertEqual(registry.get('pool.checkout_failures'), 1)
+        self.assertEqual(registry.get('pool.timeouts'), 1)
+
+        instance.maybe_return_socket(sock_info)
+        self.assertEqual(registry.get('pool.in_use'), 0)
+
+        # The returned socket is reused rather than a new one opened
+        self.assertIs(instance.get_socket(), sock_info)
+        self.assertEqual(registry.get('pool.connects'), 1)
+        self.assertEqual(registry.get('pool.checkout.count'), 2)
+
+    def test_instrumented_pool_failure(self):
+        registry = metrics.Registry()
+        pool_class = utils.instrumented_pool_class(registry)
+        instance = pool_class(('127.0.0.1', 27017), max_size=1,
+                              net_timeout=None, conn_timeout=5,
+                              use_ssl=False, use_greenlets=False,
+                              wait_queue_timeout=0.5)
+
+        # A connection error is a failure, but not a timeout
+        failure = pymongo.errors.ConnectionFailure('Connection refused')
+        with mock.patch('pymongo.pool.Pool.get_socket',
+                        side_effect=failure):
+            with mock.patch('time.time', side_effect=[0, 0.1]):
+                self.assertRaises(pymongo.errors.ConnectionFailure,
+                                  instance.get_socket)
+
+        self.assertEqual(registry.get('pool.checkout_failures'), 1)
+        self.assertEqual(registry.get('pool.timeouts'), 0)
+        self.assertEqual(registry.get('pool.checkout.count'), 0)
+
+    def test_write_concerns(self):
+        registry = metrics.Registry()
+        concerns = utils.WriteConcerns({'post': 'majority',
+                                        'delete': 'unacknowledged'},
+                                       registry)
+
+        with concerns.write('post') as options:
+            self.assertEqual(options, {'w': 'majority'})
+
+        with concerns.write('delete') as options:
+            self.assertEqual(options, {'w': 0})
+
+        # Writes whose result is needed are always acknowledged
+        with concerns.write('delete', needs_result=True) as options:
+            self.assertEqual(options, {'w': 1})
+
+        # Unconfigured profiles keep their previous behaviour
+        with concerns.write('claim') as options:
+            self.assertEqual(options, {})
+
+        with concerns.write('admin', default='unacknowledged') as options:
+            self.assertEqual(options, {'w': 0})
+
+        self.assertEqual(registry.get('writes.post.majority.count'), 1)
+        self.assertEqual(registry.get('writes.delete.unacknowledged.count'),
+                         1)
+        self.assertEqual(registry.get('writes.delete.acknowledged.count'), 1)
+        self.assertEqual(registry.get('writes.claim.default.count'), 1)
+
+        self.assertRaises(ValueError, utils.WriteConcerns,
+                          {'list': 'majority'}, registry)
+        self.assertRaises(ValueError, utils.WriteConcerns,
+                          {'post': 'eventually'}, registry)
+
+    def test_contention_tracker(self):
+        tracker = utils.ContentionTracker(weight=0.5)
+        self.assertEqual(tracker.rate('/q'), 0)
+
+        tracker.record('/q', 4)
+        self.assertEqual(tracker.rate('/q'), 2)
+
+        tracker.record('/q', 0)
+        self.assertEqual(tracker.rate('/q'), 1)
+
+        # Uncontended keys are forgotten
+        for _ in range(10):
+            tracker.record('/q', 0)
+
+        self.assertNotIn('/q', tracker._rates)
+
 
 @testing.requires_mongodb
 class MongodbDriverTest(testing.TestBase):
@@ -151,6 +428,76 @@ class MongodbDriverTest(testing.TestBase):
             self.assertThat(db.name, matchers.StartsWith(
                 driver.mongodb_conf.database))
 
+    def test_fast_start(self):
+        cache = oslo_cache.get_cache()
+
+        self.conf.register_opts(options.MONGODB_OPTIONS,
+                                group=options.MONGODB_GROUP)
+        driver = mongodb.DataDriver(self.conf, cache)
+        driver.queues_database.schema.drop()
+        self.addCleanup(driver.queues_database.schema.drop)
+
+        self.assertFalse(driver.schema_bootstrapped)
+
+        # Nothing has been recorded yet
+        self.config(options.MONGODB_GROUP, fast_start=True)
+        driver = mongodb.DataDriver(self.conf, cache)
+        self.assertFalse(driver.schema_bootstrapped)
+
+        schema.bootstrap(driver)
+
+        driver = mongodb.DataDriver(self.conf, cache)
+        self.assertTrue(driver.schema_bootstrapped)
+
+        with mock.patch('pymongo.collection.Collection.ensure_index') as ei:
+            driver.message_controller
+            self.assertFalse(ei.called)
+
+        # Changing the layout invalidates the recorded schema
+        self.config(options.MONGODB_GROUP, partitions=4)
+        driver = mongodb.DataDriver(self.conf, cache)
+        self.assertFalse(driver.schema_bootstrapped)
+
+    def test_watermark_excludes_leasing(self):
+        cache = oslo_cache.get_cache()
+
+        self.conf.register_opts(options.MONGODB_OPTIONS,
+                                group=options.MONGODB_GROUP)
+        self.config(options.MONGODB_GROUP, visibility_watermark=True,
+                    marker_lease_size=10)
+
+        self.assertRaises(common_errors.InvalidDriver,
+                          mongodb.DataDriver, self.conf, cache)
+
+    @mock.patch('pymongo.MongoClient')
+    def test_pool_options(self, client):
+        cache = oslo_cache.get_cache()
+
+        self.conf.register_opts(options.MONGODB_OPTIONS,
+                                group=options.MONGODB_GROUP)
+        self.config(options.MONGODB_GROUP, max_pool_size=50,
+                    wait_queue_timeout=500, socket_keepalive=True)
+        driver = mongodb.DataDriver(self.conf, cache)
+        driver.connection
+
+        kwargs = client.call_args[1]
+        self.assertEqual(kwargs['max_pool_size'], 50)
+        self.assertEqual(kwargs['waitQueueTimeoutMS'], 500)
+        self.assertTrue(kwargs['socketKeepAlive'])
+        self.assertNotIn('waitQueueMultiple', kwargs)
+        self.assertTrue(issubclass(kwargs['_pool_class'],
+                                   pymongo.pool.Pool))
+
+        # Pooled drivers are sized through their pool's options
+        conf = storage_utils.dynamic_conf('mongodb://localhost',
+                                          {'max_pool_size': 5})
+        driver = mongodb.DataDriver(conf, cache)
+        driver.connection
+
+        kwargs = client.call_args[1]
+        self.assertEqual(kwargs['max_pool_size'], 5)
+        self.assertNotIn('waitQueueTimeoutMS', kwargs)
+
 
 @testing.requires_mongodb
 class MongodbQueueTests(base.QueueControllerTest):
@@ -174,6 +521,94 @@ class MongodbQueueTests(base.QueueControllerTest):
         for collection in self.message_controller._collections:
             self.assertEqual(collection.find({'q': queue_name}).count(), 0)
 
+    def test_tracked_stats(self):
+        self.config(options.MONGODB_GROUP, stats_refresh_interval=3600)
+
+        queue_name = 'tracked-stats-queue'
+        self.controller.create(queue_name, self.project)
+
+        def messages_stats():
+            stats = self.controller.stats(queue_name, project=self.project)
+            return stats['messages']
+
+        # The first call reconciles the stats
+        self.assertEqual(messages_stats()['total'], 0)
+
+        ids = self.message_controller.post(queue_name,
+                                           [{'ttl': 60, 'body': i}
+                                            for i in range(4)],
+                                           uuid.uuid4(), self.project)
+
+        meta = {'ttl': 60, 'grace': 60}
+        cid, _ = self.claim_controller.create(queue_name, meta,
+                                              project=self.project,
+                                              limit=2)
+
+        # From now on, stats must not need to count messages
+        with mock.patch.object(self.message_controller, '_count') as count:
+            stats = messages_stats()
+            self.assertEqual(stats['total'], 4)
+            self.assertEqual(stats['claimed'], 2)
+            self.assertEqual(stats['free'], 2)
+            self.assertEqual(stats['oldest']['id'], ids[0])
+            self.assertEqual(stats['newest']['id'], ids[-1])
+
+            self.message_controller.delete(queue_name, ids[0],
+                                           project=self.project,
+                                           claim=cid)
+            self.claim_controller.delete(queue_name, cid,
+                                         project=self.project)
+            self.message_controller.pop(queue_name, 1, project=self.project)
+            self.message_controller.bulk_delete(queue_name, ids[2:3],
+                                                project=self.project)
+
+            stats = messages_stats()
+            self.assertEqual(stats['total'], 1)
+            self.assertEqual(stats['claimed'], 0)
+            self.assertEqual(stats['free'], 1)
+
+            self.assertFalse(count.called)
+
+    def test_tracked_stats_with_expired_claims(self):
+        self.config(options.MONGODB_GROUP, stats_refresh_interval=3600)
+
+        queue_name = 'expired-claims-stats-queue'
+        self.controller.create(queue_name, self.project)
+        self.controller.stats(queue_name, project=self.project)
+
+        self.message_controller.post(queue_name,
+                                     [{'ttl': 60, 'body': i}
+                                      for i in range(3)],
+                                     uuid.uuid4(), self.project)
+
+        meta = {'ttl': 60, 'grace': 60}
+        cid, _ = self.claim_controller.create(queue_name, meta,
+                                              project=self.project,
+                                              limit=2)
+
+        # Expire the claim behind the controller's back, after the
+        # stats were last reconciled.
+        now = timeutils.utcnow_ts()
+        scope = utils.scope_queue_name(queue_name, self.project)
+        self.controller._collection.update({'p_q': scope},
+                                           {'$set': {'s.r': now - 10}})
+
+        collection = self.message_controller._collection(queue_name,
+                                                         self.project)
+        collection.update({'c.id': utils.to_oid(cid)},
+                          {'$set': {'c.e': now - 1}}, multi=True)
+
+        claim_sweeper = sweeper.ClaimSweeper(self.driver,
+                                             self.message_controller)
+        self.assertEqual(claim_sweeper.run_once(), 2)
+
+        with mock.patch.object(self.message_controller, '_count') as count:
+            stats = self.controller.stats(queue_name, project=self.project)
+            self.assertEqual(stats['messages']['claimed'], 0)
+            self.assertEqual(stats['messages']['free'], 3)
+
+            self.assertFalse(count.called)
+
     def test_raises_connection_error(self):
 
         with mock.patch.object(cursor.Cursor,
@@ -205,6 +640,43 @@ class MongodbMessageTests(base.MessageControllerTest):
             self.assertIn('queue_marker', indexes)
             self.assertIn('counting', indexes)
 
+    def test_compact_indexes(self):
+        self.config(options.MONGODB_GROUP, compact_indexes=True)
+        controller = controllers.MessageController(self.driver)
+
+        rows = indexes.report(self.driver)
+        unused = set(row['name'] for row in rows if not row['expected'])
+        self.assertEqual(unused, set(['claimed', 'counting', 'transaction']))
+
+        dropped = indexes.drop_unused(self.driver)
+        self.assertEqual(len(dropped), 3 * len(self.driver.message_databases))
+
+        for collection in controller._collections:
+            names = collection.index_information()
+            self.assertIn('claim_id', names)
+            self.assertIn('transaction_pending', names)
+            self.assertNotIn('claimed', names)
+            self.assertNotIn('counting', names)
+
+        # Claimed messages and counts are still served by the
+        # remaining indexes.
+        self.queue_controller.create(self.queue_name, self.project)
+        controller.post(self.queue_name,
+                        [{'ttl': 60, 'body': i} for i in range(3)],
+                        uuid.uuid4(), self.project)
+
+        meta = {'ttl': 60, 'grace': 60}
+        cid, msgs = self.claim_controller.create(self.queue_name, meta,
+                                                 project=self.project,
+                                                 limit=2)
+        self.assertEqual(len(list(msgs)), 2)
+
+        claimed = list(controller._claimed(self.queue_name,
+                                           utils.to_oid(cid),
+                                           project=self.project))
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(controller._count(self.queue_name, self.project), 1)
+
     def test_message_counter(self):
         queue_name = self.queue_name
         iterations = 10
@@ -266,6 +738,178 @@ class MongodbMessageTests(base.MessageControllerTest):
                                                          window=5)
             self.assertEqual(changed, reference_value + 1)
 
+    def test_marker_leasing(self):
+        queue_name = self.queue_name
+        self.controller._marker_lease_size = 10
+
+        seed_marker = self.queue_controller._get_counter(queue_name,
+                                                         self.project)
+
+        for i in range(3):
+            self.controller.post(queue_name, [{'ttl': 60}],
+                                 'uuid', project=self.project)
+
+        # A single block should have been reserved for all three posts
+        marker = self.queue_controller._get_counter(queue_name,
+                                                    self.project)
+        self.assertEqual(marker, seed_marker + 10)
+
+        # A batch that doesn't fit in the remainder of the current
+        # block gets a block of its own.
+        self.controller.post(queue_name, [{'ttl': 60}] * 12,
+                             'uuid', project=self.project)
+
+        marker = self.queue_controller._get_counter(queue_name,
+                                                    self.project)
+        self.assertEqual(marker, seed_marker + 22)
+
+        collection = self.controller._collection(queue_name, self.project)
+        scope = utils.scope_queue_name(queue_name, self.project)
+        markers = [msg['k'] for msg in
+                   collection.find({'p_q': scope}).sort('k', 1)]
+
+        expected = (list(range(seed_marker, seed_marker + 3)) +
+                    list(range(seed_marker + 10, seed_marker + 22)))
+        self.assertEqual(markers, expected)
+
+    def test_post_many_by_partition(self):
+        self.controller._marker_lease_size = 10
+
+        queues = ['fanout-{0}'.format(i) for i in range(6)]
+        for queue_name in queues:
+            self.queue_controller.create(queue_name, project=self.project)
+            self.addCleanup(self.queue_controller.delete, queue_name,
+                            project=self.project)
+
+        batches = dict((queue_name, [{'ttl': 60, 'body': queue_name}] * 2)
+                       for queue_name in queues)
+
+        with mock.patch.object(self.controller, 'post') as post:
+            created = self.controller.post_many(batches, 'uuid',
+                                                project=self.project)
+            self.assertFalse(post.called)
+
+        partitions = set(utils.get_partition(self.controller._num_partitions,
+                                             queue_name, self.project)
+                         for queue_name in queues)
+        self.assertEqual(
+            self.driver.metrics.get('messages.post_many.partitions'),
+            len(partitions))
+
+        for queue_name in queues:
+            messages = list(next(self.controller.list(queue_name,
+                                                      project=self.project,
+                                                      echo=True)))
+
+            self.assertEqual(sorted(msg['id'] for msg in messages),
+                             sorted(created[queue_name]))
+            self.assertEqual(set(msg['body'] for msg in messages),
+                             set([queue_name]))
+
+    def test_post_many_backs_out_on_failure(self):
+        self.controller._marker_lease_size = 10
+
+        queues = ['fanout-{0}'.format(i) for i in range(6)]
+        for queue_name in queues:
+            self.queue_controller.create(queue_name, project=self.project)
+            self.addCleanup(self.queue_controller.delete, queue_name,
+                            project=self.project)
+
+        partitions = set(utils.get_partition(self.controller._num_partitions,
+                                             queue_name, self.project)
+                         for queue_name in queues)
+        self.assertGreater(len(partitions), 1)
+
+        batches = dict((queue_name, [{'ttl': 60, 'body': queue_name}] * 2)
+                       for queue_name in queues)
+
+        # Fail once every partition but the last has been inserted
+        lease_markers = self.controller._lease_markers
+        leased = []
+
+        def lease_or_fail(queue_name, project, count):
+            leased.append(queue_name)
+            if len(leased) == len(queues):
+                raise RuntimeError('simulated failure')
+
+            return lease_markers(queue_name, project, count)
+
+        with mock.patch.object(self.controller, '_lease_markers',
+                               side_effect=lease_or_fail):
+            self.assertRaises(RuntimeError, self.controller.post_many,
+                              batches, 'uuid', project=self.project)
+
+        for queue_name in queues:
+            scope = utils.scope_queue_name(queue_name, self.project)
+            collection = self.controller._collection(queue_name,
+                                                     self.project)
+            self.assertEqual(collection.find({'p_q': scope}).count(), 0)
+
+    def test_visibility_watermark(self):
+        queue_name = self.queue_name
+        self.controller._use_watermark = True
+
+        messages = [{'ttl': 60, 'body': i} for i in range(3)]
+        self.controller.post(queue_name, messages, 'uuid',
+                             project=self.project)
+
+        interaction = self.controller.list(queue_name, echo=True,
+                                           project=self.project)
+        listed = list(next(interaction))
+        self.assertEqual([msg['body'] for msg in listed], [0, 1, 2])
+
+        # Simulate a batch that was inserted, but whose post has not
+        # completed yet, by keeping the counter from moving forward.
+        with mock.patch.object(mongodb.queues.QueueController,
+                               '_inc_counter', autospec=True):
+            self.controller.post(queue_name, messages, 'uuid',
+                                 project=self.project)
+
+        interaction = self.controller.list(queue_name, echo=True,
+                                           project=self.project)
+        self.assertEqual(len(list(next(interaction))), 3)
+
+        collection = self.controller._collection(queue_name, self.project)
+        self.assertEqual(collection.find({'tx': {'$ne': None}}).count(), 0)
+
+    def test_watermark_removes_crashed_batch(self):
+        queue_name = self.queue_name
+        self.controller._use_watermark = True
+
+        # Simulate a worker that crashed part way through a batch, so
+        # the counter was never moved past the messages it inserted.
+        collection = self.controller._collection(queue_name, self.project)
+        counter = self.queue_controller._get_counter(queue_name,
+                                                     self.project)
+
+        crashed = self.controller._prepare_messages(
+            queue_name, self.project, [{'ttl': 60, 'body': 'crashed'}] * 2,
+            'uuid', timeutils.utcnow_ts(), None)
+        for index, message in enumerate(crashed):
+            message['k'] = counter + index
+
+        collection.insert(crashed)
+
+        # Once the counter has stalled, the crashed batch is removed
+        # rather than exposed by moving the counter past it.
+        window = mongodb.messages.COUNTER_STALL_WINDOW
+        later = timeutils.utcnow() + datetime.timedelta(seconds=window * 2)
+        timeutils_utcnow = 'marconi.openstack.common.timeutils.utcnow'
+        with mock.patch(timeutils_utcnow) as mock_utcnow:
+            mock_utcnow.return_value = later
+
+            with mock.patch.object(self.controller, '_backoff_sleep'):
+                created = self.controller.post(
+                    queue_name, [{'ttl': 60, 'body': 'posted'}] * 2,
+                    'uuid', project=self.project)
+
+        self.assertEqual(len(created), 2)
+        self.assertEqual(collection.find({'b': 'crashed'}).count(), 0)
+
+        interaction = self.controller.list(queue_name, echo=True,
+                                           project=self.project)
+        self.assertEqual([msg['id'] for msg in next(interaction)], created)
+
     def test_race_condition_on_post(self):
         queue_name = self.queue_name
 
@@ -366,6 +1010,271 @@ class MongodbMessageTests(base.MessageControllerTest):
                                              project=self.project)
         self.assertEqual(len(message_popped), 1)
 
+    def test_pop_stops_when_queue_is_empty(self):
+        queue_name = 'pop-empty-queue-test'
+        self.queue_controller.create(queue_name, self.project)
+        messages = [{'ttl': 60, 'body': i} for i in range(3)]
+        self.controller.post(queue_name, messages, uuid.uuid1(), self.project)
+
+        popped = self.controller.pop(queue_name, limit=20,
+                                     project=self.project)
+        self.assertEqual([m['body'] for m in popped], [0, 1, 2])
+
+        popped = self.controller.pop(queue_name, limit=20,
+                                     project=self.project)
+        self.assertEqual(popped, [])
+
+        collection = self.controller._collection(queue_name, self.project)
+        self.assertEqual(collection.find().count(), 0)
+
+    def test_pop_lost_to_race(self):
+        queue_name = 'pop-race-queue-test'
+        self.queue_controller.create(queue_name, self.project)
+        messages = [{'ttl': 60, 'body': i} for i in range(3)]
+        self.controller.post(queue_name, messages, uuid.uuid1(), self.project)
+
+        # Simulate a parallel pop that removes the first message
+        # after our candidates have been selected.
+        candidates = list(self.controller._active(
+            queue_name, echo=True, fields={'_id': 1, 't': 1, 'b': 1},
+            project=self.project))
+
+        self.assertEqual(len(self.controller.pop(queue_name, limit=1,
+                                                 project=self.project)), 1)
+
+        with mock.patch.object(self.controller, '_active',
+                               return_value=iter(candidates)):
+            popped = self.controller.pop(queue_name, limit=3,
+                                         project=self.project)
+
+        self.assertEqual([m['body'] for m in popped], [1, 2])
+
+        collection = self.controller._collection(queue_name, self.project)
+        self.assertEqual(collection.find().count(), 0)
+
+    def test_delete_with_expired_claim(self):
+        [msgid] = self.controller.post(self.queue_name,
+                                       [{'body': {}, 'ttl': 60}],
+                                       project=self.project,
+                                       client_uuid=uuid.uuid4())
+
+        meta = {'ttl': 60, 'grace': 60}
+        cid, _ = self.claim_controller.create(self.queue_name, meta,
+                                              project=self.project)
+
+        with testing.expect(errors.MessageIsClaimed):
+            self.controller.delete(self.queue_name, msgid,
+                                   project=self.project)
+
+        # Expire the claim behind the controller's back
+        collection = self.controller._collection(self.queue_name,
+                                                 self.project)
+        collection.update({'c.id': utils.to_oid(cid)},
+                          {'$set': {'c.e': timeutils.utcnow_ts() - 1}},
+                          multi=True)
+
+        with testing.expect(errors.MessageIsClaimedBy):
+            self.controller.delete(self.queue_name, msgid,
+                                   project=self.project, claim=cid)
+
+        # Once the claim has expired, the message is free again
+        self.controller.delete(self.queue_name, msgid, project=self.project)
+
+        with testing.expect(errors.MessageDoesNotExist):
+            self.controller.get(self.queue_name, msgid, project=self.project)
+
+    def test_partition_migration(self):
+        previous = self.controller._num_partitions
+
+        # Pick a queue that moves when going down to a single partition
+        queue_name = next(name for name in
+                          ('migrating-queue-%d' % i for i in range(100))
+                          if utils.get_partition(previous, name,
+                                                 self.project) != 0)
+
+        self.queue_controller.create(queue_name, self.project)
+        messages = [{'ttl': 60, 'body': i} for i in range(4)]
+        old_ids = self.controller.post(queue_name, messages,
+                                       uuid.uuid4(), self.project)
+
+        with mock.patch.multiple(self.controller, _num_partitions=1,
+                                 _prev_partitions=previous, _migrating=True):
+
+            old_collection = self.controller._previous_collection(
+                queue_name, self.project)
+            self.assertIsNotNone(old_collection)
+
+            [new_id] = self.controller.post(queue_name,
+                                            [{'ttl': 60, 'body': 4}],
+                                            uuid.uuid4(), self.project)
+
+            # Messages in either partition are visible, in order
+            interaction = self.controller.list(queue_name, echo=True,
+                                               project=self.project)
+            bodies = [m['body'] for m in next(interaction)]
+            self.assertEqual(bodies, list(range(5)))
+
+            msg = self.controller.get(queue_name, old_ids[0],
+                                      project=self.project)
+            self.assertEqual(msg['body'], 0)
+
+            self.controller.delete(queue_name, old_ids[0],
+                                   project=self.project)
+
+            # Move the remaining messages over, a batch at a time
+            migrate = self.controller._migrate_queue
+            self.assertEqual(migrate(queue_name, self.project, 2), 2)
+            self.assertEqual(migrate(queue_name, self.project, 2), 1)
+            self.assertEqual(migrate(queue_name, self.project, 2), 0)
+
+            self.assertEqual(old_collection.find().count(), 0)
+
+            interaction = self.controller.list(queue_name, echo=True,
+                                               project=self.project)
+            bodies = [m['body'] for m in next(interaction)]
+            self.assertEqual(bodies, list(range(1, 5)))
+
+            self.controller.delete(queue_name, new_id, project=self.project)
+            self.assertEqual(self.controller._count(queue_name,
+                                                    self.project), 3)
+
+    def test_partition_migration_with_pending_batch(self):
+        previous = self.controller._num_partitions
+
+        queue_name = next(name for name in
+                          ('migrating-queue-%d' % i for i in range(100))
+                          if utils.get_partition(previous, name,
+                                                 self.project) != 0)
+
+        self.queue_controller.create(queue_name, self.project)
+
+        # Simulate a batch posted by a worker still running with the
+        # previous number of partitions, which has been inserted, but
+        # not finalized yet.
+        transaction = objectid.ObjectId()
+        pending = self.controller._prepare_messages(
+            queue_name, self.project, [{'ttl': 60, 'body': i}
+                                       for i in range(2)],
+            'uuid', timeutils.utcnow_ts(), transaction)
+        counter = self.queue_controller._inc_counter(
+            queue_name, self.project, amount=len(pending))
+        for index, message in enumerate(pending):
+            message['k'] = counter - len(pending) + index
+
+        old_collection = self.controller._collection(queue_name,
+                                                     self.project)
+        old_collection.insert(pending)
+
+        with mock.patch.multiple(self.controller, _num_partitions=1,
+                                 _prev_partitions=previous, _migrating=True):
+
+            migrate = self.controller._migrate_queue
+            self.assertEqual(migrate(queue_name, self.project), 0)
+            self.assertEqual(old_collection.find({'tx': transaction}).count(),
+                             len(pending))
+
+            # The worker finalizes the batch where it inserted it
+            old_collection.update({'tx': transaction},
+                                  {'$set': {'tx': None}}, multi=True)
+
+            self.assertEqual(migrate(queue_name, self.project),
+                             len(pending))
+            self.assertEqual(old_collection.find().count(), 0)
+
+            interaction = self.controller.list(queue_name, echo=True,
+                                               project=self.project)
+            bodies = [m['body'] for m in next(interaction)]
+            self.assertEqual(bodies, [0, 1])
+
+    def test_compressed_bodies(self):
+        self.config(options.MONGODB_GROUP, body_codec='zlib',
+                    body_compression_threshold=0)
+        controller = controllers.MessageController(self.driver)
+
+        queue_name = 'compressed-queue'
+        self.queue_controller.create(queue_name, self.project)
+
+        body = {'event': 'BackupStarted', 'log': ['line'] * 100}
+        [msgid] = controller.post(queue_name, [{'ttl': 60, 'body': body}],
+                                  uuid.uuid4(), self.project)
+
+        collection = controller._collection(queue_name, self.project)
+        stored = collection.find_one({'_id': utils.to_oid(msgid)})['b']
+        self.assertIsInstance(stored, binary.Binary)
+
+        msg = controller.get(queue_name, msgid, project=self.project)
+        self.assertEqual(msg['body'], body)
+
+        # Bodies remain readable once compression is turned off
+        interaction = self.controller.list(queue_name, echo=True,
+                                           project=self.project)
+        self.assertEqual([m['body'] for m in next(interaction)], [body])
+
+        [popped] = self.controller.pop(queue_name, 1, project=self.project)
+        self.assertEqual(popped['body'], body)
+
+    def test_wait_for_messages(self):
+        self.config(options.MONGODB_GROUP, notifications=True)
+        controller = controllers.MessageController(self.driver)
+
+        queue_name = 'waiting-queue'
+        self.queue_controller.create(queue_name, self.project)
+
+        since = timeutils.utcnow_ts()
+        self.assertFalse(controller.wait(queue_name, self.project,
+                                         since=since, timeout=1))
+
+        controller.post(queue_name, [{'ttl': 60, 'body': {}}],
+                        uuid.uuid4(), self.project)
+
+        self.assertTrue(controller.wait(queue_name, self.project,
+                                        since=since, timeout=1))
+
+        # Notifications for one queue don't wake readers of another
+        self.assertFalse(controller.wait(self.queue_name, self.project,
+                                         since=since, timeout=1))
+
+        # Without notifications, wait() returns right away
+        self.assertFalse(self.controller.wait(queue_name, self.project,
+                                              since=since, timeout=1))
+
+    def test_sweep_expired_claims(self):
+        self.controller.post(self.queue_name,
+                             [{'ttl': 60, 'body': i} for i in range(3)],
+                             uuid.uuid4(), self.project)
+
+        meta = {'ttl': 60, 'grace': 60}
+        expired_cid, _ = self.claim_controller.create(self.queue_name, meta,
+                                                      project=self.project,
+                                                      limit=2)
+        live_cid, _ = self.claim_controller.create(self.queue_name, meta,
+                                                   project=self.project,
+                                                   limit=1)
+
+        # Expire the first claim behind the controller's back
+        collection = self.controller._collection(self.queue_name,
+                                                 self.project)
+        collection.update({'c.id': utils.to_oid(expired_cid)},
+                          {'$set': {'c.e': timeutils.utcnow_ts() - 1}},
+                          multi=True)
+
+        claim_sweeper = sweeper.ClaimSweeper(self.driver, self.controller)
+        claim_sweeper._batch_size = 1
+        claim_sweeper._batch_delay = 0
+
+        self.assertEqual(claim_sweeper.run_once(), 2)
+        self.assertEqual(claim_sweeper.run_once(), 0)
+        self.assertEqual(self.driver.metrics.get('claims.swept'), 2)
+
+        self.assertEqual(collection.find({'c.id': None}).count(), 2)
+        self.assertEqual(
+            collection.find({'c.id': utils.to_oid(live_cid)}).count(), 1)
+
+        # The swept messages can be claimed again
+        _, msgs = self.claim_controller.create(self.queue_name, meta,
+                                               project=self.project)
+        self.assertEqual(len(list(msgs)), 2)
+
     def test_empty_queue_exception(self):
         self.assertRaises(storage.errors.QueueIsEmpty,
                           self.controller.first,
@@ -410,6 +1319,66 @@ class MongodbClaimTests(base.ClaimControllerTest):
                           self.controller.update, self.queue_name,
                           claim_id, {}, project=self.project)
 
+    def test_claim_lost_to_race(self):
+        self.message_controller.post(self.queue_name,
+                                     [{'ttl': 60, 'body': i}
+                                      for i in range(3)],
+                                     'uuid', project=self.project)
+
+        # Take a snapshot of the claimable messages, then let a
+        # parallel request claim the first one.
+        stale = list(self.message_controller._active(
+            self.queue_name, fields={'_id': 1, 't': 1, 'b': 1, 'e': 1},
+            project=self.project))
+
+        meta = {'ttl': 60, 'grace': 0}
+        self.controller.create(self.queue_name, meta,
+                               project=self.project, limit=1)
+
+        with mock.patch.object(self.message_controller, '_active',
+                               return_value=iter(stale)):
+            claim_id, messages = self.controller.create(
+                self.queue_name, meta, project=self.project)
+
+        messages = list(messages)
+        self.assertEqual([msg['body'] for msg in messages], [1, 2])
+        self.assertEqual(self.driver.metrics.get('claims.lost'), 1)
+
+        claim, claimed = self.controller.get(self.queue_name, claim_id,
+                                             project=self.project)
+        self.assertEqual(messages, list(claimed))
+
+    def test_claim_extends_expiring_messages_only(self):
+        short_id, long_id = self.message_controller.post(
+            self.queue_name, [{'ttl': 30, 'body': 0}, {'ttl': 30, 'body': 1}],
+            'uuid', project=self.project)
+
+        # Push the second message's expiration past the claim's,
+        # without touching its TTL.
+        collection = self.message_controller._collection(self.queue_name,
+                                                         self.project)
+        far = timeutils.utcnow() + datetime.timedelta(seconds=3600)
+        collection.update({'_id': utils.to_oid(long_id)},
+                          {'$set': {'e': far}})
+
+        meta = {'ttl': 60, 'grace': 60}
+        claim_id, messages = self.controller.create(self.queue_name, meta,
+                                                    project=self.project)
+
+        ttls = dict((msg['id'], msg['ttl']) for msg in messages)
+        self.assertEqual(ttls, {short_id: 120, long_id: 30})
+
+        docs = dict((str(doc['_id']), doc) for doc in collection.find(
+            {'_id': {'$in': [utils.to_oid(short_id),
+                             utils.to_oid(long_id)]}}))
+        self.assertEqual(docs[short_id]['t'], 120)
+        self.assertEqual(docs[long_id]['t'], 30)
+        self.assertEqual(docs[long_id]['e'].replace(microsecond=0),
+                         far.replace(microsecond=0))
+
+        for doc in docs.values():
+            self.assertEqual(str(doc['c']['id']), claim_id)
+
 
 @testing.requires_mongodb
 class MongodbPoolsTests(base.PoolsControllerTest):
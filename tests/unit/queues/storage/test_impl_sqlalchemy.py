@@ -12,14 +12,21 @@
 # License for the specific language governing permissions and limitations under
 # the License.
 
+import calendar
 import datetime
 
 import sqlalchemy as sa
 
+from marconi.common import metrics
+from marconi.openstack.common import timeutils
 from marconi.queues.storage import errors
 from marconi.queues.storage import pooling
 from marconi.queues.storage import sqlalchemy
 from marconi.queues.storage.sqlalchemy import controllers
+from marconi.queues.storage.sqlalchemy import messages
+from marconi.queues.storage.sqlalchemy import migration
+from marconi.queues.storage.sqlalchemy import options
+from marconi.queues.storage.sqlalchemy import reaper
 from marconi.queues.storage.sqlalchemy import tables
 from marconi.queues.storage.sqlalchemy import utils
 from marconi import tests as testing
@@ -56,10 +63,151 @@ class SqlalchemyTableTests(testing.TestBase):
         self.assertIsNone(row)
 
 
+class SqlalchemyMigrationTests(testing.TestBase):
+
+    def setUp(self):
+        super(SqlalchemyMigrationTests, self).setUp()
+        self.engine = sa.create_engine('sqlite:///:memory:')
+
+        # The tables as created by earlier releases, without the
+        # expires column or any index.
+        legacy = sa.MetaData()
+        self.queues = sa.Table('Queues', legacy,
+                               sa.Column('id', sa.INTEGER, primary_key=True),
+                               sa.Column('project', sa.String(64)),
+                               sa.Column('name', sa.String(64)),
+                               sa.Column('metadata', sa.LargeBinary))
+        self.claims = sa.Table('Claims', legacy,
+                               sa.Column('id', sa.INTEGER, primary_key=True),
+                               sa.Column('qid', sa.INTEGER,
+                                         sa.ForeignKey('Queues.id')),
+                               sa.Column('ttl', sa.INTEGER),
+                               sa.Column('created', sa.TIMESTAMP))
+        self.messages = sa.Table('Messages', legacy,
+                                 sa.Column('id', sa.INTEGER,
+                                           primary_key=True),
+                                 sa.Column('qid', sa.INTEGER,
+                                           sa.ForeignKey('Queues.id')),
+                                 sa.Column('ttl', sa.INTEGER),
+                                 sa.Column('body', sa.LargeBinary),
+                                 sa.Column('client', sa.TEXT),
+                                 sa.Column('created', sa.TIMESTAMP),
+                                 sa.Column('cid', sa.INTEGER,
+                                           sa.ForeignKey('Claims.id')))
+        legacy.create_all(self.engine)
+
+    def test_upgrade(self):
+        created = datetime.datetime(2014, 7, 1, 12, 0, 0)
+        created_ts = calendar.timegm(created.timetuple())
+
+        self.engine.execute(self.queues.insert(), id=1, project='',
+                            name='legacy')
+        self.engine.execute(self.claims.insert(), id=1, qid=1, ttl=30,
+                            created=created)
+        self.engine.execute(self.messages.insert(), [
+            dict(id=i, qid=1, ttl=60 + i, body=utils.json_encode(i),
+                 client='a', created=created, cid=None)
+            for i in range(1, migration.BACKFILL_BATCH_SIZE + 2)
+        ])
+
+        self.assertFalse(migration.is_current(self.engine))
+
+        changes = migration.upgrade(self.engine)
+        self.assertTrue(changes)
+        self.assertTrue(migration.is_current(self.engine))
+
+        sel = sa.sql.select([tables.Messages.c.id, tables.Messages.c.expires])
+        rows = self.engine.execute(sel).fetchall()
+        self.assertEqual(len(rows), migration.BACKFILL_BATCH_SIZE + 1)
+        for id, expires in rows:
+            self.assertEqual(expires, created_ts + 60 + id)
+
+        sel = sa.sql.select([tables.Claims.c.expires])
+        self.assertEqual(self.engine.execute(sel).scalar(), created_ts + 30)
+
+        # Applying the migration again changes nothing
+        self.assertEqual(migration.upgrade(self.engine), [])
+
+
+class QidCacheTests(testing.TestBase):
+
+    def setUp(self):
+        super(QidCacheTests, self).setUp()
+        self.metrics = metrics.Registry()
+
+    def test_evicts_least_recently_used(self):
+        cache = utils.QidCache(2, self.metrics)
+        cache.set('p', 'a', 1)
+        cache.set('p', 'b', 2)
+
+        self.assertEqual(cache.get('p', 'a'), 1)
+        cache.set('p', 'c', 3)
+
+        self.assertIsNone(cache.get('p', 'b'))
+        self.assertEqual(cache.get('p', 'a'), 1)
+        self.assertEqual(cache.get('p', 'c'), 3)
+
+        self.assertEqual(self.metrics.get('qid_cache.hits'), 3)
+        self.assertEqual(self.metrics.get('qid_cache.misses'), 1)
+
+    def test_entries_expire(self):
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+
+        cache = utils.QidCache(10, self.metrics)
+        cache.set('p', 'a', 1)
+
+        timeutils.advance_time_seconds(utils.QID_CACHE_TTL + 1)
+        self.assertIsNone(cache.get('p', 'a'))
+
+    def test_disabled(self):
+        cache = utils.QidCache(0, self.metrics)
+        cache.set('p', 'a', 1)
+        self.assertIsNone(cache.get('p', 'a'))
+
+
 class SqlalchemyQueueTests(base.QueueControllerTest):
     driver_class = sqlalchemy.DataDriver
     controller_class = controllers.QueueController
 
+    def test_qid_cache(self):
+        self.controller.create('cached', self.project)
+        qid = utils.get_qid(self.driver, 'cached', self.project)
+
+        self.assertEqual(utils.get_qid(self.driver, 'cached', self.project),
+                         qid)
+        self.assertEqual(self.driver.metrics.get('qid_cache.misses'), 0)
+
+        self.controller.delete('cached', self.project)
+        self.assertRaises(errors.QueueDoesNotExist,
+                          utils.get_qid, self.driver, 'cached', self.project)
+
+    def test_pool_options(self):
+        conf = self.driver.sqlalchemy_conf
+        self.assertEqual(utils.pool_options(conf), {})
+
+        self.config(options.SQLALCHEMY_GROUP, uri='mysql://localhost/marconi',
+                    pool_size=20, max_overflow=0, pool_recycle=3600)
+        self.assertEqual(utils.pool_options(conf),
+                         {'pool_size': 20, 'max_overflow': 0,
+                          'pool_recycle': 3600})
+
+    def test_pool_metrics(self):
+        self.config(options.SQLALCHEMY_GROUP, pool_pre_ping=True)
+        driver = sqlalchemy.DataDriver(self.conf, self.driver.cache)
+        metrics = driver.metrics
+
+        driver.queue_controller.create('pooled', self.project)
+        self.assertEqual(metrics.get('pool.in_use'), 0)
+
+        with driver.trans():
+            self.assertEqual(metrics.get('pool.in_use'), 1)
+
+        self.assertEqual(metrics.get('pool.in_use'), 0)
+        self.assertTrue(metrics.get('pool.checkout.count') >= 2)
+        self.assertEqual(metrics.get('pool.stale'), 0)
+        self.assertEqual(metrics.get('pool.timeouts'), 0)
+
 
 class SqlalchemyMessageTests(base.MessageControllerTest):
     driver_class = sqlalchemy.DataDriver
@@ -73,6 +221,127 @@ class SqlalchemyMessageTests(base.MessageControllerTest):
                           self.controller.first,
                           queue_name, None, sort=1)
 
+    def test_compressed_bodies(self):
+        self.config(options.SQLALCHEMY_GROUP, body_codec='zlib',
+                    body_compression_threshold=0)
+        controller = controllers.MessageController(self.driver)
+
+        queue_name = 'compressed-queue'
+        self.queue_controller.create(queue_name, self.project)
+
+        body = {'event': 'BackupStarted', 'log': ['line'] * 100}
+        uuid = '33a7ce80-0892-11e4-9d5d-28cfe91478b9'
+        [msgid] = controller.post(queue_name, [{'ttl': 60, 'body': body}],
+                                  uuid, self.project)
+
+        sel = sa.sql.select([tables.Messages.c.body])
+        stored = self.driver.get(sel)[0]
+        self.assertEqual(stored[:1], b'\x00')
+
+        msg = controller.get(queue_name, msgid, project=self.project)
+        self.assertEqual(msg['body'], body)
+
+        # Bodies remain readable once compression is turned off
+        interaction = self.controller.list(queue_name, echo=True,
+                                           project=self.project)
+        self.assertEqual([m['body'] for m in next(interaction)], [body])
+
+        self.assertEqual(self.driver.metrics.get('compression.compressed'),
+                         1)
+
+    def test_expired_messages_are_hidden(self):
+        queue_name = 'expired-messages-test'
+        self.queue_controller.create(queue_name, self.project)
+
+        uuid = '33a7ce80-0892-11e4-9d5d-28cfe91478b9'
+        msgids = self.controller.post(queue_name,
+                                      [{'ttl': 60, 'body': i}
+                                       for i in range(3)],
+                                      uuid, self.project)
+
+        self.driver.run(tables.Messages.update().values(
+            expires=timeutils.utcnow_ts() - 1))
+
+        self.assertRaises(errors.MessageDoesNotExist,
+                          self.controller.get,
+                          queue_name, msgids[0], self.project)
+
+        interaction = self.controller.list(queue_name, echo=True,
+                                           project=self.project)
+        self.assertEqual(list(next(interaction)), [])
+
+        self.assertRaises(errors.QueueIsEmpty,
+                          self.controller.first,
+                          queue_name, self.project)
+
+        stats = self.queue_controller.stats(queue_name, self.project)
+        self.assertEqual(stats['messages']['total'], 0)
+
+    def test_post_ids_with_concurrent_producer(self):
+        self.queue_controller.create('fanin', self.project)
+        self.queue_controller.create('other', self.project)
+        other_qid = utils.get_qid(self.driver, 'other', self.project)
+
+        # Simulates another producer whose messages are inserted right
+        # after the first of ours, before the post looks up its ids.
+        interleaved = []
+
+        def interleave(conn, clauseelement, multiparams, params, result):
+            if (interleaved or
+                    not isinstance(clauseelement, sa.sql.expression.Insert)
+                    or clauseelement.table is not tables.Messages):
+                return
+
+            interleaved.append(True)
+            now = timeutils.utcnow()
+            conn.execute(tables.Messages.insert(), [
+                dict(qid=other_qid, ttl=60, body=utils.json_encode(i),
+                     client='other', created=now,
+                     expires=timeutils.utcnow_ts() + 60)
+                for i in range(3)
+            ])
+
+        sa.event.listen(self.driver.engine, 'after_execute', interleave)
+
+        uuid = '33a7ce80-0892-11e4-9d5d-28cfe91478b9'
+        msgids = self.controller.post('fanin',
+                                      [{'ttl': 60, 'body': i}
+                                       for i in range(5)],
+                                      uuid, self.project)
+        self.assertTrue(interleaved)
+
+        bodies = [self.controller.get('fanin', msgid, self.project)['body']
+                  for msgid in msgids]
+        self.assertEqual(bodies, list(range(5)))
+
+    def test_insert_strategies(self):
+        self.assertEqual(messages.insert_strategy(self.driver.engine.dialect),
+                         messages.insert_contiguous)
+
+        self.queue_controller.create('strategies', self.project)
+        qid = utils.get_qid(self.driver, 'strategies', self.project)
+
+        now = timeutils.utcnow()
+        count = messages.INSERT_CHUNK_SIZE + 1
+        rows = [dict(qid=qid, ttl=60, body=utils.json_encode(i),
+                     client='a', created=now, cid=None,
+                     expires=timeutils.utcnow_ts() + 60)
+                for i in range(count)]
+
+        for insert_rows in (messages.insert_contiguous,
+                            messages.insert_each):
+            with self.driver.trans() as trans:
+                ids = insert_rows(trans, rows)
+
+            self.assertEqual(len(ids), count)
+
+            sel = sa.sql.select([tables.Messages.c.id,
+                                 tables.Messages.c.body],
+                                tables.Messages.c.id.in_(ids))
+            stored = dict(self.driver.run(sel).fetchall())
+            self.assertEqual([utils.json_decode(stored[id]) for id in ids],
+                             list(range(count)))
+
     def test_pop_message(self):
         queue_name = 'pop-message-test'
         self.queue_controller.create(queue_name, self.project)
@@ -114,6 +383,64 @@ class SqlalchemyClaimTests(base.ClaimControllerTest):
     driver_class = sqlalchemy.DataDriver
     controller_class = controllers.ClaimController
 
+    def _post(self, count):
+        uuid = '33a7ce80-0892-11e4-9d5d-28cfe91478b9'
+        return self.message_controller.post(self.queue_name,
+                                            [{'ttl': 60, 'body': i}
+                                             for i in range(count)],
+                                            uuid, self.project)
+
+    def test_expired_claims_release_messages(self):
+        # With the reaper enabled, expired claims are no longer
+        # deleted inline when claiming.
+        self.config(options.SQLALCHEMY_GROUP, reap_interval=3600)
+        self._post(2)
+
+        meta = {'ttl': 60, 'grace': 0}
+        self.controller.create(self.queue_name, meta, project=self.project)
+        self.driver.run(tables.Claims.update().values(
+            expires=timeutils.utcnow_ts() - 1))
+
+        stats = self.queue_controller.stats(self.queue_name, self.project)
+        self.assertEqual(stats['messages']['claimed'], 0)
+        self.assertEqual(stats['messages']['free'], 2)
+
+        claim_id, messages = self.controller.create(self.queue_name, meta,
+                                                    project=self.project)
+        self.assertEqual(len(messages), 2)
+
+        sel = sa.sql.select([sa.func.count(tables.Claims.c.id)])
+        self.assertEqual(self.driver.get(sel)[0], 2)
+
+    def test_reaper(self):
+        msgids = self._post(4)
+
+        meta = {'ttl': 60, 'grace': 0}
+        self.controller.create(self.queue_name, meta, project=self.project,
+                               limit=2)
+
+        past = timeutils.utcnow_ts() - 1
+        self.driver.run(tables.Claims.update().values(expires=past))
+        self.driver.run(tables.Messages.update().values(expires=past).where(
+            tables.Messages.c.id.in_([utils.msgid_decode(msgid)
+                                      for msgid in msgids[2:]])))
+
+        expiry_reaper = reaper.ExpiryReaper(self.driver,
+                                            self.message_controller)
+        expiry_reaper._batch_size = 1
+        expiry_reaper._batch_delay = 0
+
+        self.assertEqual(expiry_reaper.run_once(), (1, 2))
+        self.assertEqual(expiry_reaper.run_once(), (0, 0))
+
+        # The messages of the expired claim were released
+        sel = sa.sql.select([tables.Messages.c.cid])
+        self.assertEqual([row[0] for row in self.driver.run(sel)],
+                         [None, None])
+
+        self.assertEqual(self.driver.metrics.get('reaper.claims'), 1)
+        self.assertEqual(self.driver.metrics.get('reaper.messages'), 2)
+
 
 class SqlalchemyPoolsTest(base.PoolsControllerTest):
     driver_class = sqlalchemy.ControlDriver
@@ -15,10 +15,12 @@
 import random
 import uuid
 
+import mock
 from oslo.config import cfg
 import six
 
 from marconi.openstack.common.cache import cache as oslo_cache
+from marconi.queues.storage import errors
 from marconi.queues.storage import pooling
 from marconi.queues.storage import utils
 from marconi import tests as testing
@@ -97,3 +99,49 @@ class PoolQueuesTest(testing.TestBase):
         queues = list(next(interaction))
 
         self.assertEqual(len(queues), 0)
+
+
+class PoolMessagesTest(testing.TestBase):
+
+    def setUp(self):
+        super(PoolMessagesTest, self).setUp()
+
+        # One queue per pool, posted to in whatever order the pools
+        # come up in.
+        self.targets = {'fizbit': mock.Mock(), 'fizbat': mock.Mock()}
+        self.posted = []
+
+        catalog = mock.Mock()
+        catalog.lookup.side_effect = lambda queue, project: (
+            self.targets[queue])
+        self.controller = pooling.MessageController(catalog)
+
+    def _post_many(self, failure):
+        def post_many(batches, client_uuid, project=None):
+            if self.posted:
+                raise failure(batches)
+
+            self.posted.extend(batches)
+            return dict((queue, ['id']) for queue in batches)
+
+        for target in six.itervalues(self.targets):
+            target.message_controller.post_many.side_effect = post_many
+
+        batches = dict((queue, [{'ttl': 60, 'body': {}}])
+                       for queue in self.targets)
+        return self.assertRaises(errors.FanoutIncomplete,
+                                 self.controller.post_many, batches,
+                                 client_uuid=uuid.uuid4(), project='p')
+
+    def test_post_many_partial(self):
+        ex = self._post_many(lambda batches: RuntimeError())
+        self.assertEqual(ex.succeeded_ids, {self.posted[0]: ['id']})
+
+    def test_post_many_partial_within_pool(self):
+        # The pools' own partial results are merged
+        ex = self._post_many(lambda batches: errors.FanoutIncomplete(
+            'p', dict((queue, ['other']) for queue in batches)))
+
+        other, = set(self.targets) - set(self.posted)
+        self.assertEqual(ex.succeeded_ids,
+                         {self.posted[0]: ['id'], other: ['other']})